@@ -0,0 +1,162 @@
+""" Benchmark: concurrent reads through the threaded WSGI app and the ASGI app
+
+Every client loops over GETs of persons, meals, portions and mealrecords. In the
+WSGI mode every client is a thread calling the Flask app, as a threaded WSGI
+server would run one thread per connection. In the ASGI mode the clients are
+tasks on one event loop calling tapi.asgi.AsgiApp, which runs the views in
+--threads worker threads. Both call the apps directly, without sockets and
+HTTP parsing. The requests/s are over the time until the last client has
+stopped, the latencies include the wait for a thread.
+
+Run from the flask-server directory:
+    python -m benchmarks.asgi_bench --clients 64 --threads 8 --seconds 5
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import statistics
+import tempfile
+import threading
+import time
+import warnings
+
+from tapi import create_app, db
+from tapi.asgi import AsgiApp, wsgi_environ
+from tapi.example_data import db_load_example_data
+
+URLS = [
+    ('/api/persons/', b''),
+    ('/api/persons/123/', b''),
+    ('/api/meals/', b''),
+    ('/api/meals/oatmeal/', b''),
+    ('/api/portions/', b'limit=50'),
+    ('/api/persons/123/mealrecords/', b'limit=50&order=desc'),
+    ('/api/persons/123/mealrecords/', b'limit=50&after=oatmeal%2F123-oatmeal-2020-01-10_00%3A00%3A00.000000'),
+]
+
+
+def scope(path, query):
+    return {'type': 'http', 'method': 'GET', 'path': path, 'query_string': query, 'headers': [],
+            'server': ('localhost', 80), 'root_path': ''}
+
+
+def seed(app, records):
+    client = app.test_client()
+    start = datetime.datetime(2020, 1, 1)
+    for first in range(0, records, 1000):
+        batch = [{'person_id': '123', 'meal_id': 'oatmeal', 'amount': 1,
+                  'timestamp': str(start + datetime.timedelta(minutes=i))}
+                 for i in range(first, min(first + 1000, records))]
+        client.post("/api/mealrecords/batch/", data=json.dumps(batch), content_type="application/json")
+
+
+def run_wsgi(app, args):
+    stop = threading.Event()
+    latencies = [[] for _ in range(args.clients)]
+    errors = [0] * args.clients
+
+    def client(number):
+        statuses = []
+
+        def start_response(status, headers, exc_info=None):
+            statuses.append(status)
+
+        i = 0
+        while not stop.is_set():
+            path, query = URLS[i % len(URLS)]
+            started = time.perf_counter()
+            result = app.wsgi_app(wsgi_environ(scope(path, query), b''), start_response)
+            b''.join(result)
+            result.close()
+            latencies[number].append(time.perf_counter() - started)
+            if not statuses.pop().startswith('200'):
+                errors[number] += 1
+            i += 1
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(args.clients)]
+    started = time.perf_counter()
+    for t in threads:
+        t.start()
+    time.sleep(args.seconds)
+    stop.set()
+    for t in threads:
+        t.join()
+    return time.perf_counter() - started, latencies, errors
+
+
+def run_asgi(app, args):
+    asgi = AsgiApp(app, args.threads)
+    latencies = [[] for _ in range(args.clients)]
+    errors = [0] * args.clients
+
+    async def client(number, deadline):
+        i = 0
+        while time.perf_counter() < deadline:
+            path, query = URLS[i % len(URLS)]
+            sent = []
+
+            async def receive():
+                return {'type': 'http.request', 'body': b''}
+
+            async def send(message):
+                sent.append(message)
+
+            started = time.perf_counter()
+            await asgi(scope(path, query), receive, send)
+            latencies[number].append(time.perf_counter() - started)
+            if sent[0]['status'] != 200:
+                errors[number] += 1
+            i += 1
+
+    async def main():
+        await asyncio.gather(*[client(i, started + args.seconds) for i in range(args.clients)])
+
+    started = time.perf_counter()
+    asyncio.run(main())
+    elapsed = time.perf_counter() - started
+    asgi.executor.shutdown()
+    return elapsed, latencies, errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--clients", type=int, default=64)
+    parser.add_argument("--threads", type=int, default=8, help="worker threads of the ASGI app")
+    parser.add_argument("--seconds", type=float, default=5)
+    parser.add_argument("--records", type=int, default=20000)
+    parser.add_argument("--no-cache", action="store_true", help="without the response cache")
+    args = parser.parse_args()
+    warnings.simplefilter("ignore")
+
+    db_fd, db_fname = tempfile.mkstemp()
+    config = {"SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname}
+    if args.no_cache:
+        config["RESPONSE_CACHE_SIZE"] = 0
+    app = create_app(config)
+    with app.app_context():
+        db_load_example_data(db)
+        seed(app, args.records)
+        db.session.remove()
+
+    print("{} clients, {} ASGI threads, {} s, {} mealrecords{}".format(
+        args.clients, args.threads, args.seconds, args.records, ", no cache" if args.no_cache else ""))
+    print("{:<8}{:>12}{:>10}{:>10}{:>10}".format("mode", "requests/s", "p50 ms", "p99 ms", "errors"))
+    for name, run in [("wsgi", run_wsgi), ("asgi", run_asgi)]:
+        elapsed, latencies, errors = run(app, args)
+        latencies = sorted(l for client in latencies for l in client)
+        percentiles = statistics.quantiles(latencies, n=100)
+        print("{:<8}{:>12.0f}{:>10.1f}{:>10.1f}{:>10}".format(
+            name, len(latencies) / elapsed, percentiles[49] * 1000, percentiles[98] * 1000, sum(errors)))
+
+    with app.app_context():
+        db.engine.dispose()
+    os.close(db_fd)
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(db_fname + suffix):
+            os.unlink(db_fname + suffix)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+""" Benchmark: concurrent reads and writes against one SQLite database
+
+Reader threads page through the mealrecords of a person while writer threads
+POST new mealrecords, through the WSGI app. Runs once with the SQLite defaults
+(rollback journal, synchronous=FULL, no pragmas) and once with the engine
+configuration of tapi.database, and prints the throughput and the failed
+requests ("database is locked") of both.
+
+Run from the flask-server directory:
+    python -m benchmarks.concurrency_bench --readers 8 --writers 4 --seconds 5
+"""
+import argparse
+import datetime
+import json
+import os
+import tempfile
+import threading
+import time
+import warnings
+
+from tapi import create_app, db
+from tapi.database import DEFAULT_SQLITE_PRAGMAS
+
+CONFIGS = [
+    ("sqlite defaults", {"SQLITE_PRAGMAS": {name: None for name in DEFAULT_SQLITE_PRAGMAS}}),
+    ("tapi.database", {}),
+]
+
+
+def reader(client, stop, counts):
+    while not stop.is_set():
+        r = client.get("/api/persons/123/mealrecords/?limit=50&order=desc")
+        counts['reads' if r.status_code == 200 else 'read_errors'] += 1
+
+
+def writer(client, stop, counts, number):
+    i = 0
+    start = datetime.datetime(2021, 1, 1) + datetime.timedelta(days=number * 1000)
+    while not stop.is_set():
+        record = {'person_id': '123', 'meal_id': 'oatmeal', 'amount': 1,
+                  'timestamp': str(start + datetime.timedelta(seconds=i, microseconds=1))}
+        r = client.post("/api/mealrecords/", data=json.dumps(record), content_type="application/json")
+        counts['writes' if r.status_code == 201 else 'write_errors'] += 1
+        i += 1
+
+
+def run(config, args):
+    db_fd, db_fname = tempfile.mkstemp()
+    app = create_app(dict({"SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname}, **config))
+    stop = threading.Event()
+    counts = [dict(reads=0, read_errors=0, writes=0, write_errors=0)
+              for _ in range(args.readers + args.writers)]
+
+    def in_app(fn, *fn_args):
+        # every thread with its own app context, so its own session
+        with app.app_context():
+            fn(app.test_client(), stop, *fn_args)
+            db.session.remove()
+
+    threads = [threading.Thread(target=in_app, args=(reader, counts[i])) for i in range(args.readers)]
+    threads += [threading.Thread(target=in_app, args=(writer, counts[args.readers + i], i))
+                for i in range(args.writers)]
+    for t in threads:
+        t.start()
+    time.sleep(args.seconds)
+    stop.set()
+    for t in threads:
+        t.join()
+    with app.app_context():
+        db.engine.dispose()
+    os.close(db_fd)
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(db_fname + suffix):
+            os.unlink(db_fname + suffix)
+    return {key: sum(c[key] for c in counts) / args.seconds for key in counts[0]}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--readers", type=int, default=8)
+    parser.add_argument("--writers", type=int, default=4)
+    parser.add_argument("--seconds", type=float, default=5)
+    args = parser.parse_args()
+    warnings.simplefilter("ignore")
+
+    print("{} readers, {} writers, {} s".format(args.readers, args.writers, args.seconds))
+    print("{:<18}{:>10}{:>16}{:>10}{:>16}".format("config", "reads/s", "read errors/s", "writes/s", "write errors/s"))
+    for name, config in CONFIGS:
+        result = run(config, args)
+        print("{:<18}{:>10.0f}{:>16.1f}{:>10.0f}{:>16.1f}".format(
+            name, result['reads'], result['read_errors'], result['writes'], result['write_errors']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,426 @@
+""" Benchmark: latency and throughput of every endpoint, and the tapi.utils helpers
+
+Seeds a database with --size meal records (1k, 100k or 1m; --records for any
+other count) of --persons persons and --meals meals, and --portions portions
+with --portions-per-meal of them in every meal. The rows are inserted with bulk
+inserts, then the MealNutrients and DailyIntake tables are built from them.
+
+Every GET is requested --requests times (or for at most --max-seconds) through
+the Flask test client, one request at a time, after one warm-up request. The
+writes create, change and delete their own rows, every write --requests times.
+The p50/p90/p99 latencies include reading the whole body, requests/s is one
+client. The response cache is off unless --cache-size is given, so the views
+themselves are measured.
+
+The micro-benchmarks time the handle, *_to_api_* and CalorieBuilder helpers of
+tapi.utils per call. Everything is written to --output as JSON, with
+--compare an earlier output the ratios to it are printed too.
+
+Run from the flask-server directory:
+    python -m benchmarks.endpoint_bench --size 100k --output results.json
+    python -m benchmarks.endpoint_bench --size 100k --db /tmp/bench.db --compare results.json
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+import warnings
+from types import SimpleNamespace
+from urllib.parse import quote
+
+from sqlalchemy import func, select
+
+from tapi import create_app, db
+from tapi.models import Meal, MealPortion, MealRecord, Person, Portion
+from tapi.nutrition import rebuild_daily_intake, refresh_meal_nutrients
+from tapi.utils import CalorieBuilder, make_mealportion_handle, make_mealrecord_handle, mealportion_to_api_mealportion
+from tapi.utils import meal_to_api_meal, mealrecord_to_api_mealrecord, person_to_api_person, portion_to_api_portion
+
+SIZES = {'1k': 1000, '100k': 100000, '1m': 1000000}
+START = datetime.datetime(2021, 1, 1, 0, 0, 0, 1)
+CHUNK = 10000
+APPLICATION_JSON = "application/json"
+
+
+def person_id(i):
+    return "person-{}".format(i)
+
+
+def meal_id(i):
+    return "meal-{}".format(i)
+
+
+def portion_id(i):
+    return "portion-{}".format(i)
+
+
+def record_of(i, sizes):
+    # (person, meal, timestamp) of the i:th seeded mealrecord, a minute apart
+    return i % sizes['persons'], i % sizes['meals'], START + datetime.timedelta(minutes=i)
+
+
+def seed(connection, sizes):
+    """ Bulk inserts the persons, meals, portions, mealportions and mealrecords, pk = index + 1 """
+    def insert(model, rows):
+        for chunk in chunked_rows(rows):
+            connection.execute(model.__table__.insert(), chunk)
+
+    insert(Person, ({'pk': i + 1, 'id': person_id(i)} for i in range(sizes['persons'])))
+    insert(Meal, ({'pk': i + 1, 'id': meal_id(i), 'name': "Meal {}".format(i), 'servings': 1 + i % 4,
+                   'description': "Benchmark meal number {}".format(i)} for i in range(sizes['meals'])))
+    insert(Portion, ({'pk': i + 1, 'id': portion_id(i), 'name': "Portion {}".format(i), 'calories': 50 + i % 400,
+                      'density': None, 'alcohol': 0, 'carbohydrate': i % 60, 'protein': i % 30, 'fat': i % 20}
+                     for i in range(sizes['portions'])))
+    per_meal = sizes['portions_per_meal']
+    insert(MealPortion, ({'meal_pk': m + 1, 'portion_pk': (m * per_meal + k) % sizes['portions'] + 1,
+                          'weight_per_serving': 10 + k * 5}
+                         for m in range(sizes['meals']) for k in range(per_meal)))
+    records = (record_of(i, sizes) for i in range(sizes['records']))
+    insert(MealRecord, ({'person_pk': p + 1, 'meal_pk': m + 1, 'amount': 1 + (p + m) % 3, 'timestamp': t}
+                        for p, m, t in records))
+    refresh_meal_nutrients(connection)
+    rebuild_daily_intake(connection)
+
+
+def chunked_rows(rows):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == CHUNK:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def table_sizes():
+    return {model.__tablename__: db.session.execute(select(func.count()).select_from(model)).scalar()
+            for model in (Person, Meal, Portion, MealPortion, MealRecord)}
+
+
+def mealrecord_url(person, meal, timestamp):
+    return "/api/meals/{}/mealrecords/{}/".format(meal, make_mealrecord_handle(person, meal, timestamp))
+
+
+def mealportion_url(meal, portion):
+    return "/api/meals/{}/mealportions/{}/".format(meal, make_mealportion_handle(meal, portion))
+
+
+def read_cases(sizes):
+    """ [(name, method, url(i), body(i), status)] of the GETs, i is the number of the request """
+    persons, meals, portions = sizes['persons'], sizes['meals'], sizes['portions']
+
+    def record(i):
+        # spread over the records, not only the first ones
+        return record_of(i * 7919 % sizes['records'], sizes)
+
+    def record_url(i):
+        p, m, t = record(i)
+        return mealrecord_url(person_id(p), meal_id(m), t)
+
+    def day(i):
+        t = record(i)[2]
+        return "from={}&to={}".format(t.date(), t.date() + datetime.timedelta(days=1))
+
+    return [
+        ("entrypoint", "GET", lambda i: "/api/", None, 200),
+        ("persons", "GET", lambda i: "/api/persons/", None, 200),
+        ("person", "GET", lambda i: "/api/persons/{}/".format(person_id(i % persons)), None, 200),
+        ("meals", "GET", lambda i: "/api/meals/", None, 200),
+        ("meal", "GET", lambda i: "/api/meals/{}/".format(meal_id(i % meals)), None, 200),
+        ("meal expanded", "GET", lambda i: "/api/meals/{}/?expand=portions".format(meal_id(i % meals)), None, 200),
+        ("portions", "GET", lambda i: "/api/portions/", None, 200),
+        ("portion", "GET", lambda i: "/api/portions/{}/".format(portion_id(i % portions)), None, 200),
+        ("portion search", "GET", lambda i: "/api/portions/?q=portion+{}".format(i % 100), None, 200),
+        ("meals using portion", "GET", lambda i: "/api/portions/{}/meals/".format(portion_id(i % portions)),
+         None, 200),
+        ("mealportions", "GET", lambda i: "/api/meals/{}/mealportions/".format(meal_id(i % meals)), None, 200),
+        ("mealportion", "GET", lambda i: mealportion_url(
+            meal_id(i % meals), portion_id(i % meals * sizes['portions_per_meal'] % portions)), None, 200),
+        ("mealrecords", "GET", lambda i: "/api/mealrecords/", None, 200),
+        ("mealrecords page", "GET", lambda i: "/api/mealrecords/?limit=50&after=" + quote(
+            "{}/{}".format(meal_id(record(i)[1]), make_mealrecord_handle(
+                person_id(record(i)[0]), meal_id(record(i)[1]), record(i)[2])), safe=''), None, 200),
+        ("mealrecord", "GET", record_url, None, 200),
+        ("person mealrecords", "GET", lambda i: "/api/persons/{}/mealrecords/".format(person_id(i % persons)),
+         None, 200),
+        ("person mealrecords day", "GET", lambda i: "/api/persons/{}/mealrecords/?{}".format(
+            person_id(record(i)[0]), day(i)), None, 200),
+        ("person export", "GET", lambda i: "/api/persons/{}/mealrecords/export/".format(person_id(i % persons)),
+         None, 200),
+        ("person nutrition", "GET", lambda i: "/api/persons/{}/nutrition/".format(person_id(i % persons)),
+         None, 200),
+        ("cache stats", "GET", lambda i: "/api/cache/", None, 200),
+    ]
+
+
+def write_cases(sizes):
+    """ [(name, method, url(i), body(i), status)] of the writes, in the order they need each
+    other's rows: request i of every case works on the rows named bench-<i> """
+    def bench(i):
+        return "bench-{}".format(i)
+
+    def record(i, timestamp=START):
+        return {'person_id': bench(i), 'meal_id': bench(i), 'amount': 2, 'timestamp': str(timestamp)}
+
+    def batch(i):
+        return [{'person_id': bench(i), 'meal_id': meal_id(i % sizes['meals']), 'amount': 1,
+                 'timestamp': str(START + datetime.timedelta(hours=k))} for k in range(10)]
+
+    return [
+        ("person POST", "POST", lambda i: "/api/persons/", lambda i: {'id': bench(i)}, 201),
+        ("meal POST", "POST", lambda i: "/api/meals/",
+         lambda i: {'id': bench(i), 'name': "Bench", 'servings': 2}, 201),
+        ("meal PUT", "PUT", lambda i: "/api/meals/{}/".format(bench(i)),
+         lambda i: {'id': bench(i), 'name': "Bench", 'servings': 3}, 204),
+        ("portion POST", "POST", lambda i: "/api/portions/",
+         lambda i: {'id': bench(i), 'name': "Bench", 'calories': 100}, 201),
+        ("portion PUT", "PUT", lambda i: "/api/portions/{}/".format(bench(i)),
+         lambda i: {'id': bench(i), 'name': "Bench", 'calories': 120, 'protein': 10}, 204),
+        ("mealportion POST", "POST", lambda i: "/api/meals/{}/mealportions/".format(bench(i)),
+         lambda i: {'meal_id': bench(i), 'portion_id': bench(i), 'weight_per_serving': 10}, 201),
+        ("mealportion PUT", "PUT", lambda i: mealportion_url(bench(i), bench(i)),
+         lambda i: {'meal_id': bench(i), 'portion_id': bench(i), 'weight_per_serving': 20}, 204),
+        ("mealrecord POST", "POST", lambda i: "/api/mealrecords/", record, 201),
+        ("mealrecord PUT", "PUT", lambda i: mealrecord_url(bench(i), bench(i), START),
+         lambda i: dict(record(i), amount=3), 204),
+        ("mealrecord DELETE", "DELETE", lambda i: mealrecord_url(bench(i), bench(i), START), None, 204),
+        ("mealrecord batch POST", "POST", lambda i: "/api/mealrecords/batch/", batch, 200),
+        ("mealportion DELETE", "DELETE", lambda i: mealportion_url(bench(i), bench(i)), None, 204),
+        ("meal DELETE", "DELETE", lambda i: "/api/meals/{}/".format(bench(i)), None, 204),
+        ("portion DELETE", "DELETE", lambda i: "/api/portions/{}/".format(bench(i)), None, 204),
+        ("person DELETE", "DELETE", lambda i: "/api/persons/{}/".format(bench(i)), None, 204),
+    ]
+
+
+def request(client, method, url, body):
+    kwargs = {}
+    if body is not None:
+        kwargs = {'data': json.dumps(body), 'content_type': APPLICATION_JSON}
+    started = time.perf_counter()
+    r = client.open(url, method=method, **kwargs)
+    size = len(r.get_data())
+    r.close()
+    return time.perf_counter() - started, r.status_code, size
+
+
+def run_case(client, case, requests, max_seconds, warm_up):
+    name, method, url, body, status = case
+    if warm_up:
+        request(client, method, url(0), body and body(0))
+    latencies = []
+    errors = []
+    size = 0
+    deadline = time.perf_counter() + max_seconds if max_seconds else None
+    for i in range(requests):
+        seconds, got, size = request(client, method, url(i), body and body(i))
+        latencies.append(seconds)
+        if got != status:
+            errors.append("{} {}: {}".format(method, url(i), got))
+        if deadline is not None and time.perf_counter() > deadline:
+            break
+    return summary(method, latencies, errors, size)
+
+
+def summary(method, latencies, errors, size):
+    # percentiles in ms, quantiles() needs two values
+    percentiles = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else latencies * 99
+    return {
+        'method': method,
+        'requests': len(latencies),
+        'errors': len(errors),
+        'first_error': errors[0] if errors else None,
+        'p50_ms': round(percentiles[49] * 1000, 3),
+        'p90_ms': round(percentiles[89] * 1000, 3),
+        'p99_ms': round(percentiles[98] * 1000, 3),
+        'mean_ms': round(statistics.fmean(latencies) * 1000, 3),
+        'max_ms': round(max(latencies) * 1000, 3),
+        'requests_per_s': round(len(latencies) / sum(latencies), 1),
+        'response_bytes': size,
+    }
+
+
+def micro_cases():
+    """ {name: function} of the tapi.utils helpers, on objects like the ORM rows """
+    timestamp = START + datetime.timedelta(days=100, microseconds=123)
+    person = SimpleNamespace(id="person-42")
+    meal = SimpleNamespace(id="salmon-soup", name="Salmon soup", description="Creamy salmon soup", servings=4)
+    portion = SimpleNamespace(id="salmon", name="Salmon", calories=208, density=None, alcohol=0,
+                              carbohydrate=0, protein=20, fat=13)
+    record = SimpleNamespace(person_id="person-42", meal_id="salmon-soup", amount=1.5, timestamp=timestamp)
+    mealportion = SimpleNamespace(meal_id="salmon-soup", portion_id="salmon", weight_per_serving=125)
+
+    def collection_item():
+        # a mealrecord of a collection, as MealRecordItem.get builds it
+        m = mealrecord_to_api_mealrecord(record)
+        m.add_control_collection("/api/mealrecords/")
+        m.add_control_delete("/api/meals/salmon-soup/mealrecords/person-42-salmon-soup/")
+        return m
+
+    def item():
+        # a meal item with its controls
+        m = meal_to_api_meal(meal)
+        m.add_control_self("/api/meals/salmon-soup/")
+        m.add_control_profile()
+        m.add_control_collection("/api/meals/")
+        m.add_control_delete("/api/meals/salmon-soup/")
+        m.add_namespace("cameta", "/api/link-relations/")
+        return m
+
+    return {
+        'make_mealrecord_handle': lambda: make_mealrecord_handle("person-42", "salmon-soup", timestamp),
+        'make_mealportion_handle': lambda: make_mealportion_handle("salmon-soup", "salmon"),
+        'person_to_api_person': lambda: person_to_api_person(person),
+        'meal_to_api_meal': lambda: meal_to_api_meal(meal),
+        'portion_to_api_portion': lambda: portion_to_api_portion(portion),
+        'mealrecord_to_api_mealrecord': lambda: mealrecord_to_api_mealrecord(record),
+        'mealportion_to_api_mealportion': lambda: mealportion_to_api_mealportion(mealportion),
+        'CalorieBuilder()': lambda: CalorieBuilder(),
+        'CalorieBuilder collection item': collection_item,
+        'CalorieBuilder item with controls': item,
+    }
+
+
+def run_micro(repeat):
+    results = {}
+    for name, fn in micro_cases().items():
+        timer = timeit.Timer(fn)
+        number, _ = timer.autorange()
+        best = min(timer.repeat(repeat, number)) / number
+        results[name] = {'ns_per_call': round(best * 1e9, 1), 'calls_per_s': round(1 / best)}
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_endpoints(results, baseline):
+    print("{:<26}{:>7}{:>10}{:>10}{:>10}{:>10}{:>8}{}".format(
+        "endpoint", "method", "p50 ms", "p90 ms", "p99 ms", "req/s", "errors", "  p50 vs baseline" if baseline else ""))
+    for name, r in results.items():
+        line = "{:<26}{:>7}{:>10.2f}{:>10.2f}{:>10.2f}{:>10.0f}{:>8}".format(
+            name, r['method'], r['p50_ms'], r['p90_ms'], r['p99_ms'], r['requests_per_s'], r['errors'])
+        old = baseline.get(name)
+        if old:
+            line += "{:>12.2f}x".format(r['p50_ms'] / old['p50_ms'])
+        print(line)
+
+
+def print_micro(results, baseline):
+    for name, r in results.items():
+        line = "{:<36}{:>10.0f} ns".format(name, r['ns_per_call'])
+        old = baseline.get(name)
+        if old:
+            line += "{:>10.2f}x".format(r['ns_per_call'] / old['ns_per_call'])
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size", choices=sorted(SIZES, key=SIZES.get), default='1k',
+                        help="number of meal records")
+    parser.add_argument("--records", type=int, help="number of meal records, instead of --size")
+    parser.add_argument("--persons", type=int, default=100)
+    parser.add_argument("--meals", type=int, default=200)
+    parser.add_argument("--portions", type=int, default=10000)
+    parser.add_argument("--portions-per-meal", type=int, default=5)
+    parser.add_argument("--requests", type=int, default=100, help="requests per endpoint")
+    parser.add_argument("--max-seconds", type=float, default=10, help="at most this long per GET endpoint")
+    parser.add_argument("--cache-size", type=int, default=0, help="RESPONSE_CACHE_SIZE, 0 for no response cache")
+    parser.add_argument("--micro-repeat", type=int, default=5)
+    parser.add_argument("--db", help="database file, seeded if it does not exist and kept, for the same data "
+                                     "in several runs")
+    parser.add_argument("--output", default="endpoint_bench.json", help="JSON file of the results")
+    parser.add_argument("--compare", help="JSON file of an earlier run, the ratios to it are printed")
+    args = parser.parse_args()
+
+    sizes = {'records': args.records if args.records is not None else SIZES[args.size], 'persons': args.persons,
+             'meals': args.meals, 'portions': args.portions, 'portions_per_meal': args.portions_per_meal}
+    baseline = {'endpoints': {}, 'micro': {}}
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    warnings.simplefilter("ignore")
+    db_fd = None
+    if args.db:
+        db_fname = args.db
+        new = not os.path.exists(db_fname)
+    else:
+        db_fd, db_fname = tempfile.mkstemp()
+        new = True
+    app = create_app({"SQLALCHEMY_DATABASE_URI": "sqlite:///" + os.path.abspath(db_fname),
+                      "RESPONSE_CACHE_SIZE": args.cache_size})
+    results = {}
+    with app.app_context():
+        seed_seconds = None
+        if new:
+            started = time.perf_counter()
+            with db.engine.begin() as connection:
+                seed(connection, sizes)
+            seed_seconds = round(time.perf_counter() - started, 1)
+            print("seeded in {} s".format(seed_seconds))
+        else:
+            # the seeded data of an earlier run, the sizes are those of the database
+            sizes.update(records=db.session.execute(select(func.count()).select_from(MealRecord)).scalar(),
+                         persons=db.session.execute(select(func.count()).select_from(Person)).scalar())
+        rows = table_sizes()
+        print(", ".join("{} {}".format(count, table) for table, count in rows.items()))
+
+        client = app.test_client()
+        for case in read_cases(sizes):
+            results[case[0]] = run_case(client, case, args.requests, args.max_seconds, warm_up=True)
+        for case in write_cases(sizes):
+            results[case[0]] = run_case(client, case, args.requests, None, warm_up=False)
+        db.session.remove()
+        db.engine.dispose()
+
+    if db_fd is not None:
+        os.close(db_fd)
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(db_fname + suffix):
+                os.unlink(db_fname + suffix)
+
+    micro = run_micro(args.micro_repeat)
+    print_endpoints(results, baseline['endpoints'])
+    print()
+    print_micro(micro, baseline['micro'])
+
+    output = {
+        'meta': {
+            'started': datetime.datetime.now().isoformat(timespec='seconds'),
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'platform': platform.platform(),
+            'sizes': sizes,
+            'rows': rows,
+            'seed_seconds': seed_seconds,
+            'requests': args.requests,
+            'cache_size': args.cache_size,
+        },
+        'endpoints': results,
+        'micro': micro,
+    }
+    with open(args.output, "w") as f:
+        json.dump(output, f, indent=2)
+    print("results in {}".format(args.output))
+    if any(r['errors'] for r in results.values()):
+        print("some requests failed, see first_error in the results", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
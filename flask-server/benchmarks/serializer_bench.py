@@ -0,0 +1,72 @@
+""" Benchmark: JSON encoders on a mealrecord collection
+
+Builds a Mason collection of mealrecords the way MealRecordItem.get does and
+compares the old json.dumps(default=myconverter) with the serializers of
+tapi.utils. The serializers must give the same bytes.
+
+Run from the flask-server directory:
+    python -m benchmarks.serializer_bench --records 100000
+"""
+import argparse
+import datetime
+import json
+import time
+from types import SimpleNamespace
+
+from tapi.utils import CalorieBuilder, SERIALIZERS, mealrecord_to_api_mealrecord, myconverter
+from tapi.constants import NS
+
+
+def build_collection(count, native_timestamps):
+    start = datetime.datetime(2021, 1, 1, 8, 0, 0, 1)
+    resp = CalorieBuilder(items=[])
+    for i in range(count):
+        record = SimpleNamespace(person_id="person-{}".format(i % 100), meal_id="salmon-soup",
+                                 amount=1.5, timestamp=start + datetime.timedelta(minutes=i))
+        m = mealrecord_to_api_mealrecord(record)
+        if native_timestamps:
+            # the representation before the serializers: datetime for the default= callback
+            m['timestamp'] = record.timestamp
+        m['nutrients'] = {'calories': 512.5, 'fat': 31.25, 'protein': 41.0,
+                          'carbohydrate': 12.5, 'alcohol': 0}
+        m.add_control_collection("/api/mealrecords/")
+        resp['items'].append(m)
+    resp.add_control_self("/api/mealrecords/")
+    resp.add_control(NS + ':mealrecords-all', "/api/mealrecords/")
+    return resp
+
+
+def best_of(fn, repeat):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - started)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--records", type=int, default=100000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    old_doc = build_collection(args.records, native_timestamps=True)
+    doc = build_collection(args.records, native_timestamps=False)
+
+    outputs = {name: dumps(doc) for name, dumps in SERIALIZERS.items()}
+    if len(set(outputs.values())) != 1:
+        raise SystemExit("serializers do not give the same bytes")
+
+    print("{} mealrecords, {:.1f} MB of JSON".format(args.records, len(outputs['stdlib']) / 1e6))
+    cases = [("json.dumps(default=myconverter)", lambda: json.dumps(old_doc, default=myconverter))]
+    cases += [(name, lambda dumps=dumps: dumps(doc)) for name, dumps in SERIALIZERS.items()]
+    baseline = None
+    for name, fn in cases:
+        seconds = best_of(fn, args.repeat)
+        baseline = baseline or seconds
+        print("{:<34}{:>9.1f} ms{:>8.1f}x".format(name, seconds * 1000, baseline / seconds))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,171 @@
+""" Benchmark: memory and throughput of tapi.serve against independent processes
+
+Starts `python -m tapi.serve --workers N` and, for comparison, N independent
+processes that each build the app and serve it on their own port. All of them
+serve some requests first, then the proportional (PSS) and private (USS)
+memory of every process is read from /proc/<pid>/smaps_rollup (Linux). The
+requests/s are those of --clients HTTP client threads against tapi.serve with
+1 and with N workers.
+
+Run from the flask-server directory:
+    python -m benchmarks.serve_bench --workers 4 --threads 4 --seconds 5
+"""
+import argparse
+import http.client
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+INDEPENDENT = """
+import gc, os, sys
+from tapi.serve import WorkerServer, build_app, listen
+server = WorkerServer(build_app(), listen("127.0.0.1", int(sys.argv[1])), int(sys.argv[2]))
+server.serve(os.getppid())
+"""
+
+URLS = ['/api/', '/api/persons/', '/api/meals/', '/api/portions/', '/api/persons/123/mealrecords/?limit=50']
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_for(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            get(port, '/api/')
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError("no server on port {}".format(port))
+
+
+def get(port, url):
+    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+    try:
+        connection.request("GET", url)
+        response = connection.getresponse()
+        response.read()
+        return response.status
+    finally:
+        connection.close()
+
+
+def memory(pid):
+    # (PSS, USS) in KiB
+    fields = {}
+    with open("/proc/{}/smaps_rollup".format(pid)) as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) >= 2 and parts[1].isdigit():
+                fields[parts[0].rstrip(':')] = int(parts[1])
+    return fields['Pss'], fields['Private_Clean'] + fields['Private_Dirty']
+
+
+def children(pid):
+    with open("/proc/{}/task/{}/children".format(pid, pid)) as f:
+        return [int(p) for p in f.read().split()]
+
+
+def throughput(port, clients, seconds):
+    stop = threading.Event()
+    counts = [0] * clients
+
+    def client(number):
+        i = 0
+        while not stop.is_set():
+            if get(port, URLS[i % len(URLS)]) == 200:
+                counts[number] += 1
+            i += 1
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(clients)]
+    started = time.perf_counter()
+    for t in threads:
+        t.start()
+    time.sleep(seconds)
+    stop.set()
+    for t in threads:
+        t.join()
+    return sum(counts) / (time.perf_counter() - started)
+
+
+def start_serve(env, workers, threads):
+    port = free_port()
+    process = subprocess.Popen([sys.executable, "-m", "tapi.serve", "--port", str(port), "--workers", str(workers),
+                                "--threads", str(threads)], env=env, stderr=subprocess.DEVNULL)
+    wait_for(port)
+    return process, port
+
+
+def stop(process):
+    process.send_signal(signal.SIGTERM)
+    process.wait(30)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--clients", type=int, default=16)
+    parser.add_argument("--seconds", type=float, default=5)
+    args = parser.parse_args()
+
+    db_fd, db_fname = tempfile.mkstemp()
+    env = dict(os.environ, TAPI_SQLALCHEMY_DATABASE_URI="sqlite:///" + db_fname, PYTHONWARNINGS="ignore")
+    subprocess.run([sys.executable, "-m", "flask", "--app", "tapi", "seed-example-data"], env=env, check=True,
+                   capture_output=True)
+
+    # tapi.serve: the parent and its workers
+    process, port = start_serve(env, args.workers, args.threads)
+    for _ in range(args.workers * 50):
+        for url in URLS:
+            get(port, url)
+    workers = [memory(pid) for pid in children(process.pid)]
+    parent = memory(process.pid)
+    stop(process)
+
+    # independent processes
+    independent = []
+    for _ in range(args.workers):
+        ind_port = free_port()
+        independent.append((subprocess.Popen([sys.executable, "-c", INDEPENDENT, str(ind_port), str(args.threads)],
+                                             env=env, stderr=subprocess.DEVNULL), ind_port))
+    for p, ind_port in independent:
+        wait_for(ind_port)
+        for _ in range(50):
+            for url in URLS:
+                get(ind_port, url)
+    separate = [memory(p.pid) for p, _ in independent]
+    for p, _ in independent:
+        stop(p)
+
+    print("memory of {} workers, KiB".format(args.workers))
+    print("{:<24}{:>12}{:>14}".format("", "PSS total", "USS / worker"))
+    print("{:<24}{:>12}{:>14}".format("tapi.serve", parent[0] + sum(w[0] for w in workers),
+                                      sum(w[1] for w in workers) // len(workers)))
+    print("{:<24}{:>12}{:>14}".format("independent processes", sum(s[0] for s in separate),
+                                      sum(s[1] for s in separate) // len(separate)))
+
+    print("{} clients, {} threads per worker, {} s".format(args.clients, args.threads, args.seconds))
+    for workers in sorted({1, args.workers}):
+        process, port = start_serve(env, workers, args.threads)
+        rate = throughput(port, args.clients, args.seconds)
+        stop(process)
+        print("{:<24}{:>12.0f} requests/s".format("{} workers".format(workers), rate))
+
+    os.close(db_fd)
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(db_fname + suffix):
+            os.unlink(db_fname + suffix)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+""" Benchmark: cold start of a worker on an existing database
+
+Starts fresh interpreters that import tapi and call create_app() on a database
+that is already at the current schema, and times the phases. "import" includes
+the resources that create_app() would import itself. "old boot" adds
+what create_app() used to do at every start: create_all() and the example
+data check.
+
+Run from the flask-server directory:
+    python -m benchmarks.startup_bench --runs 10
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+WORKER = """
+import json, sys, time, warnings
+warnings.simplefilter("ignore")
+started = time.perf_counter()
+from tapi import create_app, db
+import tapi.api
+imported = time.perf_counter()
+app = create_app({"SQLALCHEMY_DATABASE_URI": sys.argv[1]})
+created = time.perf_counter()
+with app.app_context():
+    from tapi.example_data import db_load_example_data
+    db.create_all()
+    db_load_example_data(db)
+old_boot = time.perf_counter()
+print(json.dumps({"import": imported - started, "create_app": created - imported,
+                  "old boot extra": old_boot - created}))
+"""
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=10)
+    args = parser.parse_args()
+
+    db_fd, db_fname = tempfile.mkstemp()
+    uri = "sqlite:///" + db_fname
+    here = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    # the first start creates the schema and loads the example data
+    subprocess.run([sys.executable, "-c", WORKER, uri], cwd=here, check=True, capture_output=True)
+
+    timings = []
+    for _ in range(args.runs):
+        out = subprocess.run([sys.executable, "-c", WORKER, uri], cwd=here, check=True,
+                             capture_output=True, text=True).stdout
+        timings.append(json.loads(out.splitlines()[-1]))
+    os.close(db_fd)
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(db_fname + suffix):
+            os.unlink(db_fname + suffix)
+
+    print("median of {} cold starts".format(args.runs))
+    for phase in timings[0]:
+        print("{:<16}{:>9.1f} ms".format(phase, statistics.median(t[phase] for t in timings) * 1000))
+
+
+if __name__ == '__main__':
+    main()
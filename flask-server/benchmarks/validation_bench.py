@@ -0,0 +1,48 @@
+""" Micro-benchmark: per-request cost of validating a POST/PUT body
+
+Compares the old way (build the schema dict, jsonschema.validate) with the
+precompiled validators of tapi.validation.
+
+Run from the flask-server directory:
+    python -m benchmarks.validation_bench
+"""
+import argparse
+import timeit
+
+from jsonschema import validate
+
+import tapi.api  # noqa: F401, registers the resources
+from tapi.resources.meal import meal_schema, MEAL_VALIDATOR
+from tapi.resources.mealrecord import mealrecord_schema, MEALRECORD_VALIDATOR
+from tapi.resources.portion import portion_schema, PORTION_VALIDATOR
+
+CASES = [
+    ("meal", meal_schema, MEAL_VALIDATOR,
+     {'id': 'salmon-soup', 'name': 'Salmon Soup', 'servings': 4, 'description': 'Finnish soup'}),
+    ("portion", portion_schema, PORTION_VALIDATOR,
+     {'id': 'olive-oil', 'name': 'Olive oil', 'calories': 700, 'density': 0.89, 'fat': 100}),
+    ("mealrecord", mealrecord_schema, MEALRECORD_VALIDATOR,
+     {'person_id': '123', 'meal_id': 'salmon-soup', 'amount': 1.5,
+      'timestamp': '2021-04-21 12:00:00.000000'}),
+]
+
+
+def per_call_us(fn, number):
+    # best of 5 runs, microseconds per call
+    return min(timeit.repeat(fn, number=number, repeat=5)) / number * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--number", type=int, default=2000, help="calls per timing run")
+    args = parser.parse_args()
+
+    print("{:<12}{:>14}{:>14}{:>10}".format("schema", "before (us)", "after (us)", "speedup"))
+    for name, schema_fn, validator, doc in CASES:
+        before = per_call_us(lambda: validate(doc, schema=schema_fn()), args.number)
+        after = per_call_us(lambda: validator.validate(doc), args.number)
+        print("{:<12}{:>14.1f}{:>14.1f}{:>9.1f}x".format(name, before, after, before / after))
+
+
+if __name__ == '__main__':
+    main()
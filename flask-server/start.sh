@@ -1,2 +1,8 @@
 export FLASK_APP=tapi
-python3 -m flask run --host=0.0.0.0
+# demo data for the client only with SEED_EXAMPLE_DATA=1, never into a production database
+if [ -n "${SEED_EXAMPLE_DATA}" ] && [ "${SEED_EXAMPLE_DATA}" != "0" ]; then
+    python3 -m flask seed-example-data
+fi
+# exec, so the server gets the stop signal of the container
+exec python3 -m tapi.serve --host 0.0.0.0 --port 5000 --workers "${WEB_CONCURRENCY:-2}" --threads "${THREADS:-4}" \
+    --max-requests "${MAX_REQUESTS:-10000}" --max-requests-jitter 1000
@@ -3,6 +3,8 @@ import os
 from flask import Flask, request
 from flask_sqlalchemy import SQLAlchemy
 # END of the content taken from the exercise example
+import click
+
 db = SQLAlchemy()
 
 
@@ -13,6 +15,8 @@ def create_app(test_config=None):
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
     if test_config is None:
         app.config.from_pyfile("config.py", silent=True)
+        # e.g. TAPI_SQLALCHEMY_DATABASE_URI, TAPI_DB_POOL_SIZE, TAPI_SQLITE_PRAGMAS='{"synchronous": "FULL"}'
+        app.config.from_prefixed_env("TAPI")
     else:
         app.config.from_mapping(test_config)
 
@@ -21,17 +25,71 @@ def create_app(test_config=None):
     except OSError:
         pass
 
+    from tapi.database import engine_options, configure_engine
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(app.config)
     db.init_app(app)
+    with app.app_context():
+        configure_engine(db.engine, app.config)
+
+    from tapi.cache import init_cache
+    init_cache(app)
+
+    # SERVER_TIMING / TIMING_LOG
+    from tapi.timing import init_timing
+    init_timing(app)
+
+    # QUERY_BUDGET_ACTION / QUERY_BUDGETS
+    from tapi.querybudget import init_query_budget
+    init_query_budget(app)
 
     from tapi import api
     app.register_blueprint(api.api_blueprint)
 
-    # Create all the tables if don't exist
+    # Create or upgrade the tables if the schema is not current, one query if it is
     with app.app_context():
-        db.create_all()
+        from tapi.schema import ensure_schema
+        ensure_schema(db.engine)
+
+    @app.cli.command("seed-example-data")
+    def seed_example_data_command():
+        """ Adds the example person, meals, portions and mealrecords if not there yet """
         from tapi.example_data import db_load_example_data
         db_load_example_data(db)
+        click.echo("Example data loaded")
+
+    @app.cli.command("rebuild-daily-intake")
+    def rebuild_daily_intake_command():
+        """ Recomputes the daily nutrient totals of all persons from their MealRecords """
+        from tapi.nutrition import refresh_meal_nutrients, rebuild_daily_intake
+        with db.engine.begin() as connection:
+            refresh_meal_nutrients(connection)
+            rebuild_daily_intake(connection)
+        click.echo("Daily intake rebuilt")
+
+    @app.cli.command("build-portion-catalog")
+    @click.argument("csv_file", type=click.File("r", encoding="utf-8-sig"))
+    @click.argument("catalog")
+    def build_portion_catalog_command(csv_file, catalog):
+        """ Builds a Portion catalog file from a CSV with the Portion fields as its header """
+        from tapi.catalog import CatalogError, build_catalog
+        from tapi.resources.portion import portion_schema
+        try:
+            count = build_catalog(csv_file, catalog, portion_schema())
+        except CatalogError as e:
+            raise click.ClickException(str(e))
+        click.echo("{} Portions written to {}".format(count, catalog))
 
+    @app.cli.command("swap-portion-catalog")
+    @click.argument("catalog")
+    @click.option("--prune", is_flag=True, help="Delete the Portions not in the catalog and used by no Meal")
+    def swap_portion_catalog_command(catalog, prune):
+        """ Replaces the Portions of the database with those of a catalog file, in one transaction """
+        from tapi.catalog import CatalogError, swap_catalog
+        try:
+            upserted, deleted = swap_catalog(db.engine, catalog, prune)
+        except CatalogError as e:
+            raise click.ClickException(str(e))
+        click.echo("{} Portions added or changed, {} deleted".format(upserted, deleted))
 
 
 # @app.after_request taken from Blog post: https://modernweb.com/unlimited-access-with-cors/
@@ -3,7 +3,6 @@
 # https://flask-restful.readthedocs.io/en/latest/intermediate-usage.html#use-with-blueprints
 
 # This is used in the __init__ when creating the Flask instance
-import json
 from flask import Blueprint, Response, redirect
 from flask_restful import Api
 from tapi.constants import *
@@ -16,7 +15,11 @@ from tapi.resources.meal import MealItem
 from tapi.resources.mealrecord import MealRecordItem
 from tapi.resources.mealportion import MealPortionItem
 from tapi.resources.portion import PortionItem
-from tapi.utils import CalorieBuilder, add_mason_response_header, add_calorie_namespace
+from tapi.resources.nutrition import NutritionItem
+from tapi.utils import CalorieBuilder, add_mason_response_header, add_calorie_namespace, dumps
+from tapi.urls import resource_url
+from tapi.cache import cached_get, get_cache
+from tapi.querybudget import query_budget
 
 
 api.add_resource(PersonItem, ROUTE_PERSON, ROUTE_PERSON_COLLECTION)
@@ -24,33 +27,77 @@ api.add_resource(MealItem, ROUTE_MEAL, ROUTE_MEAL_COLLECTION)
 api.add_resource(MealRecordItem, ROUTE_MEALRECORD, ROUTE_MEALRECORD_COLLECTION)
 api.add_resource(MealPortionItem, ROUTE_MEALPORTION)
 api.add_resource(PortionItem, ROUTE_PORTION, ROUTE_PORTION_COLLECTION)
+api.add_resource(NutritionItem, ROUTE_PERSON_NUTRITION)
 
 
 # Route for entry point
 @api_blueprint.route('/')
+@query_budget(0)
+@cached_get()
 def entrypoint():
     resp = CalorieBuilder()
-    resp.add_control(NS + ':persons-all', api.url_for(PersonItem, handle=None))
-    resp.add_control(NS + ':meals-all', api.url_for(MealItem, handle=None))
-    resp.add_control(NS + ':portions-all', api.url_for(PortionItem, handle=None))
+    resp.add_control(NS + ':persons-all', resource_url(PersonItem, handle=None))
+    resp.add_control(NS + ':meals-all', resource_url(MealItem, handle=None))
+    resp.add_control(NS + ':portions-all', resource_url(PortionItem, handle=None))
     add_calorie_namespace(resp)
-    return Response(json.dumps(resp), 200, headers=add_mason_response_header())
+    return Response(dumps(resp), 200, headers=add_mason_response_header())
+
+
+# Route for the response cache counters
+@api_blueprint.route(ROUTE_CACHE_STATS)
+@query_budget(0)
+def cache_stats():
+    resp = CalorieBuilder(get_cache().stats())
+    resp.add_control_self(ROUTE_ENTRYPOINT + ROUTE_CACHE_STATS)
+    add_calorie_namespace(resp)
+    return Response(dumps(resp), 200, headers=add_mason_response_header())
 
 
 # Route for MealRecords for person
 @api_blueprint.route('/persons/<handle>/mealrecords/')
+@query_budget(4)
 def meals_for_person(handle):
     return MealRecordItem.get_records_for_person(handle)
 
 
+# Route for the MealRecord export of a person
+@api_blueprint.route(ROUTE_PERSON_MEALRECORD_EXPORT)
+@query_budget(3)
+def mealrecords_export_for_person(handle):
+    return MealRecordItem.get_export(handle)
+
+
+# Route for MealRecord batch POST
+@api_blueprint.route(ROUTE_MEALRECORD_BATCH, methods=['POST'])
+@query_budget(6)
+def mealrecords_batch():
+    return MealRecordItem.post_batch()
+
+
 # Route for MealPortion POST
-@api_blueprint.route('/meals/<handle>/mealportions/', methods=['POST'])
+@api_blueprint.route(ROUTE_MEALPORTION_COLLECTION, methods=['POST'])
+@query_budget(7)
 def mealportions_for_meal(handle):
     return MealPortionItem.post(handle)
 
 
+# Route for Meals using a portion
+@api_blueprint.route(ROUTE_PORTION_MEALS)
+@query_budget(3)
+def meals_using_portion(handle):
+    return MealPortionItem.get_meals_for_portion(handle)
+
+
+# Route for MealPortions of a meal
+@api_blueprint.route(ROUTE_MEALPORTION_COLLECTION, methods=['GET'])
+@query_budget(3)
+def mealportions_of_meal(handle):
+    return MealPortionItem.get_collection(handle)
+
+
 APIARY_URL = "https://pwp2021calorie.docs.apiary.io/#reference/"
 
 @api_blueprint.route('/link-relations/')
+@query_budget(0)
 def redirect_to_apiary_link_rels():
     return redirect(APIARY_URL + "link-relations")
\ No newline at end of file
@@ -0,0 +1,181 @@
+""" ASGI entry point
+
+`flask run` (and any threaded WSGI server) gives every open connection a thread
+of its own. A slow SQLite read holds that thread, and every thread can hold a
+pooled connection. AsgiApp serves the same Flask app from an asyncio event loop
+instead. The connections wait on the loop, and only the requests being
+processed use one of a fixed number of worker threads, so the connection pool
+is not outgrown. The sqlite3 driver has no async API, so the views, and their
+queries, run in the worker threads. The resources, the Mason builders, the
+conditional GETs and the response cache are the ones of the WSGI app.
+
+A GET whose response is in the response cache runs no SQL, so it is answered on
+the loop without a thread hop. The entry is looked up once and handed to the
+view. A commit that drops it meanwhile does not make the view query on the loop.
+
+A streamed response (?stream=true, the exports) is read from the view a chunk at
+a time in the worker threads, and the loop sends each chunk.
+
+Run with any ASGI server, e.g.:
+    uvicorn --factory tapi.asgi:create_asgi_app
+"""
+import asyncio
+import contextvars
+import io
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+from tapi import create_app, db
+from tapi.cache import CACHED_RESPONSE_KEY
+
+
+def wsgi_environ(scope, body):
+    """ The WSGI environ of an ASGI http scope and its request body """
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    root_path = scope.get('root_path', '')
+    path = scope['path']
+    if root_path and path.startswith(root_path):
+        path = path[len(root_path):]
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        # WSGI strings are the bytes of the request as latin-1
+        'SCRIPT_NAME': root_path.encode('utf-8').decode('latin-1'),
+        'PATH_INFO': path.encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': 'HTTP/' + scope.get('http_version', '1.1'),
+        'REMOTE_ADDR': client[0],
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = 'HTTP_' + name
+        value = value.decode('latin-1')
+        environ[name] = environ[name] + ',' + value if name in environ else value
+    # the body is read whole, also when the client sent it chunked
+    environ['CONTENT_LENGTH'] = str(len(body))
+    return environ
+
+
+def _no_write(data):
+    raise RuntimeError("the write() callable of WSGI is not supported")
+
+
+class AsgiApp:
+    """ ASGI application serving a Flask app with its views in a thread pool """
+
+    def __init__(self, flask_app, threads=None):
+        self.flask_app = flask_app
+        self.executor = ThreadPoolExecutor(threads, thread_name_prefix='tapi-asgi')
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'http':
+            await self.http(scope, receive, send)
+        elif scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.close()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def close(self):
+        """ Waits for the worker threads and closes the connections of the engine """
+        self.executor.shutdown(wait=True)
+        with self.flask_app.app_context():
+            db.engine.dispose()
+
+    async def http(self, scope, receive, send):
+        body = []
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+            body.append(message.get('body', b''))
+            if not message.get('more_body'):
+                break
+        environ = wsgi_environ(scope, b''.join(body))
+
+        # the Flask contexts of the request live in this copy, whichever thread runs a step
+        context = contextvars.copy_context()
+        loop = asyncio.get_running_loop()
+
+        def in_thread(fn, *args):
+            return loop.run_in_executor(self.executor, context.run, fn, *args)
+
+        hit = self.cached(environ)
+        if hit is not None:
+            # the view answers from this entry, even if it is dropped meanwhile
+            environ[CACHED_RESPONSE_KEY] = hit
+            status, headers, content, result = context.run(self.call, environ)
+        else:
+            status, headers, content, result = await in_thread(self.call, environ)
+
+        await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+        if result is None:
+            await send({'type': 'http.response.body', 'body': content})
+            return
+        try:
+            iterator = iter(result)
+            while True:
+                chunk = await in_thread(next, iterator, None)
+                if chunk is None:
+                    break
+                if chunk:
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            if hasattr(result, 'close'):
+                await in_thread(result.close)
+
+    def cached(self, environ):
+        # the response cache entry of a GET, keyed as cached_get keys it, None if there is
+        # none. A miss is not counted, cached_get looks it up again in the worker thread
+        if environ['REQUEST_METHOD'] != 'GET':
+            return None
+        cache = self.flask_app.extensions.get('tapi_response_cache')
+        if cache is None or cache.max_entries <= 0:
+            return None
+        request = self.flask_app.request_class(environ)
+        return cache.get(request.script_root + request.full_path, count_miss=False)
+
+    def call(self, environ):
+        """ Calls the Flask app. Returns the status, the ASGI headers and either the whole
+        body or, for a streamed response (no Content-Length), the WSGI iterable to read """
+        started = []
+
+        def start_response(status, headers, exc_info=None):
+            started[:] = [status, headers]
+            return _no_write
+
+        result = self.flask_app(environ, start_response)
+        status, headers = started
+        headers = [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]
+        if any(name == b'content-length' for name, _ in headers):
+            try:
+                return int(status[:3]), headers, b''.join(result), None
+            finally:
+                if hasattr(result, 'close'):
+                    result.close()
+        return int(status[:3]), headers, None, result
+
+
+def create_asgi_app(test_config=None):
+    """ create_app() wrapped into an AsgiApp with ASGI_THREADS worker threads (default:
+    that of ThreadPoolExecutor) """
+    app = create_app(test_config)
+    return AsgiApp(app, app.config.get('ASGI_THREADS'))
@@ -0,0 +1,179 @@
+""" In-process cache of serialized GET responses
+
+The catalog GETs are read far more often than they are written. cached_get keeps
+their response bodies in an LRU cache of the app, keyed by the path and the query
+string, so a cache hit runs no SQL and no JSON encoding. Every entry records the
+tables its resource reads. When a session commits changes to a table, the entries
+reading that table are dropped, so writes through the API and through the ORM both
+invalidate.
+
+The cache is local to the process, it does not see the commits of the other
+processes of a multi-process server, whose entries would stay stale for up to the
+TTL. It is off by default with more than one process (SERVER_PROCESSES, or
+WEB_CONCURRENCY as start.sh, uvicorn and gunicorn read it). Checking the table
+versions on every hit would keep it right across processes, but a hit would no
+longer run without SQL. RESPONSE_CACHE_SIZE turns it on for a server whose
+processes may serve responses up to RESPONSE_CACHE_TTL seconds old.
+"""
+import functools
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from flask import Response, current_app, has_app_context, request
+from sqlalchemy import event, inspect
+
+from tapi import db
+
+DEFAULT_CACHE_SIZE = 1024
+DEFAULT_CACHE_TTL = 60
+# WSGI environ key of an entry looked up before the request, see AsgiApp.cached()
+CACHED_RESPONSE_KEY = 'tapi.cached_response'
+
+
+class ResponseCache:
+    """ LRU cache of (status, headers, body) with a TTL and hit/miss/eviction counters """
+
+    def __init__(self, max_entries=DEFAULT_CACHE_SIZE, ttl=DEFAULT_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        # counts the invalidations, a response computed across one is not stored
+        self.generation = 0
+
+    def get(self, key, count_miss=True):
+        # count_miss=False for a lookup whose miss is looked up again, by cached_get
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._entries[key]
+                if count_miss:
+                    self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[2]
+
+    def put(self, key, tables, value, generation):
+        with self._lock:
+            if generation != self.generation:
+                return
+            self._entries[key] = (time.monotonic() + self.ttl, frozenset(tables), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, tables):
+        # drops the entries that read any of the tables
+        with self._lock:
+            stale = [key for key, (_, entry_tables, _) in self._entries.items() if entry_tables & tables]
+            for key in stale:
+                del self._entries[key]
+            self.invalidations += len(stale)
+            self.generation += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations
+            }
+
+
+def server_processes(config):
+    # the number of processes serving the database, 1 unless told otherwise
+    processes = config.get('SERVER_PROCESSES')
+    if processes is None:
+        processes = os.environ.get('WEB_CONCURRENCY') or 1
+    return int(processes)
+
+
+def init_cache(app):
+    size = app.config.get('RESPONSE_CACHE_SIZE')
+    if size is None:
+        size = DEFAULT_CACHE_SIZE if server_processes(app.config) <= 1 else 0
+    app.extensions['tapi_response_cache'] = ResponseCache(
+        size, app.config.get('RESPONSE_CACHE_TTL', DEFAULT_CACHE_TTL))
+
+
+def get_cache():
+    return current_app.extensions.get('tapi_response_cache')
+
+
+def cached_get(*tables):
+    """ Decorator for a resource GET that reads the given tables. Place it above
+    conditional_get, a hit answers the conditional requests from the cached headers """
+    def decorator(get):
+        @functools.wraps(get)
+        def wrapper(*args, **kwargs):
+            cache = get_cache()
+            if cache is None or cache.max_entries <= 0:
+                return get(*args, **kwargs)
+            key = request.script_root + request.full_path
+            generation = cache.generation
+            hit = request.environ.get(CACHED_RESPONSE_KEY) or cache.get(key)
+            if hit is not None:
+                status, headers, body = hit
+                # 304 for a matching If-None-Match or If-Modified-Since
+                resp = Response(body, status, headers=headers).make_conditional(request)
+                resp.headers['X-Cache'] = 'HIT'
+                return resp
+
+            resp = get(*args, **kwargs)
+            if resp.status_code == 200 and not resp.is_streamed:
+                cache.put(key, tables, (resp.status_code, list(resp.headers), resp.get_data()), generation)
+            resp.headers['X-Cache'] = 'MISS'
+            return resp
+        return wrapper
+    return decorator
+
+
+# Tables changed by a session, collected until its commit
+
+def _changed_tables(session):
+    return session.info.setdefault('tapi_changed_tables', set())
+
+
+@event.listens_for(db.session, "after_flush")
+def _collect_flushed_tables(session, flush_context):
+    changed = _changed_tables(session)
+    for obj in session.new | session.dirty | session.deleted:
+        changed.update(table.name for table in inspect(obj).mapper.tables)
+
+
+@event.listens_for(db.session, "do_orm_execute")
+def _collect_executed_tables(orm_execute_state):
+    # bulk INSERT/UPDATE/DELETE statements skip the flush
+    if orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete:
+        _changed_tables(orm_execute_state.session).add(orm_execute_state.statement.table.name)
+
+
+@event.listens_for(db.session, "after_commit")
+def _invalidate_committed_tables(session):
+    changed = session.info.pop('tapi_changed_tables', None)
+    if changed and has_app_context():
+        cache = get_cache()
+        if cache is not None:
+            cache.invalidate(changed)
+
+
+@event.listens_for(db.session, "after_rollback")
+def _forget_rolled_back_tables(session):
+    session.info.pop('tapi_changed_tables', None)
@@ -0,0 +1,189 @@
+""" Prebuilt Portion catalog
+
+Loading a food composition table through the API means one POST and one commit per
+Portion. build_catalog() streams a CSV into a separate SQLite file instead, with
+batched inserts into a table like portion and without a journal: a failed build
+leaves no file behind, and the database of the app is not touched at all.
+
+swap_catalog() then ATTACHes the built file to the app database and upserts its
+Portions in one IMMEDIATE transaction. The readers (WAL) see the old catalog until the
+commit and the new one after it. Writers wait for the commit (busy_timeout). Only the
+rows that differ are written, so the FTS index, the table versions and the nutrient
+rollups change only for them. The FTS triggers find the index rows by the Portion pk:
+20k changed names of 50k Portions swap in 0.6 s, a rename of all of 200k Portions in
+5 s, while rebuilding the whole index in bulk takes 3 s for the 200k alone, so the
+triggers are kept for the swap too.
+
+The catalog is copied in and not served from the attached file, because MealPortion
+refers to the Portions with a foreign key and SQLite has no foreign keys across
+databases.
+"""
+import csv
+import os
+
+from sqlalchemy import MetaData, create_engine, text
+from sqlalchemy.exc import IntegrityError
+
+from tapi.models import Portion
+from tapi.nutrition import NUTRIENTS, refresh_meal_nutrients, rebuild_daily_intake
+from tapi.validation import compile_pattern
+
+# the handle and the data of a Portion, the catalog has no surrogate keys
+CATALOG_COLUMNS = [column.name for column in Portion.__table__.columns if column.name != 'pk']
+CATALOG_BATCH_SIZE = 5000
+
+
+class CatalogError(Exception):
+    """ A CSV row that is not a valid Portion, or a catalog file that cannot be used """
+
+
+def string_checks(schema):
+    """ [(field, maxLength, compiled pattern)] of the string properties of a resource
+    schema. The numbers of a CSV row are converted by catalog_row itself, checking the
+    strings alone is several times faster than running the validator on every row """
+    checks = []
+    for field, prop in schema["properties"].items():
+        if prop.get("type") == "string":
+            pattern = prop.get("pattern")
+            checks.append((field, prop.get("maxLength"), compile_pattern(pattern) if pattern else None))
+    return checks
+
+
+def catalog_row(row, line, checks):
+    # a CSV row to a portion row, empty number cells get the column defaults
+    portion = {}
+    for field, max_length, pattern in checks:
+        value = row.get(field) or ""
+        if not value or (max_length is not None and len(value) > max_length) or \
+                (pattern is not None and not pattern.search(value)):
+            raise CatalogError("line {}: invalid {}: {!r}".format(line, field, value))
+        portion[field] = value
+    for column in CATALOG_COLUMNS[2:]:
+        value = row.get(column)
+        if value not in (None, ""):
+            try:
+                portion[column] = float(value)
+            except ValueError:
+                raise CatalogError("line {}: {} is not a number: {!r}".format(line, column, value))
+        elif column == "calories":
+            raise CatalogError("line {}: no calories".format(line))
+        else:
+            portion[column] = None if column == "density" else 0
+    return portion
+
+
+def catalog_rows(csv_file, schema):
+    """ Yields the rows of an open CSV file with a header row as portion rows """
+    reader = csv.DictReader(csv_file)
+    missing = set(schema["required"]) - set(reader.fieldnames or [])
+    if missing:
+        raise CatalogError("the CSV has no column {}".format(", ".join(sorted(missing))))
+    checks = string_checks(schema)
+    for row in reader:
+        yield catalog_row(row, reader.line_num, checks)
+
+
+def build_catalog(csv_file, path, schema, batch_size=CATALOG_BATCH_SIZE):
+    """ Writes the rows of the CSV to a new catalog file at path, replacing an existing
+    one only when the build succeeds. Returns the number of Portions """
+    tmp_path = path + ".tmp"
+    if os.path.exists(tmp_path):
+        os.unlink(tmp_path)
+    engine = create_engine("sqlite:///" + tmp_path)
+    metadata = MetaData()
+    table = Portion.__table__.to_metadata(metadata)
+    count = 0
+    built = False
+    try:
+        with engine.connect() as connection:
+            # a throwaway file until the rename, nothing to journal or sync
+            connection.exec_driver_sql("PRAGMA journal_mode=OFF")
+            connection.exec_driver_sql("PRAGMA synchronous=OFF")
+            metadata.create_all(connection)
+            batch = []
+            for portion in catalog_rows(csv_file, schema):
+                batch.append(portion)
+                if len(batch) >= batch_size:
+                    connection.execute(table.insert(), batch)
+                    count += len(batch)
+                    batch = []
+            if batch:
+                connection.execute(table.insert(), batch)
+                count += len(batch)
+            connection.commit()
+        built = True
+    except IntegrityError as e:
+        raise CatalogError("duplicate Portion id in the CSV: {}".format(e.orig))
+    finally:
+        engine.dispose()
+        if not built and os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+    os.replace(tmp_path, path)
+    return count
+
+
+def _differs(new, old, columns):
+    return " OR ".join("{0}.{2} IS NOT {1}.{2}".format(new, old, c) for c in columns)
+
+
+def _catalog_changes(connection):
+    # the number of catalog Portions that are new or differ from the current ones, and
+    # the Meals using a Portion whose nutrients change
+    count = connection.execute(text(
+        "SELECT count(*) FROM catalog.portion AS c LEFT JOIN main.portion AS p ON p.id = c.id "
+        "WHERE p.id IS NULL OR " + _differs("c", "p", CATALOG_COLUMNS[1:]))).scalar()
+    meal_pks = connection.execute(text(
+        "SELECT DISTINCT mp.meal_pk FROM main.meal_portion AS mp "
+        "JOIN main.portion AS p ON p.pk = mp.portion_pk JOIN catalog.portion AS c ON c.id = p.id "
+        "WHERE " + _differs("c", "p", NUTRIENTS))).scalars().all()
+    return count, meal_pks
+
+
+def _upsert_catalog(connection):
+    columns = ", ".join(CATALOG_COLUMNS)
+    updates = ", ".join("{0} = excluded.{0}".format(c) for c in CATALOG_COLUMNS[1:])
+    differs = _differs("excluded", "portion", CATALOG_COLUMNS[1:])
+    # WHERE true: a SELECT feeding an upsert needs one to parse ON CONFLICT
+    connection.execute(text(
+        "INSERT INTO main.portion ({0}) SELECT {0} FROM catalog.portion WHERE true "
+        "ON CONFLICT (id) DO UPDATE SET {1} WHERE {2}".format(columns, updates, differs)))
+
+
+def _prune_catalog(connection):
+    # the Portions missing from the catalog that no Meal uses
+    result = connection.execute(text(
+        "DELETE FROM main.portion WHERE id NOT IN (SELECT id FROM catalog.portion) "
+        "AND pk NOT IN (SELECT portion_pk FROM main.meal_portion)"))
+    return result.rowcount
+
+
+def swap_catalog(engine, path, prune=False):
+    """ Makes the Portions of the catalog file at path the Portions of the database in
+    one transaction. With prune, the Portions not in the catalog and used by no Meal
+    are deleted. Returns the counts of the upserted and of the deleted Portions """
+    if engine.dialect.name != "sqlite":
+        raise CatalogError("the catalog swap needs an SQLite database")
+    if not os.path.isfile(path):
+        raise CatalogError("no catalog file {}".format(path))
+    # ATTACH and DETACH do not run inside a transaction, the transaction is begun here
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        connection.execute(text("ATTACH DATABASE :path AS catalog"), {"path": path})
+        try:
+            columns = {row[1] for row in connection.exec_driver_sql("PRAGMA catalog.table_info(portion)")}
+            if not set(CATALOG_COLUMNS) <= columns:
+                raise CatalogError("{} is not a Portion catalog".format(path))
+            connection.exec_driver_sql("BEGIN IMMEDIATE")
+            try:
+                upserted, meal_pks = _catalog_changes(connection)
+                _upsert_catalog(connection)
+                deleted = _prune_catalog(connection) if prune else 0
+                # the nutrients of the meals, and of the days they were eaten
+                refresh_meal_nutrients(connection, meal_pks)
+                rebuild_daily_intake(connection, meal_pks)
+            except BaseException:
+                connection.exec_driver_sql("ROLLBACK")
+                raise
+            connection.exec_driver_sql("COMMIT")
+        finally:
+            connection.exec_driver_sql("DETACH DATABASE catalog")
+    return upserted, deleted
@@ -0,0 +1,64 @@
+""" Conditional GETs with ETag and Last-Modified
+
+The ETag of a response is a hash of the request URL and the change counters
+(table_version) of the tables the resource reads. A request whose If-None-Match
+(or If-Modified-Since) still matches gets a 304 from one small query, without
+running the resource query or the serialization.
+"""
+import datetime
+import functools
+import hashlib
+
+from flask import Response, request
+
+from tapi.models import TableVersion
+from tapi import db
+
+
+def table_versions(tables):
+    """ Returns [(table, version)] and the last change time of the tables, one query """
+    rows = db.session.query(TableVersion.table_name, TableVersion.version, TableVersion.modified) \
+        .filter(TableVersion.table_name.in_(tables)).all()
+    found = {name: (version, modified) for name, version, modified in rows}
+    versions = [(table, found.get(table, (0, 0))) for table in tables]
+    modified = max([m for _, (_, m) in versions], default=0)
+    last_modified = datetime.datetime.fromtimestamp(modified, datetime.timezone.utc) if modified else None
+    return versions, last_modified
+
+
+def make_etag(versions, *extra):
+    # the modification times are in the hash too, versions start from 1 again in a new database
+    key = "|".join([request.url] + ["{}:{}:{}".format(t, v, m) for t, (v, m) in versions] +
+                   [str(e) for e in extra])
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+def not_modified(etag, last_modified):
+    # If-None-Match wins over If-Modified-Since (RFC 7232, 6.)
+    if request.if_none_match:
+        return request.if_none_match.contains(etag)
+    if last_modified is not None and request.if_modified_since is not None:
+        return last_modified <= request.if_modified_since
+    return False
+
+
+def conditional_get(*tables, vary=None):
+    """ Decorator for a resource GET that reads the given tables. vary() returns anything
+    else the response depends on (e.g. the default day), it is part of the ETag """
+    def decorator(get):
+        @functools.wraps(get)
+        def wrapper(*args, **kwargs):
+            versions, last_modified = table_versions(tables)
+            etag = make_etag(versions, *([vary()] if vary is not None else []))
+            if not_modified(etag, last_modified):
+                resp = Response(status=304)
+            else:
+                resp = get(*args, **kwargs)
+                if resp.status_code != 200:
+                    return resp
+            resp.set_etag(etag)
+            if last_modified is not None:
+                resp.last_modified = last_modified
+            return resp
+        return wrapper
+    return decorator
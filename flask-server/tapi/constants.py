@@ -5,9 +5,32 @@ ROUTE_MEAL_COLLECTION = '/meals/'
 ROUTE_MEAL = '/meals/<handle>/'
 ROUTE_PORTION_COLLECTION = '/portions/'
 ROUTE_PORTION = '/portions/<handle>/'
+ROUTE_PORTION_MEALS = '/portions/<handle>/meals/'
 ROUTE_MEALRECORD_COLLECTION = '/mealrecords/'
 ROUTE_MEALRECORD = '/meals/<meal>/mealrecords/<handle>/'
+ROUTE_MEALRECORD_BATCH = '/mealrecords/batch/'
+ROUTE_PERSON_MEALRECORD_EXPORT = '/persons/<handle>/mealrecords/export/'
+ROUTE_MEALPORTION_COLLECTION = '/meals/<handle>/mealportions/'
 ROUTE_MEALPORTION = '/meals/<meal>/mealportions/<handle>/'
+ROUTE_PERSON_NUTRITION = '/persons/<handle>/nutrition/'
+ROUTE_CACHE_STATS = '/cache/'
+
+# Keyset pagination of the collections: default and hard upper limit of ?limit=
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+# Most MealRecords accepted by one batch POST
+MAX_BATCH_SIZE = 1000
+# Streamed collections (?stream=true): rows fetched per query round, characters per write
+STREAM_CHUNK_SIZE = 1000
+STREAM_BUFFER_SIZE = 64 * 1024
+# Formats of the MealRecord export and their content types
+EXPORT_FORMATS = {'ndjson': 'application/x-ndjson', 'csv': 'text/csv; charset=utf-8'}
+
+# Portion search ranks all the name matches of a word this long or longer. The 1-2
+# letter prefixes of an autocomplete match too many names of a big catalog to rank
+# all of them for every keystroke, only the first SEARCH_CANDIDATES matches are ranked
+SEARCH_RANK_ALL_LENGTH = 3
+SEARCH_CANDIDATES = 500
 
 MASON = 'application/vnd.mason+json'
 NS = 'cameta'
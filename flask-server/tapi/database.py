@@ -0,0 +1,73 @@
+""" Database engine configuration
+
+The SQLite pragmas are connection settings, so they are set on every new
+connection of the pool. The defaults are for a server with concurrent readers
+and writers: WAL lets the readers run while a write is in progress,
+synchronous=NORMAL syncs at WAL checkpoints instead of at every commit, and
+busy_timeout makes a writer wait for the write lock instead of failing with
+"database is locked". A pragma set to None in the SQLITE_PRAGMAS config is
+left at the SQLite default.
+
+DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_TIMEOUT and DB_POOL_RECYCLE size the
+connection pool of a file database (or a server database).
+"""
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+
+DEFAULT_SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    # milliseconds
+    'busy_timeout': 5000,
+    'foreign_keys': 'ON',
+    # negative is KiB, 64 MiB of page cache per connection
+    'cache_size': -64 * 1024,
+    'mmap_size': 256 * 1024 * 1024,
+}
+
+POOL_OPTIONS = {
+    'DB_POOL_SIZE': 'pool_size',
+    'DB_MAX_OVERFLOW': 'max_overflow',
+    'DB_POOL_TIMEOUT': 'pool_timeout',
+    'DB_POOL_RECYCLE': 'pool_recycle',
+}
+
+
+def is_memory_sqlite(url):
+    url = make_url(url)
+    return url.get_backend_name() == 'sqlite' and url.database in (None, '', ':memory:')
+
+
+def engine_options(config):
+    """ SQLALCHEMY_ENGINE_OPTIONS with the pool options of the config added """
+    options = dict(config.get('SQLALCHEMY_ENGINE_OPTIONS', {}))
+    # an in-memory SQLite database lives in a single connection, it has no pool to size
+    if not is_memory_sqlite(config['SQLALCHEMY_DATABASE_URI']):
+        for key, option in POOL_OPTIONS.items():
+            if config.get(key) is not None:
+                options.setdefault(option, config[key])
+    return options
+
+
+def sqlite_pragmas(config):
+    pragmas = dict(DEFAULT_SQLITE_PRAGMAS)
+    pragmas.update(config.get('SQLITE_PRAGMAS', {}))
+    if is_memory_sqlite(config['SQLALCHEMY_DATABASE_URI']):
+        # no WAL or memory mapping for a database without a file
+        pragmas.pop('journal_mode', None)
+        pragmas.pop('mmap_size', None)
+    return [(name, value) for name, value in pragmas.items() if value is not None]
+
+
+def configure_engine(engine, config):
+    """ Sets the pragmas of the config on every new SQLite connection of the engine """
+    if engine.dialect.name != 'sqlite':
+        return
+    pragmas = sqlite_pragmas(config)
+
+    @event.listens_for(engine, "connect")
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas:
+            cursor.execute("PRAGMA {}={}".format(name, value))
+        cursor.close()
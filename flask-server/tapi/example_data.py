@@ -51,12 +51,12 @@ def db_load_example_data(db):
     meal2.name = "Oatmeal"
     meal2.servings = 2
 
-    mp1 = MealPortion(meal_id=meal1.id, portion_id=portion1.id, weight_per_serving=10)
-    mp2 = MealPortion(meal_id=meal1.id, portion_id=portion2.id, weight_per_serving=200)
-    mp3 = MealPortion(meal_id=meal1.id, portion_id=portion3.id, weight_per_serving=200)
+    mp1 = MealPortion(meal=meal1, portion=portion1, weight_per_serving=10)
+    mp2 = MealPortion(meal=meal1, portion=portion2, weight_per_serving=200)
+    mp3 = MealPortion(meal=meal1, portion=portion3, weight_per_serving=200)
 
-    mp4 = MealPortion(meal_id=meal2.id, portion_id=portion4.id, weight_per_serving=150)
-    mp5 = MealPortion(meal_id=meal2.id, portion_id=portion5.id, weight_per_serving=50)
+    mp4 = MealPortion(meal=meal2, portion=portion4, weight_per_serving=150)
+    mp5 = MealPortion(meal=meal2, portion=portion5, weight_per_serving=50)
 
     m1 = MealRecord()
     m1.person = person
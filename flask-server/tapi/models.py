@@ -5,23 +5,98 @@ An example from the exercise taken as a base and then modified (Measurement exam
 """
 
 # BEGIN of the content taken from the exercise example
-from sqlalchemy import ForeignKey
+from sqlalchemy import ForeignKey, DDL, event
 from sqlalchemy.orm import relationship, backref
 # END of the content taken from the exercise example
 # now group's own content from here on.
-from sqlalchemy.ext.hybrid import hybrid_property
+from sqlalchemy import inspect, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.ext.hybrid import Comparator, hybrid_property
+from sqlalchemy.orm.attributes import flag_dirty
+from sqlalchemy.sql import operators
+from sqlalchemy.schema import CreateTable, DropTable
 
 from tapi import db
 
 
+class HandleComparator(Comparator):
+    """ Compares a handle attribute by the integer foreign key under it: == and in_() look
+    the handles up in the unique id index of the target and compare the keys, so they
+    need no join. Other uses (select, order_by) get the handle with a subquery """
+    def __init__(self, fk, target):
+        self.fk = fk
+        self.target = target
+        super().__init__(select(target.id).where(target.pk == fk).scalar_subquery())
+
+    def operate(self, op, *other, **kwargs):
+        if op is operators.eq:
+            return self.fk == select(self.target.pk).where(self.target.id == other[0]).scalar_subquery()
+        if op is operators.in_op:
+            return self.fk.in_(select(self.target.pk).where(self.target.id.in_(other[0])))
+        return op(self.expression, *other, **kwargs)
+
+
+def handle_property(relation, target):
+    """ The id (handle) of the related target object, e.g. MealRecord.person_id for
+    MealRecord.person. Setting it looks the handle up at the next flush, a handle that
+    is not found fails the flush with IntegrityError like a foreign key would """
+    def fget(self):
+        pending = self.__dict__.get('_pending_handles', {})
+        if relation in pending:
+            return pending[relation]
+        related = getattr(self, relation)
+        return None if related is None else related.id
+
+    def fset(self, value):
+        related = getattr(self, relation)
+        pending = self.__dict__.setdefault('_pending_handles', {})
+        if related is not None and related.id == value:
+            pending.pop(relation, None)
+            return
+        pending[relation] = value
+        flag_dirty(self)
+
+    prop = hybrid_property(fget, fset)
+    return prop.comparator(lambda cls: HandleComparator(getattr(cls, relation + '_pk'), target))
+
+
+@event.listens_for(db.session, "before_flush")
+def _resolve_handles(session, flush_context, instances):
+    # before the other before_flush hooks, they see the related objects set here
+    found = {}
+    for obj in list(session.new) + list(session.dirty):
+        pending = obj.__dict__.pop('_pending_handles', None)
+        for relation, handle in (pending or {}).items():
+            target = inspect(obj).mapper.relationships[relation].mapper.class_
+            key = (target, handle)
+            if key not in found:
+                found[key] = next((o for o in session.new if isinstance(o, target) and o.id == handle), None)
+                if found[key] is None:
+                    with session.no_autoflush:
+                        found[key] = session.query(target).filter(target.id == handle).one_or_none()
+            if found[key] is None:
+                raise IntegrityError("{}.{}".format(type(obj).__name__, relation), {relation: handle},
+                                     Exception("FOREIGN KEY constraint failed: no {} {!r}".format(
+                                         target.__name__, handle)))
+            setattr(obj, relation, found[key])
+
+
+# Integer surrogate keys (pk) under the string ids (handles) of the API: the foreign keys,
+# the joins and the indexes of the link tables compare integers, the handles are unique
+# indexed columns of their own table only
+
 class Person(db.Model):
     """ Person- All columns required """
-    id = db.Column(db.String(128), primary_key=True)
+    pk = db.Column(db.Integer, primary_key=True)
+    id = db.Column(db.String(128), unique=True, nullable=False)
+    daily_intake = relationship("DailyIntake", back_populates="person", cascade="all, delete-orphan")
 
 
 class Activity(db.Model):
     """ Activity- id, name and intensity required """
-    id = db.Column(db.String(128), primary_key=True)
+    pk = db.Column(db.Integer, primary_key=True)
+    id = db.Column(db.String(128), unique=True, nullable=False)
     name = db.Column(db.String(128), nullable=False)
     intensity = db.Column(db.Integer, nullable=False)
     # Description max size 8K for simplicity reasons
@@ -31,37 +106,60 @@ class Activity(db.Model):
 
 class ActivityRecord(db.Model):
     """ ActivityRecord- All columns required """
-    person_id = db.Column(db.String(128), ForeignKey('person.id'), primary_key=True)
-    activity_id = db.Column(db.String(128), ForeignKey('activity.id'), primary_key=True)
+    __table_args__ = (
+        db.Index('ux_activity_record_handle', 'person_pk', 'activity_pk', 'timestamp', unique=True),
+    )
+    pk = db.Column(db.Integer, primary_key=True)
+    person_pk = db.Column(db.Integer, ForeignKey('person.pk'), nullable=False)
+    activity_pk = db.Column(db.Integer, ForeignKey('activity.pk'), nullable=False)
     person = relationship(Person, backref=backref("activities", cascade="all, delete-orphan"))
     activity = relationship(Activity, backref=backref("activityrecords"))
+    person_id = handle_property('person', Person)
+    activity_id = handle_property('activity', Activity)
     duration = db.Column(db.Integer, nullable=False)
-    timestamp = db.Column(db.DateTime, primary_key=True)
+    timestamp = db.Column(db.DateTime, nullable=False)
 
 
 class Meal(db.Model):
     """  id, name and servings required """
-    id = db.Column(db.String(128), primary_key=True)
+    pk = db.Column(db.Integer, primary_key=True)
+    id = db.Column(db.String(128), unique=True, nullable=False)
     name = db.Column(db.String(128), nullable=False)
     servings = db.Column(db.Float, nullable=False)
     # Description max size 8K for simplicity reasons
     description = db.Column(db.String(8*1024), nullable=True)
     meal_records = relationship("MealRecord", back_populates="meal", cascade="all, delete-orphan")
-    portions = relationship("MealPortion", cascade="all, delete-orphan")
+    portions = relationship("MealPortion", back_populates="meal", cascade="all, delete-orphan")
+    nutrients = relationship("MealNutrients", uselist=False, back_populates="meal", cascade="all, delete-orphan")
 
 
 class MealRecord(db.Model):
     """ MealRecord- All columns required """
-    person_id = db.Column(db.String(128), ForeignKey('person.id'), primary_key=True)
-    meal_id = db.Column(db.String(128), ForeignKey('meal.id'), primary_key=True)
-    person = relationship(Person, backref=backref("meals", cascade="all, delete-orphan"))
-    meal = relationship(Meal, back_populates="meal_records")
+    # The handle of a record is (person, meal, timestamp), unique. Time range queries of a
+    # person's records are index range scans of the second index, meal_pk gives a stable
+    # order for the records with the same timestamp. The rollups of a meal and the deletes
+    # of its records find them by the third
+    __table_args__ = (
+        db.Index('ux_meal_record_handle', 'person_pk', 'meal_pk', 'timestamp', unique=True),
+        db.Index('ix_meal_record_person_timestamp', 'person_pk', 'timestamp', 'meal_pk'),
+        db.Index('ix_meal_record_meal_person_timestamp', 'meal_pk', 'person_pk', 'timestamp'),
+    )
+    pk = db.Column(db.Integer, primary_key=True)
+    person_pk = db.Column(db.Integer, ForeignKey('person.pk'), nullable=False)
+    meal_pk = db.Column(db.Integer, ForeignKey('meal.pk'), nullable=False)
+    # loaded with the record, the API shows their handles
+    person = relationship(Person, lazy="joined", innerjoin=True,
+                          backref=backref("meals", cascade="all, delete-orphan"))
+    meal = relationship(Meal, lazy="joined", innerjoin=True, back_populates="meal_records")
+    person_id = handle_property('person', Person)
+    meal_id = handle_property('meal', Meal)
     amount = db.Column(db.Float, nullable=False)
-    timestamp = db.Column(db.DateTime, primary_key=True)
+    timestamp = db.Column(db.DateTime, nullable=False)
 
 
 class Portion(db.Model):
-    id = db.Column(db.String(128), primary_key=True)
+    pk = db.Column(db.Integer, primary_key=True)
+    id = db.Column(db.String(128), unique=True, nullable=False)
     name = db.Column(db.String(128), nullable=False)
     calories = db.Column(db.Float, nullable=False)
     density = db.Column(db.Float, nullable=True)
@@ -72,6 +170,144 @@ class Portion(db.Model):
 
 
 class MealPortion(db.Model):
-    meal_id = db.Column(db.String(128), ForeignKey('meal.id'), primary_key=True)
-    portion_id = db.Column(db.String(128), ForeignKey('portion.id'), primary_key=True)
+    # The unique index starts with meal_pk, the other one serves the lookups by portion:
+    # the meals using a portion and the foreign key check when a portion is deleted
+    __table_args__ = (
+        db.Index('ux_meal_portion_meal_portion', 'meal_pk', 'portion_pk', unique=True),
+        db.Index('ix_meal_portion_portion_meal', 'portion_pk', 'meal_pk'),
+    )
+    pk = db.Column(db.Integer, primary_key=True)
+    meal_pk = db.Column(db.Integer, ForeignKey('meal.pk'), nullable=False)
+    portion_pk = db.Column(db.Integer, ForeignKey('portion.pk'), nullable=False)
+    meal = relationship(Meal, back_populates="portions")
+    portion = relationship(Portion, lazy="joined", innerjoin=True)
+    meal_id = handle_property('meal', Meal)
+    portion_id = handle_property('portion', Portion)
     weight_per_serving = db.Column(db.Float, nullable=False)
+
+
+class MealNutrients(db.Model):
+    """ MealNutrients- nutrients of one serving of a Meal, summed from its MealPortions
+    and their Portions. Kept up to date on every flush by tapi.nutrition """
+    meal_pk = db.Column(db.Integer, ForeignKey('meal.pk', ondelete="CASCADE"), primary_key=True)
+    meal = relationship(Meal, back_populates="nutrients")
+    meal_id = handle_property('meal', Meal)
+    calories = db.Column(db.Float, nullable=False, default=0)
+    fat = db.Column(db.Float, nullable=False, default=0)
+    protein = db.Column(db.Float, nullable=False, default=0)
+    carbohydrate = db.Column(db.Float, nullable=False, default=0)
+    alcohol = db.Column(db.Float, nullable=False, default=0)
+
+
+class SchemaVersion(db.Model):
+    """ SchemaVersion- the single row tells the version of the schema in the database,
+    see tapi.schema """
+    version = db.Column(db.Integer, primary_key=True)
+
+
+class TableVersion(db.Model):
+    """ TableVersion- change counter and last change time (unix seconds) of a table.
+    Kept up to date by the database triggers below, so every write counts: ORM flushes,
+    bulk inserts and the example data alike """
+    table_name = db.Column(db.String(64), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+    modified = db.Column(db.Integer, nullable=False)
+
+
+# Tables the API serves, the conditional GETs compare their versions
+VERSIONED_TABLES = ['person', 'meal', 'meal_record', 'portion', 'meal_portion']
+
+VERSION_TRIGGER = """
+CREATE TRIGGER IF NOT EXISTS table_version_{table}_{action} AFTER {action} ON {table}
+BEGIN
+    INSERT INTO table_version (table_name, version, modified)
+    VALUES ('{table}', 1, CAST(strftime('%%s', 'now') AS INTEGER))
+    ON CONFLICT (table_name) DO UPDATE SET version = version + 1, modified = excluded.modified;
+END
+"""
+
+
+@event.listens_for(db.metadata, "after_create")
+def create_version_triggers(target, connection, **kw):
+    # after every create_all, IF NOT EXISTS adds the triggers to existing databases too
+    if connection.dialect.name != "sqlite":
+        return
+    for table in VERSIONED_TABLES:
+        for action in ("INSERT", "UPDATE", "DELETE"):
+            connection.execute(DDL(VERSION_TRIGGER.format(table=table, action=action)))
+
+
+class DailyIntake(db.Model):
+    """ DailyIntake- nutrient totals of the MealRecords of a person per day. Kept up to
+    date on every flush by tapi.nutrition, flask rebuild-daily-intake recomputes it """
+    person_pk = db.Column(db.Integer, ForeignKey('person.pk', ondelete="CASCADE"), primary_key=True)
+    person = relationship(Person, back_populates="daily_intake")
+    person_id = handle_property('person', Person)
+    day = db.Column(db.Date, primary_key=True)
+    calories = db.Column(db.Float, nullable=False, default=0)
+    fat = db.Column(db.Float, nullable=False, default=0)
+    protein = db.Column(db.Float, nullable=False, default=0)
+    carbohydrate = db.Column(db.Float, nullable=False, default=0)
+    alcohol = db.Column(db.Float, nullable=False, default=0)
+
+
+# Full-text index of the Portion names, an FTS5 virtual table kept in sync by triggers.
+# It is declared in the metadata with its shadow tables, so create_all() creates it as
+# a virtual table and db.reflect() does not pick up the shadow tables as plain tables
+PORTION_FTS = db.Table(
+    'portion_fts', db.metadata,
+    # the pk of the portion, the triggers find the rows of a portion by it
+    db.Column('rowid', db.Integer),
+    db.Column('name', db.String(128)),
+    info={'fts5': "name, tokenize = 'unicode61 remove_diacritics 2', prefix = '1 2 3'"}
+)
+for _shadow in ('data', 'idx', 'content', 'docsize', 'config'):
+    db.Table('portion_fts_' + _shadow, db.metadata, info={'fts5_shadow': True})
+
+PORTION_FTS_TRIGGERS = {
+    'portion_fts_insert': """CREATE TRIGGER IF NOT EXISTS portion_fts_insert AFTER INSERT ON portion
+    BEGIN
+        INSERT INTO portion_fts (rowid, name) VALUES (new.pk, new.name);
+    END""",
+    'portion_fts_update': """CREATE TRIGGER IF NOT EXISTS portion_fts_update AFTER UPDATE OF name ON portion
+    BEGIN
+        UPDATE portion_fts SET name = new.name WHERE rowid = new.pk;
+    END""",
+    'portion_fts_delete': """CREATE TRIGGER IF NOT EXISTS portion_fts_delete AFTER DELETE ON portion
+    BEGIN
+        DELETE FROM portion_fts WHERE rowid = old.pk;
+    END""",
+}
+
+
+@compiles(CreateTable, "sqlite")
+def _create_fts_table(element, compiler, **kw):
+    table = element.element
+    if 'fts5' in table.info:
+        return "CREATE VIRTUAL TABLE {} USING fts5({})".format(table.name, table.info['fts5'])
+    if 'fts5_shadow' in table.info:
+        # made by the virtual table
+        return "SELECT 1"
+    return compiler.visit_create_table(element, **kw)
+
+
+@compiles(DropTable, "sqlite")
+def _drop_fts_table(element, compiler, **kw):
+    if 'fts5_shadow' in element.element.info:
+        # dropped with the virtual table
+        return "SELECT 1"
+    return compiler.visit_drop_table(element, **kw)
+
+
+@event.listens_for(PORTION_FTS, "after_create")
+def fill_portion_fts(target, connection, **kw):
+    # index the portions already in the database when the index is added
+    connection.execute(DDL("INSERT INTO portion_fts (rowid, name) SELECT pk, name FROM portion"))
+
+
+@event.listens_for(db.metadata, "after_create")
+def create_portion_fts_triggers(target, connection, **kw):
+    if connection.dialect.name != "sqlite":
+        return
+    for trigger in PORTION_FTS_TRIGGERS.values():
+        connection.execute(DDL(trigger))
@@ -0,0 +1,278 @@
+""" Nutrient totals computed in the database
+
+Portion nutrients are given per 100g, MealPortion tells the weight of a Portion in
+one serving of a Meal and MealRecord the number of servings eaten. Instead of
+walking the API the totals are summed with aggregate queries over those tables.
+
+The nutrients of one serving of each Meal are materialized in MealNutrients. They
+are refreshed after every flush that changes a MealPortion, the nutrients of a
+Portion or adds a Meal, inside the same transaction, so reading them is a single
+row lookup per meal.
+
+The daily totals of each person are materialized in DailyIntake. Added, changed
+and deleted MealRecords apply their deltas to it in the same transaction, and the
+days with records of a meal whose nutrients change are recomputed. Daily and
+weekly totals are then read from a row per day.
+"""
+import datetime
+from collections import defaultdict
+
+from sqlalchemy import bindparam, delete, event, exists, func, insert, inspect, select, tuple_
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from tapi import db
+from tapi.models import DailyIntake, Meal, MealNutrients, MealRecord, MealPortion, Person, Portion
+
+NUTRIENTS = ['calories', 'fat', 'protein', 'carbohydrate', 'alcohol']
+
+
+def nutrient_sums(weight):
+    # SUM(weight * nutrient/100g) for each nutrient, missing values count as zero
+    return [
+        func.coalesce(func.sum(weight * func.coalesce(getattr(Portion, n), 0) / 100), 0).label(n)
+        for n in NUTRIENTS
+    ]
+
+
+def zero_nutrients():
+    return dict.fromkeys(NUTRIENTS, 0)
+
+
+def meal_nutrients_select(meal_pks=None):
+    # nutrients of one serving of the meals (all of them if None), zeros for meals without portions
+    query = select(Meal.pk, *nutrient_sums(MealPortion.weight_per_serving)) \
+        .select_from(Meal) \
+        .outerjoin(MealPortion, MealPortion.meal_pk == Meal.pk) \
+        .outerjoin(Portion, Portion.pk == MealPortion.portion_pk) \
+        .group_by(Meal.pk)
+    if meal_pks is not None:
+        query = query.where(Meal.pk.in_(meal_pks))
+    return query
+
+
+def refresh_meal_nutrients(connection, meal_pks=None):
+    """ Recomputes the MealNutrients rows of the given meals (pk), all meals if None """
+    if meal_pks is not None and not meal_pks:
+        return
+    stale = delete(MealNutrients)
+    if meal_pks is not None:
+        stale = stale.where(MealNutrients.meal_pk.in_(meal_pks))
+    connection.execute(stale)
+    connection.execute(insert(MealNutrients).from_select(
+        ['meal_pk'] + NUTRIENTS, meal_nutrients_select(meal_pks)))
+
+
+def fill_meal_nutrients(connection):
+    """ Adds the missing MealNutrients rows, e.g. for a database created before them """
+    missing = select(Meal.pk).where(~Meal.pk.in_(select(MealNutrients.meal_pk)))
+    meal_pks = connection.execute(missing).scalars().all()
+    refresh_meal_nutrients(connection, meal_pks)
+
+
+def _pk(key):
+    # pk of a key collected before a flush: the pk itself, or an object that was pending
+    return key if key is None or isinstance(key, int) else key.pk
+
+
+def _key(obj, relation):
+    # pk of the related object, the object itself while it has no pk yet
+    related = getattr(obj, relation)
+    if related is not None and related.pk is None:
+        return related
+    return getattr(obj, relation + '_pk') if related is None else related.pk
+
+
+def _changed_meals(session):
+    # meals (keys) whose nutrients the pending flush changes, and the pks of changed portions
+    meals = set()
+    portion_pks = set()
+    for obj in session.new | session.dirty | session.deleted:
+        if isinstance(obj, MealPortion):
+            # None if added through Meal.portions, the meal is then new or dirty itself
+            meal = _key(obj, 'meal')
+            if meal is not None:
+                meals.add(meal)
+        elif isinstance(obj, Meal):
+            if obj in session.new or inspect(obj).attrs.portions.history.has_changes():
+                meals.add(obj if obj.pk is None else obj.pk)
+        elif isinstance(obj, Portion) and obj not in session.new:
+            state = inspect(obj)
+            if obj in session.deleted or any(state.attrs[n].history.has_changes() for n in NUTRIENTS):
+                portion_pks.add(obj.pk)
+    return meals, portion_pks
+
+
+def daily_intake_select(days=None):
+    # daily totals of the mealrecords, of the given (person_pk, day) pairs if not None
+    day = func.date(MealRecord.timestamp)
+    query = select(MealRecord.person_pk, day,
+                   *[func.coalesce(func.sum(MealRecord.amount * getattr(MealNutrients, n)), 0)
+                     for n in NUTRIENTS]) \
+        .join(MealNutrients, MealNutrients.meal_pk == MealRecord.meal_pk) \
+        .group_by(MealRecord.person_pk, day)
+    if days is not None:
+        query = query.where(tuple_(MealRecord.person_pk, day).in_(days))
+    return query
+
+
+def rebuild_daily_intake(connection, meal_pks=None):
+    """ Recomputes the DailyIntake days that have records of the given meals (pk), all if None """
+    if meal_pks is not None and not meal_pks:
+        return
+    stale = delete(DailyIntake)
+    days = None
+    if meal_pks is not None:
+        days = select(MealRecord.person_pk, func.date(MealRecord.timestamp)) \
+            .where(MealRecord.meal_pk.in_(meal_pks)).distinct()
+        stale = stale.where(tuple_(DailyIntake.person_pk, DailyIntake.day).in_(days))
+    connection.execute(stale)
+    connection.execute(insert(DailyIntake).from_select(
+        ['person_pk', 'day'] + NUTRIENTS, daily_intake_select(days)))
+
+
+def fill_daily_intake(connection):
+    """ Builds DailyIntake if it is empty, e.g. for a database created before it """
+    if connection.execute(select(DailyIntake.person_pk).limit(1)).first() is None:
+        rebuild_daily_intake(connection)
+
+
+def mealrecord_deltas(records, per_serving, deltas=None):
+    """ Adds sign * nutrients of (person, meal, amount, timestamp, sign) records to the
+    {(person, day): {nutrient: delta}} deltas. per_serving as from meal_nutrients(), the
+    records of meals not in it add nothing """
+    deltas = defaultdict(zero_nutrients) if deltas is None else deltas
+    for person, meal, amount, timestamp, sign in records:
+        if meal not in per_serving:
+            continue
+        total = deltas[(person, timestamp.date())]
+        for n in NUTRIENTS:
+            total[n] += sign * amount * per_serving[meal][n]
+    return deltas
+
+
+def apply_daily_intake_deltas(connection, deltas):
+    """ Adds the {(person_pk, day): nutrients} deltas to the DailyIntake rows, creating the
+    missing rows. Deltas of persons that are gone are dropped, their rows are deleted with them """
+    if not deltas:
+        return
+    person_pk = bindparam('person_pk', type_=Person.pk.type)
+    values = select(person_pk, bindparam('day', type_=DailyIntake.day.type), *[bindparam(n) for n in NUTRIENTS]) \
+        .where(exists().where(Person.pk == person_pk))
+    upsert = sqlite_insert(DailyIntake).from_select(['person_pk', 'day'] + NUTRIENTS, values)
+    upsert = upsert.on_conflict_do_update(
+        index_elements=['person_pk', 'day'],
+        set_={n: getattr(DailyIntake, n) + getattr(upsert.excluded, n) for n in NUTRIENTS})
+    connection.execute(upsert, [dict(person_pk=person_pk, day=day, **values)
+                                for (person_pk, day), values in deltas.items()])
+
+
+def delete_mealrecords(connection, *criteria):
+    """ Deletes the mealrecords matching the criteria in one statement and subtracts them from
+    DailyIntake, for the deletes of many records: a cascade of the ORM loads them all and
+    deletes them one row at a time """
+    deltas = {(person_pk, datetime.date.fromisoformat(day)): {n: -value for n, value in zip(NUTRIENTS, values)}
+              for person_pk, day, *values in connection.execute(daily_intake_select().where(*criteria))}
+    apply_daily_intake_deltas(connection, deltas)
+    connection.execute(delete(MealRecord).where(*criteria))
+
+
+def _changed_mealrecords(session):
+    # (person, meal, amount, timestamp, sign) of the old and new versions of the changed
+    # mealrecords, person and meal as pks or as the objects that get their pk in the flush
+    records = []
+    for obj in session.new | session.dirty | session.deleted:
+        if not isinstance(obj, MealRecord):
+            continue
+        person, meal = _key(obj, 'person'), _key(obj, 'meal')
+        if obj in session.new:
+            records.append((person, meal, obj.amount, obj.timestamp, 1))
+        elif obj in session.deleted:
+            records.append((person, meal, obj.amount, obj.timestamp, -1))
+        else:
+            state = inspect(obj)
+            if not any(state.attrs[name].history.has_changes() for name in ('person', 'meal', 'amount', 'timestamp')):
+                continue
+            # a PUT may move the record to another person or meal, the old version is
+            # subtracted from the old ones. The old values are read from the row, they
+            # are not in the history if they were expired, e.g. after a commit
+            old = session.execute(select(MealRecord.person_pk, MealRecord.meal_pk, MealRecord.amount,
+                                         MealRecord.timestamp).where(MealRecord.pk == obj.pk)).one()
+            records.append(tuple(old) + (-1,))
+            records.append((person, meal, obj.amount, obj.timestamp, 1))
+    return records
+
+
+@event.listens_for(db.session, "before_flush")
+def _collect_nutrient_changes(session, flush_context, instances):
+    meals, portion_pks = _changed_meals(session)
+    with session.no_autoflush:
+        records = _changed_mealrecords(session)
+        if portion_pks:
+            # meals using the portions, looked up before the flush deletes anything
+            meals.update(session.execute(
+                select(MealPortion.meal_pk).where(MealPortion.portion_pk.in_(portion_pks))).scalars())
+        if records:
+            # deltas with the meal nutrients before the flush, the days of meals changed
+            # in this flush (and of the new ones) are recomputed after it anyway
+            per_serving = meal_nutrients({r[1] for r in records if isinstance(r[1], int)})
+            mealrecord_deltas(records, per_serving, session.info.setdefault('tapi_intake_deltas',
+                                                                            defaultdict(zero_nutrients)))
+    if meals:
+        session.info.setdefault('tapi_stale_meals', set()).update(meals)
+
+
+@event.listens_for(db.session, "after_flush")
+def _refresh_nutrients(session, flush_context):
+    # same connection and transaction as the flush, the new objects have their pks now
+    connection = session.connection()
+    meal_pks = {_pk(meal) for meal in session.info.pop('tapi_stale_meals', ())}
+    deltas = defaultdict(zero_nutrients)
+    for (person, day), values in session.info.pop('tapi_intake_deltas', {}).items():
+        total = deltas[(_pk(person), day)]
+        for n in NUTRIENTS:
+            total[n] += values[n]
+    apply_daily_intake_deltas(connection, deltas)
+    if meal_pks:
+        # deleted meals drop out of the selects
+        refresh_meal_nutrients(connection, meal_pks)
+        rebuild_daily_intake(connection, meal_pks)
+
+
+def meal_nutrients(meal_pks):
+    # nutrients of one serving of each given meal, {meal_pk: {nutrient: value}}
+    meal_pks = set(meal_pks)
+    if not meal_pks:
+        return {}
+    rows = db.session.execute(select(MealNutrients).where(MealNutrients.meal_pk.in_(meal_pks))).scalars()
+    result = {meal_pk: zero_nutrients() for meal_pk in meal_pks}
+    for row in rows:
+        result[row.meal_pk] = {n: getattr(row, n) for n in NUTRIENTS}
+    return result
+
+
+def mealrecord_nutrients(mealrecord, per_serving):
+    # nutrients of a mealrecord from the nutrients of one serving of its meal
+    return {n: mealrecord.amount * per_serving[n] for n in NUTRIENTS}
+
+
+def person_nutrients(person_pk, time_from, time_to):
+    # nutrient totals of the mealrecords of a person in [time_from, time_to)
+    row = db.session.query(*[func.coalesce(func.sum(MealRecord.amount * getattr(MealNutrients, n)), 0).label(n)
+                             for n in NUTRIENTS]) \
+        .select_from(MealRecord) \
+        .join(MealNutrients, MealNutrients.meal_pk == MealRecord.meal_pk) \
+        .filter(MealRecord.person_pk == person_pk,
+                MealRecord.timestamp >= time_from,
+                MealRecord.timestamp < time_to) \
+        .one()
+    return {n: getattr(row, n) for n in NUTRIENTS}
+
+
+def person_daily_nutrients(person_pk, day_from, day_to):
+    # nutrient totals of a person for the days [day_from, day_to), one DailyIntake row per day
+    row = db.session.query(*[func.coalesce(func.sum(getattr(DailyIntake, n)), 0).label(n) for n in NUTRIENTS]) \
+        .filter(DailyIntake.person_pk == person_pk,
+                DailyIntake.day >= day_from,
+                DailyIntake.day < day_to) \
+        .one()
+    return {n: getattr(row, n) for n in NUTRIENTS}
@@ -0,0 +1,118 @@
+""" Query budgets of the endpoints and N+1 detection
+
+@query_budget(n) on a resource method or a route function sets the most SQL
+statements a request to it may run. QUERY_BUDGETS in the config overrides the
+budgets, by "METHOD endpoint" or by endpoint, e.g.
+{"GET tapi.mealitem": 4, "tapi.personitem": 6}.
+
+With QUERY_BUDGET_ACTION set to 'log' or 'raise', the statements of every
+request are recorded. A request over its budget is logged to the
+'tapi.querybudget' logger, or fails with QueryBudgetExceeded. The same statement
+run QUERY_REPEAT_THRESHOLD times or more in one request is logged as a likely
+N+1 pattern: one query per row of an earlier one, like a lazy relationship read
+in a loop. Without QUERY_BUDGET_ACTION nothing is recorded and the decorator has
+no cost. The statements of a streamed body run after the check.
+"""
+import contextvars
+import logging
+from collections import Counter
+
+from flask import current_app, request
+from sqlalchemy import event
+
+logger = logging.getLogger('tapi.querybudget')
+
+QUERY_BUDGET_ACTIONS = ('log', 'raise')
+DEFAULT_REPEAT_THRESHOLD = 3
+
+_statements = contextvars.ContextVar('tapi_statements', default=None)
+
+
+class QueryBudgetExceeded(Exception):
+    """ A request ran more SQL statements than the budget of its endpoint """
+
+
+def query_budget(statements):
+    """ Decorator setting the most SQL statements a request to the view may run """
+    def decorator(fn):
+        fn.query_budget = statements
+        return fn
+    return decorator
+
+
+def view_function(app, endpoint, method):
+    # the function serving the method, the resource method of a flask_restful Resource
+    view = app.view_functions.get(endpoint)
+    view_class = getattr(view, 'view_class', None)
+    if view_class is None:
+        return view
+    method = method.lower()
+    if method == 'head' and not hasattr(view_class, 'head'):
+        method = 'get'
+    return getattr(view_class, method, None)
+
+
+def endpoint_budget(app, endpoint, method):
+    """ The statement budget of a request, None if the endpoint has none """
+    budgets = app.config.get('QUERY_BUDGETS', {})
+    for key in ("{} {}".format(method, endpoint), endpoint):
+        if key in budgets:
+            return budgets[key]
+    return getattr(view_function(app, endpoint, method), 'query_budget', None)
+
+
+def repeated_statements(statements, threshold=DEFAULT_REPEAT_THRESHOLD):
+    """ [(statement, count)] of the statements run at least threshold times, most first """
+    return [(s, count) for s, count in Counter(statements).most_common() if count >= threshold]
+
+
+def budget_report(endpoint, method, statements, budget, repeated):
+    lines = ["{} {}: {} SQL statements".format(method, endpoint, len(statements))]
+    if budget is not None:
+        lines[0] += ", budget {}".format(budget)
+    for statement, count in repeated:
+        lines.append("  {} times (N+1?): {}".format(count, " ".join(statement.split())[:300]))
+    return "\n".join(lines)
+
+
+def _record_statement(conn, cursor, statement, parameters, context, executemany):
+    statements = _statements.get()
+    if statements is not None:
+        statements.append(statement)
+
+
+def init_query_budget(app):
+    """ Checks the requests against their budgets if QUERY_BUDGET_ACTION is set """
+    action = app.config.get('QUERY_BUDGET_ACTION')
+    if not action:
+        return
+    if action not in QUERY_BUDGET_ACTIONS:
+        raise ValueError("QUERY_BUDGET_ACTION must be one of {}".format(", ".join(QUERY_BUDGET_ACTIONS)))
+    threshold = app.config.get('QUERY_REPEAT_THRESHOLD', DEFAULT_REPEAT_THRESHOLD)
+
+    from tapi import db
+    with app.app_context():
+        event.listen(db.engine, "before_cursor_execute", _record_statement)
+
+    @app.before_request
+    def start_recording():
+        _statements.set([])
+
+    @app.after_request
+    def check_query_budget(response):
+        statements = _statements.get()
+        if statements is None or request.endpoint is None:
+            return response
+        budget = endpoint_budget(current_app, request.endpoint, request.method)
+        repeated = repeated_statements(statements, threshold)
+        over = budget is not None and len(statements) > budget
+        if over or repeated:
+            report = budget_report(request.endpoint, request.method, statements, budget, repeated)
+            if over and action == 'raise':
+                raise QueryBudgetExceeded(report)
+            logger.warning(report)
+        return response
+
+    @app.teardown_request
+    def stop_recording(exc):
+        _statements.set(None)
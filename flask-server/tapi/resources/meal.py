@@ -1,18 +1,24 @@
-import json
-
 from flask import Response, request
 from flask_restful import Resource
-from jsonschema import validate, SchemaError, ValidationError
+from jsonschema import ValidationError
+from sqlalchemy import delete
 from sqlalchemy.exc import IntegrityError
 from werkzeug.exceptions import BadRequest
 
-from tapi.models import Meal
-from tapi.utils import add_mason_response_header, add_calorie_namespace, meal_to_api_meal
-from tapi.utils import CalorieBuilder
-from tapi.utils import error_400, error_404, error_409, error_415
+from tapi.models import Meal, MealPortion, MealRecord
+from tapi.utils import add_mason_response_header, add_calorie_namespace, meal_to_api_meal, dumps
+from tapi.utils import CalorieBuilder, get_page_limit, keyset_page, add_control_next_page
+from tapi.utils import stream_requested, keyset_stream, StreamedItems, stream_mason_response
+from tapi.utils import error_400, error_400_query, error_404, error_409, error_415
 from tapi.constants import MASON, NS
+from tapi.validation import compile_schema
+from tapi.nutrition import delete_mealrecords
 from tapi import db
 from tapi.api import api
+from tapi.urls import resource_url
+from tapi.conditional import conditional_get
+from tapi.querybudget import query_budget
+from tapi.cache import cached_get
 
 
 # MealItem type specific helper functions
@@ -45,65 +51,102 @@ def meal_schema():
     return schema
 
 
+# Checked once at startup, reused for every request
+MEAL_VALIDATOR = compile_schema(meal_schema())
+
+
 def add_control_add_meal(resp):
     resp.add_control(
         NS + ":add-meal",
-        href=api.url_for(MealItem, handle=None),
+        href=resource_url(MealItem, handle=None),
         method="POST",
         # TODO: json or should it be application/json?
         encoding="json",
         title="Creates a new Meal",
-        schema=meal_schema()
+        schema=MEAL_VALIDATOR.schema
     )
 
 
 def add_control_edit_meal(resp, handle):
     resp.add_control(
         NS + ":edit-meal",
-        href=api.url_for(MealItem) + handle + '/',
+        href=resource_url(MealItem, handle=handle),
         method="PUT",
         # TODO: json or should it be application/json?
         encoding="json",
         title="Edits a Meal",
-        schema=meal_schema()
+        schema=MEAL_VALIDATOR.schema
     )
 
 
+def meal_collection_item(meal):
+    m = meal_to_api_meal(meal)
+    m.add_control_self(resource_url(MealItem, handle=meal.id))
+    m.add_control_collection(resource_url(MealItem, handle=None))
+    add_control_edit_meal(m, handle=meal.id)
+    return m
+
+
 class MealItem(Resource):
     """ MealItem servers both: Individual MealItem and Meal Collection
     If given handle is missing, the Meal Collection is returned. If handle is
-    given, the corresponding MealItem is returned (if found from the DB) """
+    given, the corresponding MealItem is returned (if found from the DB)
+    Collections are paginated with ?limit= and ?after=, ?stream=true streams all of it.
+    ?expand=portions embeds the MealPortions and Portions of a MealItem """
     @classmethod
+    @query_budget(3)
+    @cached_get('meal', 'meal_portion', 'portion')
+    @conditional_get('meal', 'meal_portion', 'portion')
     def get(cls, handle=None):
         if handle is None:
-            # Meal collection
-            resp = CalorieBuilder(items=[])
-            for meal in Meal.query.all():
-                m = meal_to_api_meal(meal)
-                m.add_control_self(api.url_for(MealItem, handle=meal.id))
-                m.add_control_collection(api.url_for(MealItem, handle=None))
-                add_control_edit_meal(m, handle=meal.id)
-
-                resp['items'].append(m)
-            add_control_add_meal(resp)
+            # Meal collection, one page at a time or streamed as a whole
+            after = request.args.get('after')
+            after = None if after is None else [after]
+            if stream_requested():
+                meals = keyset_stream(Meal.query, [Meal.id], after)
+                resp = CalorieBuilder(items=StreamedItems(map(meal_collection_item, meals)))
+                add_control_add_meal(resp)
+            else:
+                limit = get_page_limit()
+                if limit is None:
+                    return error_400_query()
+                meals, has_more = keyset_page(Meal.query, [Meal.id], after, limit)
+                resp = CalorieBuilder(items=[meal_collection_item(meal) for meal in meals])
+                add_control_add_meal(resp)
+                if has_more:
+                    add_control_next_page(resp, meals[-1].id, limit)
         else:
             # Meal item
-            meal = Meal.query.filter(Meal.id == handle).first()
+            expand = request.args.get('expand')
+            if expand not in (None, 'portions'):
+                return error_400_query()
+            if expand is None:
+                meal = Meal.query.filter(Meal.id == handle).first()
+            else:
+                # imported here, tapi.resources.mealportion imports this module
+                from tapi.resources.mealportion import load_meal_with_portions, mealportion_collection_items
+                meal = load_meal_with_portions(handle)
             if meal is None:
                 return error_404()
             resp = meal_to_api_meal(meal)
-            resp.add_control_collection(api.url_for(MealItem, handle=None))
-            resp.add_control_delete(api.url_for(MealItem, handle=handle))
+            if expand is not None:
+                resp['portions'] = mealportion_collection_items(meal)
+            resp.add_control(NS + ':mealportions', resource_url(MealItem, handle=handle) + "mealportions/")
+            resp.add_control_collection(resource_url(MealItem, handle=None))
+            resp.add_control_delete(resource_url(MealItem, handle=handle))
             resp.add_control_profile()
             add_control_edit_meal(resp, handle)
 
         # Common fields for person item and person collection
-        resp.add_control_self(api.url_for(MealItem, handle=handle))
-        resp.add_control(NS+':meals-all', api.url_for(MealItem, handle=None))
+        resp.add_control_self(resource_url(MealItem, handle=handle))
+        resp.add_control(NS+':meals-all', resource_url(MealItem, handle=None))
         add_calorie_namespace(resp)
-        return Response(json.dumps(resp), 200, headers=add_mason_response_header())
+        if isinstance(resp.get('items'), StreamedItems):
+            return stream_mason_response(resp)
+        return Response(dumps(resp), 200, headers=add_mason_response_header())
 
     @classmethod
+    @query_budget(6)
     def post(cls):
         try:
             if request.content_type != "application/json" or request.json is None:
@@ -112,8 +155,8 @@ class MealItem(Resource):
             return error_415()
 
         try:
-            validate(request.json, schema=meal_schema())
-        except (SchemaError, ValidationError):
+            MEAL_VALIDATOR.validate(request.json)
+        except ValidationError:
             return error_400()
 
         meal_id = request.json['id']
@@ -145,6 +188,7 @@ class MealItem(Resource):
         )
 
     @classmethod
+    @query_budget(2)
     def put(cls, handle):
         try:
             if request.content_type != "application/json" or request.json is None:
@@ -153,8 +197,8 @@ class MealItem(Resource):
             return error_415()
 
         try:
-            validate(request.json, schema=meal_schema())
-        except (SchemaError, ValidationError):
+            MEAL_VALIDATOR.validate(request.json)
+        except ValidationError:
             return error_400()
 
         meal = Meal.query.filter(Meal.id == handle).first()
@@ -182,10 +226,15 @@ class MealItem(Resource):
         )
 
     @classmethod
+    @query_budget(10)
     def delete(cls, handle=None):
         meal = Meal.query.filter(Meal.id == handle).first()
         if meal is None:
             return error_404()
+        # the mealrecords and mealportions in bulk, the cascades then have nothing to load
+        connection = db.session.connection()
+        delete_mealrecords(connection, MealRecord.meal_pk == meal.pk)
+        connection.execute(delete(MealPortion).where(MealPortion.meal_pk == meal.pk))
         db.session.delete(meal)
         db.session.commit()
         return Response("DELETED", 204, mimetype=MASON)
@@ -1,19 +1,25 @@
-import json
-
 from flask import Response, request
 from flask_restful import Resource
-from jsonschema import validate, SchemaError, ValidationError
+from jsonschema import ValidationError
+from sqlalchemy import select
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload, selectinload
 from werkzeug.exceptions import BadRequest
 
 from tapi.models import Meal, MealPortion, Portion
-from tapi.resources.meal import MealItem
+from tapi.resources.meal import MealItem, meal_collection_item
+from tapi.resources.portion import PortionItem
 from tapi.utils import add_mason_response_header, add_calorie_namespace, \
-    mealportion_to_api_mealportion, make_mealportion_handle
-from tapi.utils import error_400, error_404, error_409, error_415
+    mealportion_to_api_mealportion, portion_to_api_portion, make_mealportion_handle, dumps
+from tapi.utils import CalorieBuilder, get_page_limit, keyset_page, add_control_next_page
+from tapi.utils import error_400, error_400_query, error_404, error_409, error_415
 from tapi.constants import MASON, NS
+from tapi.validation import compile_schema
 from tapi import db
 from tapi.api import api
+from tapi.urls import resource_url
+from tapi.conditional import conditional_get
+from tapi.querybudget import query_budget
 
 
 # MealItem type specific helper functions
@@ -42,18 +48,45 @@ def mealportion_schema():
     return schema
 
 
+# Checked once at startup, reused for every request
+MEALPORTION_VALIDATOR = compile_schema(mealportion_schema())
+
+
 def add_control_edit_mealportion(resp, meal, handle):
     resp.add_control(
         NS + ":edit-mealportion",
-        href=api.url_for(MealPortionItem, meal=meal, handle=handle),
+        href=resource_url(MealPortionItem, meal=meal, handle=handle),
         method="PUT",
         # TODO: json or should it be application/json?
         encoding="json",
         title="Edits a MealPortion",
-        schema=mealportion_schema()
+        schema=MEALPORTION_VALIDATOR.schema
     )
 
 
+def load_meal_with_portions(handle):
+    # the meal, its mealportions and their portions with two queries, whatever the meal size
+    return Meal.query \
+        .options(selectinload(Meal.portions).joinedload(MealPortion.portion)) \
+        .filter(Meal.id == handle).first()
+
+
+def mealportion_collection_item(mealportion):
+    # mealportion with its portion embedded, the portion must be loaded already
+    m = mealportion_to_api_mealportion(mealportion)
+    p = portion_to_api_portion(mealportion.portion)
+    p.add_control_self(resource_url(PortionItem, handle=mealportion.portion_id))
+    m['portion'] = p
+    m.add_control_self(resource_url(
+        MealPortionItem, meal=mealportion.meal_id,
+        handle=make_mealportion_handle(mealportion.meal_id, mealportion.portion_id)))
+    return m
+
+
+def mealportion_collection_items(meal):
+    return [mealportion_collection_item(mp) for mp in sorted(meal.portions, key=lambda mp: mp.portion_id)]
+
+
 def decode_handle(meal, handle):
     d = handle.split(meal + '-')
     return meal, d[1]
@@ -61,6 +94,8 @@ def decode_handle(meal, handle):
 
 class MealPortionItem(Resource):
     @classmethod
+    @query_budget(3)
+    @conditional_get('meal_portion')
     def get(cls, meal, handle):
         # MealPortion
         meal_id, portion_id = decode_handle(meal, handle)
@@ -72,16 +107,62 @@ class MealPortionItem(Resource):
             return error_404()
         resp = mealportion_to_api_mealportion(mealportion)
 
-        resp.add_control_collection(api.url_for(MealItem, handle=meal_id) + "mealportions/")
-        resp.add_control_delete(api.url_for(MealPortionItem, meal=meal, handle=handle))
+        resp.add_control_collection(resource_url(MealItem, handle=meal_id) + "mealportions/")
+        resp.add_control_delete(resource_url(MealPortionItem, meal=meal, handle=handle))
         resp.add_control_profile()
         add_control_edit_mealportion(resp, meal, handle)
 
-        resp.add_control_self(api.url_for(MealPortionItem, meal=meal, handle=handle))
+        resp.add_control_self(resource_url(MealPortionItem, meal=meal, handle=handle))
+        add_calorie_namespace(resp)
+        return Response(dumps(resp), 200, headers=add_mason_response_header())
+
+    @classmethod
+    @conditional_get('meal', 'meal_portion', 'portion')
+    def get_collection(cls, handle):
+        # MealPortions of a meal, each with its Portion
+        meal = load_meal_with_portions(handle)
+        if meal is None:
+            return error_404()
+        resp = CalorieBuilder(items=mealportion_collection_items(meal))
+        resp.add_control_self(resource_url(MealItem, handle=handle) + "mealportions/")
+        resp.add_control(NS + ':meal', resource_url(MealItem, handle=handle))
+        add_calorie_namespace(resp)
+        return Response(dumps(resp), 200, headers=add_mason_response_header())
+
+    @classmethod
+    @conditional_get('meal', 'meal_portion', 'portion')
+    def get_meals_for_portion(cls, handle):
+        # Meals using a portion in the order they were created, paginated by meal pk, a
+        # range scan of the (portion_pk, meal_pk) index. The cursor is the meal handle
+        after = request.args.get('after')
+        # the portion handle and the cursor to keys with one query
+        portion_pk, after_pk = db.session.query(
+            select(Portion.pk).where(Portion.id == handle).scalar_subquery(),
+            select(Meal.pk).where(Meal.id == after).scalar_subquery()).one()
+        if portion_pk is None:
+            return error_404()
+        limit = get_page_limit()
+        if limit is None or (after is not None and after_pk is None):
+            return error_400_query()
+        query = db.session.query(Meal, MealPortion.weight_per_serving) \
+            .join(MealPortion, MealPortion.meal_pk == Meal.pk) \
+            .filter(MealPortion.portion_pk == portion_pk)
+        rows, has_more = keyset_page(query, [MealPortion.meal_pk], None if after is None else [after_pk], limit)
+        items = []
+        for meal, weight_per_serving in rows:
+            m = meal_collection_item(meal)
+            m['weight_per_serving'] = weight_per_serving
+            items.append(m)
+        resp = CalorieBuilder(items=items)
+        if has_more:
+            add_control_next_page(resp, rows[-1][0].id, limit)
+        resp.add_control_self(resource_url(PortionItem, handle=handle) + "meals/")
+        resp.add_control(NS + ':portion', resource_url(PortionItem, handle=handle))
         add_calorie_namespace(resp)
-        return Response(json.dumps(resp), 200, headers=add_mason_response_header())
+        return Response(dumps(resp), 200, headers=add_mason_response_header())
 
     @classmethod
+    @query_budget(7)
     def post(cls, handle):
         try:
             if request.content_type != "application/json" or request.json is None:
@@ -90,8 +171,8 @@ class MealPortionItem(Resource):
             return error_415()
 
         try:
-            validate(request.json, schema=mealportion_schema())
-        except (SchemaError, ValidationError):
+            MEALPORTION_VALIDATOR.validate(request.json)
+        except ValidationError:
             return error_400()
 
         meal_id = handle
@@ -121,6 +202,7 @@ class MealPortionItem(Resource):
         )
 
     @classmethod
+    @query_budget(7)
     def put(cls, meal, handle):
         try:
             if request.content_type != "application/json" or request.json is None:
@@ -129,8 +211,8 @@ class MealPortionItem(Resource):
             return error_415()
 
         try:
-            validate(request.json, schema=mealportion_schema())
-        except (SchemaError, ValidationError):
+            MEALPORTION_VALIDATOR.validate(request.json)
+        except ValidationError:
             return error_400()
 
         meal_id, portion_id = decode_handle(meal, handle)
@@ -157,6 +239,7 @@ class MealPortionItem(Resource):
         )
 
     @classmethod
+    @query_budget(7)
     def delete(cls, meal, handle):
         meal_id, portion_id = decode_handle(meal, handle)
         mealportion = MealPortion.query.filter(
@@ -1,19 +1,29 @@
-import json
+import csv
 import datetime
+import io
 
 from flask import Response, request
 from flask_restful import Resource
-from jsonschema import validate, SchemaError, ValidationError
+from jsonschema import ValidationError
+from sqlalchemy import func, insert, literal, select
 from sqlalchemy.exc import IntegrityError
 from werkzeug.exceptions import BadRequest
 
-from tapi.models import MealRecord
-from tapi.utils import add_mason_response_header, add_calorie_namespace, mealrecord_to_api_mealrecord, myconverter
-from tapi.utils import CalorieBuilder, make_mealrecord_handle
-from tapi.utils import error_400, error_404, error_409, error_415
-from tapi.constants import MASON, NS
+from tapi.models import MealRecord, MealNutrients, Person, Meal
+from tapi.utils import add_mason_response_header, add_calorie_namespace, mealrecord_to_api_mealrecord, dumps
+from tapi.utils import CalorieBuilder, make_mealrecord_handle, get_page_limit, keyset_page, add_control_next_page
+from tapi.utils import stream_requested, keyset_stream, chunked, StreamedItems, stream_mason_response
+from tapi.utils import MasonBuilder, error_400, error_400_query, error_404, error_409, error_415
+from tapi.utils import stream_export_response
+from tapi.constants import MASON, NS, STREAM_CHUNK_SIZE, STREAM_BUFFER_SIZE, MAX_BATCH_SIZE, EXPORT_FORMATS
+from tapi.constants import ROUTE_ENTRYPOINT, ROUTE_MEALRECORD_BATCH, ROUTE_PERSON_MEALRECORD_EXPORT
+from tapi.nutrition import NUTRIENTS, meal_nutrients, mealrecord_nutrients, mealrecord_deltas, apply_daily_intake_deltas
+from tapi.validation import compile_schema
 from tapi import db
 from tapi.api import api
+from tapi.urls import resource_url
+from tapi.conditional import conditional_get
+from tapi.querybudget import query_budget
 
 
 # MealRecord type specific helper functions
@@ -47,6 +57,10 @@ def mealrecord_schema():
     return schema
 
 
+# Checked once at startup, reused for every request
+MEALRECORD_VALIDATOR = compile_schema(mealrecord_schema())
+
+
 def split_mealrecord_handle(meal, handle):
     # deparse handle to make parameters
     meal = meal
@@ -57,55 +71,222 @@ def split_mealrecord_handle(meal, handle):
     return person, meal, timestamp
 
 
+def make_mealrecord_cursor(mealrecord):
+    # keyset pagination cursor: meal and the mealrecord handle, '/' is not allowed in the ids
+    return mealrecord.meal_id + '/' + make_mealrecord_handle(mealrecord.person_id,
+                                                             mealrecord.meal_id,
+                                                             mealrecord.timestamp)
+
+
+def split_mealrecord_cursor(cursor):
+    # deparse cursor to (person, meal, timestamp), raises ValueError for invalid cursor
+    if cursor is None:
+        return None
+    meal, handle = cursor.split('/', 1)
+    return split_mealrecord_handle(meal, handle)
+
+
+def handle_pks(person_id, meal_id):
+    # (person pk, meal pk) of the handles with one query, None if either one is not found
+    row = db.session.query(
+        select(Person.pk).where(Person.id == person_id).scalar_subquery(),
+        select(Meal.pk).where(Meal.id == meal_id).scalar_subquery()).one()
+    return None if None in row else tuple(row)
+
+
+def parse_timestamp_arg(name):
+    # timestamp query parameter in the API format or in ISO 8601, raises ValueError if invalid.
+    # The MealRecord timestamps have no time zone, a value with an offset is invalid: SQLite
+    # would compare it as if the offset was not there
+    value = request.args.get(name)
+    if value is None:
+        return None
+    try:
+        return datetime.datetime.strptime(value, '%Y-%m-%d %H:%M:%S.%f')
+    except ValueError:
+        timestamp = datetime.datetime.fromisoformat(value)
+    if timestamp.tzinfo is not None:
+        raise ValueError("{} has a time zone".format(name))
+    return timestamp
+
+
 def add_control_add_mealrecord(resp):
     resp.add_control(
         NS + ":add-mealrecord",
-        href=api.url_for(MealRecordItem, meal=None, handle=None),
+        href=resource_url(MealRecordItem, meal=None, handle=None),
         method="POST",
         # TODO: json or should it be application/json?
         encoding="json",
         title="Creates a new MealRecord",
-        schema=mealrecord_schema()
+        schema=MEALRECORD_VALIDATOR.schema
     )
 
 
+def add_control_add_mealrecords(resp):
+    resp.add_control(
+        NS + ":add-mealrecords",
+        href=ROUTE_ENTRYPOINT + ROUTE_MEALRECORD_BATCH,
+        method="POST",
+        encoding="json",
+        title="Creates many MealRecords in one transaction",
+        schema={"type": "array", "maxItems": MAX_BATCH_SIZE, "items": MEALRECORD_VALIDATOR.schema}
+    )
+
+
+def batch_item_error(index, status, title, details):
+    # result of a batch item that was not created, the same error as a single POST gives
+    item = MasonBuilder(index=index, status=status)
+    item.add_error(title, details)
+    return item
+
+
 def add_control_edit_mealrecord(resp, meal, handle):
     resp.add_control(
         NS + ":edit-mealrecord",
-        href=api.url_for(MealRecordItem, meal=meal, handle=handle),
+        href=resource_url(MealRecordItem, meal=meal, handle=handle),
         method="PUT",
         # TODO: json or should it be application/json?
         encoding="json",
         title="Edits a MealRecord",
-        schema=mealrecord_schema()
+        schema=MEALRECORD_VALIDATOR.schema
+    )
+
+
+def mealrecord_collection_items(mealrecords):
+    # collection items with nutrients, meal nutrients are queried once per chunk of records
+    per_serving = {}
+    for chunk in chunked(mealrecords, STREAM_CHUNK_SIZE):
+        per_serving.update(meal_nutrients({m.meal_pk for m in chunk} - per_serving.keys()))
+        for mealrecord in chunk:
+            m = mealrecord_to_api_mealrecord(mealrecord)
+            m['nutrients'] = mealrecord_nutrients(mealrecord, per_serving[mealrecord.meal_pk])
+            m.add_control_collection(resource_url(MealRecordItem, meal=None, handle=None))
+            yield m
+
+
+def add_control_export_mealrecords(resp, person_id):
+    resp.add_control(
+        NS + ":export-mealrecords",
+        href=ROUTE_ENTRYPOINT + ROUTE_PERSON_MEALRECORD_EXPORT.replace('<handle>', person_id) +
+        "{?format,nutrients,from,to}",
+        isHrefTemplate=True,
+        title="Downloads all the MealRecords of the person as NDJSON or CSV"
     )
 
 
+def mealrecord_export_rows(person, time_from, time_to, with_nutrients):
+    """ The MealRecords of a person in time order as rows, read from the database a chunk
+    at a time. With nutrients the rows have the nutrients of the record computed by SQL """
+    columns = [literal(person.id).label('person_id'), Meal.id, MealRecord.amount, MealRecord.timestamp]
+    query = select(*columns).join(Meal, Meal.pk == MealRecord.meal_pk).where(MealRecord.person_pk == person.pk)
+    if with_nutrients:
+        query = query.add_columns(*[func.coalesce(MealRecord.amount * getattr(MealNutrients, n), 0).label(n)
+                                    for n in NUTRIENTS]) \
+            .outerjoin(MealNutrients, MealNutrients.meal_pk == MealRecord.meal_pk)
+    if time_from is not None:
+        query = query.where(MealRecord.timestamp >= time_from)
+    if time_to is not None:
+        query = query.where(MealRecord.timestamp < time_to)
+    query = query.order_by(MealRecord.timestamp, MealRecord.meal_pk)
+    return db.session.execute(query.execution_options(yield_per=STREAM_CHUNK_SIZE))
+
+
+def ndjson_export(rows, with_nutrients):
+    # one JSON object per line, the fields of the MealRecord items
+    for person_id, meal_id, amount, timestamp, *nutrients in rows:
+        item = {'person_id': person_id, 'meal_id': meal_id, 'amount': amount, 'timestamp': str(timestamp)}
+        if with_nutrients:
+            item['nutrients'] = dict(zip(NUTRIENTS, nutrients))
+        yield dumps(item) + b'\n'
+
+
+def csv_export(rows, with_nutrients):
+    # a header line and one line per MealRecord, written out a buffer at a time
+    out = io.StringIO()
+    writer = csv.writer(out, lineterminator='\n')
+    writer.writerow(['person_id', 'meal_id', 'amount', 'timestamp'] + (NUTRIENTS if with_nutrients else []))
+    for person_id, meal_id, amount, timestamp, *nutrients in rows:
+        writer.writerow([person_id, meal_id, amount, str(timestamp)] + nutrients)
+        if out.tell() >= STREAM_BUFFER_SIZE:
+            yield out.getvalue().encode('utf-8')
+            out.seek(0)
+            out.truncate()
+    yield out.getvalue().encode('utf-8')
+
+
+EXPORT_WRITERS = {'ndjson': ndjson_export, 'csv': csv_export}
+
+
 class MealRecordItem(Resource):
     """ MealRecordItem serves: Individual MealRecordItem,MealRecord Collection ans MealRecord by person.
     If handle is missing, the MealRecord Collection is returned. If handle is
     given, the corresponding MealRecord is returned (if found from the DB)
-    TODO: If handle is missing but person is given, MealRecords by person are returned. """
+    If handle is missing but person is given, MealRecords by person are returned
+    in time order (?order=asc|desc), limited with ?from= and ?to= if given. Like the
+    MealRecord timestamps, these have no time zone, a UTC offset is a 400.
+    Collections are paginated with ?limit= and ?after= (see 'next' control),
+    ?stream=true streams all of it """
 
     @classmethod
+    @query_budget(4)
+    @conditional_get('meal_record', 'person', 'meal', 'meal_portion', 'portion')
     def get(cls, meal=None, handle=None, person_id=None):
 
-        if handle is None and person_id is not None:
-            resp = CalorieBuilder(items=[])
-            for mealrecord in MealRecord.query.filter(MealRecord.person_id == person_id):
-               m = mealrecord_to_api_mealrecord(mealrecord)
-               m.add_control_collection(api.url_for(MealRecordItem, meal=None, handle=None))
-               resp['items'].append(m)
-            add_control_add_mealrecord(resp)
-
-        elif handle is None:
-            # MealRecord collection
-            resp = CalorieBuilder(items=[])
-            for mealrecord in MealRecord.query.all():
-                m = mealrecord_to_api_mealrecord(mealrecord)
-                m.add_control_collection(api.url_for(MealRecordItem, meal=None, handle=None))
-                resp['items'].append(m)
-            add_control_add_mealrecord(resp)
+        if handle is None:
+            # MealRecord collection or MealRecords by person, one page at a time or streamed
+            try:
+                after = split_mealrecord_cursor(request.args.get('after'))
+            except ValueError:
+                return error_400_query()
+            if after is not None:
+                # the handles of the cursor to keys
+                pks = handle_pks(after[0], after[1])
+                if pks is None:
+                    return error_400_query()
+                after = [pks[0], pks[1], after[2]]
+            query = MealRecord.query
+            descending = False
+            if person_id is None:
+                columns = [MealRecord.person_pk, MealRecord.meal_pk, MealRecord.timestamp]
+            else:
+                # MealRecords by person in time order, optionally only the ones in [from, to)
+                try:
+                    time_from = parse_timestamp_arg('from')
+                    time_to = parse_timestamp_arg('to')
+                except ValueError:
+                    return error_400_query()
+                order = request.args.get('order', 'asc')
+                if order not in ('asc', 'desc'):
+                    return error_400_query()
+                descending = order == 'desc'
+
+                query = query.filter(MealRecord.person_id == person_id)
+                if time_from is not None:
+                    query = query.filter(MealRecord.timestamp >= time_from)
+                if time_to is not None:
+                    query = query.filter(MealRecord.timestamp < time_to)
+                columns = [MealRecord.timestamp, MealRecord.meal_pk]
+                if after is not None:
+                    after = [after[2], after[1]]
+            if stream_requested():
+                mealrecords = keyset_stream(query, columns, after, descending)
+                resp = CalorieBuilder(items=StreamedItems(mealrecord_collection_items(mealrecords)))
+                add_control_add_mealrecord(resp)
+                add_control_add_mealrecords(resp)
+                if person_id is not None:
+                    add_control_export_mealrecords(resp, person_id)
+            else:
+                limit = get_page_limit()
+                if limit is None:
+                    return error_400_query()
+                mealrecords, has_more = keyset_page(query, columns, after, limit, descending)
+                resp = CalorieBuilder(items=list(mealrecord_collection_items(mealrecords)))
+                add_control_add_mealrecord(resp)
+                add_control_add_mealrecords(resp)
+                if person_id is not None:
+                    add_control_export_mealrecords(resp, person_id)
+                if has_more:
+                    add_control_next_page(resp, make_mealrecord_cursor(mealrecords[-1]), limit)
         else:
             # MealRecord item
             person, meal_id, timestamp = split_mealrecord_handle(meal, handle)
@@ -116,22 +297,51 @@ class MealRecordItem(Resource):
             if mealrecord is None:
                 return error_404()
             resp = mealrecord_to_api_mealrecord(mealrecord)
-            resp.add_control_collection(api.url_for(MealRecordItem, meal=None, handle=None))
-            resp.add_control_delete(api.url_for(MealRecordItem, meal=meal, handle=handle))
+            per_serving = meal_nutrients([mealrecord.meal_pk])
+            resp['nutrients'] = mealrecord_nutrients(mealrecord, per_serving[mealrecord.meal_pk])
+            resp.add_control_collection(resource_url(MealRecordItem, meal=None, handle=None))
+            resp.add_control_delete(resource_url(MealRecordItem, meal=meal, handle=handle))
             resp.add_control_profile()
             add_control_edit_mealrecord(resp, meal, handle)
 
         # Common fields for mealrecord item and mealrecord collection
-        resp.add_control_self(api.url_for(MealRecordItem, meal=meal, handle=handle))
-        resp.add_control(NS+':mealrecords-all', api.url_for(MealRecordItem, meal=None, handle=None))
+        resp.add_control_self(resource_url(MealRecordItem, meal=meal, handle=handle))
+        resp.add_control(NS+':mealrecords-all', resource_url(MealRecordItem, meal=None, handle=None))
         add_calorie_namespace(resp)
-        return Response(json.dumps(resp, default=myconverter), 200, headers=add_mason_response_header())
+        if isinstance(resp.get('items'), StreamedItems):
+            return stream_mason_response(resp)
+        return Response(dumps(resp), 200, headers=add_mason_response_header())
 
     @classmethod
     def get_records_for_person(cls, person_id):
         return MealRecordItem.get(person_id=person_id)
 
     @classmethod
+    @conditional_get('meal_record', 'person', 'meal', 'meal_portion', 'portion')
+    def get_export(cls, person_id):
+        """ All the MealRecords of a person in time order as ?format=ndjson (default) or csv,
+        with the nutrients of each record if ?nutrients=true. Limited with ?from= and ?to=
+        like the MealRecords by person. The rows are streamed as they are read """
+        export_format = request.args.get('format', 'ndjson')
+        with_nutrients = request.args.get('nutrients', '').lower() in ('1', 'true')
+        if export_format not in EXPORT_FORMATS:
+            return error_400_query()
+        try:
+            time_from = parse_timestamp_arg('from')
+            time_to = parse_timestamp_arg('to')
+        except ValueError:
+            return error_400_query()
+        person = Person.query.filter(Person.id == person_id).first()
+        if person is None:
+            return error_404()
+
+        rows = mealrecord_export_rows(person, time_from, time_to, with_nutrients)
+        return stream_export_response(EXPORT_WRITERS[export_format](rows, with_nutrients),
+                                      EXPORT_FORMATS[export_format],
+                                      "{}-mealrecords.{}".format(person_id, export_format))
+
+    @classmethod
+    @query_budget(6)
     def post(cls):
         try:
             if request.content_type != "application/json" or request.json is None:
@@ -140,8 +350,8 @@ class MealRecordItem(Resource):
             return error_415()
 
         try:
-            validate(request.json, schema=mealrecord_schema())
-        except (SchemaError, ValidationError):
+            MEALRECORD_VALIDATOR.validate(request.json)
+        except ValidationError:
             return error_400()
 
         mealrecord_person = request.json['person_id']
@@ -177,6 +387,83 @@ class MealRecordItem(Resource):
         )
 
     @classmethod
+    def post_batch(cls):
+        """ Creates an array of MealRecords with one multi-row INSERT and one commit.
+        Every item gets its own status: 201 created, 400 invalid, 404 unknown person or
+        meal, or 409 if the MealRecord exists already or is twice in the batch """
+        try:
+            if request.content_type != "application/json" or request.json is None:
+                return error_415()
+        except BadRequest:
+            return error_415()
+
+        items = request.json
+        if not isinstance(items, list) or len(items) > MAX_BATCH_SIZE:
+            return error_400()
+
+        results = [None] * len(items)
+        rows = {}
+        for index, item in enumerate(items):
+            try:
+                MEALRECORD_VALIDATOR.validate(item)
+                timestamp = datetime.datetime.strptime(item['timestamp'], '%Y-%m-%d %H:%M:%S.%f')
+            except (ValidationError, ValueError):
+                results[index] = batch_item_error(
+                    index, 400, "Invalid JSON", "Request JSON does not follow the jsonschema.")
+                continue
+            key = (item['person_id'], item['meal_id'], timestamp)
+            if key in rows:
+                results[index] = batch_item_error(
+                    index, 409, "Already exists!", "Entity with given handle is twice in the batch.")
+                continue
+            rows[key] = (index, item['amount'])
+
+        # Persons, meals and existing MealRecords of the whole batch with three queries
+        persons = dict(db.session.query(Person.id, Person.pk).filter(Person.id.in_({key[0] for key in rows})))
+        meals = dict(db.session.query(Meal.id, Meal.pk).filter(Meal.id.in_({key[1] for key in rows})))
+        existing = set(db.session.query(MealRecord.person_pk, MealRecord.meal_pk, MealRecord.timestamp)
+                       .filter(MealRecord.person_pk.in_(persons.values()),
+                               MealRecord.timestamp.in_({key[2] for key in rows})))
+
+        new_rows = []
+        for key, (index, amount) in rows.items():
+            person_id, meal_id, timestamp = key
+            if person_id not in persons or meal_id not in meals:
+                results[index] = batch_item_error(
+                    index, 404, "Not found!", "Person or Meal not found with given handle.")
+            elif (persons[person_id], meals[meal_id], timestamp) in existing:
+                results[index] = batch_item_error(
+                    index, 409, "Already exists!", "Entity with given handle already exists.")
+            else:
+                new_rows.append({'person_pk': persons[person_id], 'meal_pk': meals[meal_id],
+                                 'amount': amount, 'timestamp': timestamp})
+                results[index] = CalorieBuilder(index=index, status=201)
+                results[index].add_control_self(resource_url(
+                    MealRecordItem, meal=meal_id, handle=make_mealrecord_handle(person_id, meal_id, timestamp)))
+
+        if new_rows:
+            try:
+                # the multi-row INSERT runs at once, a record created by another request
+                # after the check above fails it here and not at the commit
+                db.session.execute(insert(MealRecord), new_rows)
+                # the bulk insert skips the flush hooks, so the daily totals are added here
+                records = [(r['person_pk'], r['meal_pk'], r['amount'], r['timestamp'], 1) for r in new_rows]
+                per_serving = meal_nutrients({r['meal_pk'] for r in new_rows})
+                apply_daily_intake_deltas(db.session.connection(), mealrecord_deltas(records, per_serving))
+                db.session.commit()
+            except IntegrityError:
+                # Another request created some of them in between, nothing was created
+                db.session.rollback()
+                return error_409()
+
+        resp = CalorieBuilder(items=results)
+        resp.add_control_self(ROUTE_ENTRYPOINT + ROUTE_MEALRECORD_BATCH)
+        resp.add_control(NS + ':mealrecords-all', resource_url(MealRecordItem, meal=None, handle=None))
+        add_calorie_namespace(resp)
+        return Response(dumps(resp), 200, headers=add_mason_response_header())
+
+    @classmethod
+    @query_budget(5)
     def put(cls, meal, handle):
         try:
             if request.content_type != "application/json" or request.json is None:
@@ -185,8 +472,8 @@ class MealRecordItem(Resource):
             return error_415()
 
         try:
-            validate(request.json, schema=mealrecord_schema())
-        except (SchemaError, ValidationError):
+            MEALRECORD_VALIDATOR.validate(request.json)
+        except ValidationError:
             return error_400()
 
         person, meal_id, timestamp = split_mealrecord_handle(meal, handle)
@@ -217,6 +504,7 @@ class MealRecordItem(Resource):
         )
 
     @classmethod
+    @query_budget(4)
     def delete(cls, meal, handle=None):
         person, meal_id, timestamp = split_mealrecord_handle(meal, handle)
 
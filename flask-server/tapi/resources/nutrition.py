@@ -0,0 +1,72 @@
+import datetime
+from urllib.parse import urlencode
+
+from flask import Response, request
+from flask_restful import Resource
+
+from tapi.models import Person
+from tapi.nutrition import person_nutrients, person_daily_nutrients
+from tapi.resources.mealrecord import parse_timestamp_arg
+from tapi.utils import add_mason_response_header, add_calorie_namespace, dumps
+from tapi.utils import CalorieBuilder
+from tapi.utils import error_400_query, error_404
+from tapi.constants import NS, ROUTE_ENTRYPOINT, ROUTE_PERSON_COLLECTION
+from tapi.urls import resource_url
+from tapi.conditional import conditional_get
+from tapi.querybudget import query_budget
+
+
+def parse_nutrition_range():
+    # [from, to) from ?from= and ?to=, or the whole ?day= (today by default)
+    day = request.args.get('day')
+    if 'from' in request.args or 'to' in request.args:
+        time_from = parse_timestamp_arg('from')
+        time_to = parse_timestamp_arg('to')
+        if day is not None or time_from is None or time_to is None:
+            raise ValueError("give either day or both from and to")
+        return time_from, time_to
+    day = datetime.date.today() if day is None else datetime.date.fromisoformat(day)
+    time_from = datetime.datetime.combine(day, datetime.time())
+    return time_from, time_from + datetime.timedelta(days=1)
+
+
+def add_control_mealrecords_in_range(resp, handle, time_from, time_to):
+    resp.add_control(NS + ':mealrecords-by', "{}{}{}/mealrecords/?{}".format(
+        ROUTE_ENTRYPOINT,
+        ROUTE_PERSON_COLLECTION,
+        handle,
+        urlencode({'from': str(time_from), 'to': str(time_to)})))
+
+
+class NutritionItem(Resource):
+    """ NutritionItem serves the nutrient totals of the MealRecords of a person for a day
+    (?day=YYYY-MM-DD, today if not given) or for a time range [?from=, ?to=). The totals
+    are summed in the database, so the client needs no walk through meals and portions """
+    @classmethod
+    @query_budget(3)
+    @conditional_get('meal_record', 'person', 'meal', 'meal_portion', 'portion', vary=datetime.date.today)
+    def get(cls, handle):
+        person = Person.query.filter(Person.id == handle).first()
+        if person is None:
+            return error_404()
+        try:
+            time_from, time_to = parse_nutrition_range()
+        except ValueError:
+            return error_400_query()
+
+        resp = CalorieBuilder({
+            'person_id': person.id,
+            'from': str(time_from),
+            'to': str(time_to)
+        })
+        if time_from.time() == time_to.time() == datetime.time():
+            # whole days, a DailyIntake row per day
+            resp.update(person_daily_nutrients(person.pk, time_from.date(), time_to.date()))
+        else:
+            resp.update(person_nutrients(person.pk, time_from, time_to))
+
+        resp.add_control_self(resource_url(NutritionItem, handle=handle))
+        resp.add_control_profile()
+        add_control_mealrecords_in_range(resp, handle, time_from, time_to)
+        add_calorie_namespace(resp)
+        return Response(dumps(resp), 200, headers=add_mason_response_header())
@@ -1,18 +1,22 @@
-import json
-
 from flask import Response, request
 from flask_restful import Resource
-from jsonschema import validate, SchemaError, ValidationError
+from jsonschema import ValidationError
+from sqlalchemy import delete
 from sqlalchemy.exc import IntegrityError
 from werkzeug.exceptions import BadRequest
 
-from tapi.models import Person
-from tapi.utils import add_mason_response_header, add_calorie_namespace, person_to_api_person
-from tapi.utils import CalorieBuilder
-from tapi.utils import error_400, error_404, error_409, error_415
+from tapi.models import ActivityRecord, DailyIntake, MealRecord, Person
+from tapi.utils import add_mason_response_header, add_calorie_namespace, person_to_api_person, dumps
+from tapi.utils import CalorieBuilder, get_page_limit, keyset_page, add_control_next_page
+from tapi.utils import stream_requested, keyset_stream, StreamedItems, stream_mason_response
+from tapi.utils import error_400, error_400_query, error_404, error_409, error_415
 from tapi.constants import MASON, NS, ROUTE_ENTRYPOINT, ROUTE_PERSON_COLLECTION
+from tapi.validation import compile_schema
 from tapi import db
 from tapi.api import api
+from tapi.urls import resource_url
+from tapi.conditional import conditional_get
+from tapi.querybudget import query_budget
 
 
 # PersonItem type specific helper functions
@@ -31,14 +35,18 @@ def person_schema():
     return schema
 
 
+# Checked once at startup, reused for every request
+PERSON_VALIDATOR = compile_schema(person_schema())
+
+
 def add_control_add_person(resp):
     resp.add_control(
         NS + ":add-person",
-        href=api.url_for(PersonItem, handle=None),
+        href=resource_url(PersonItem, handle=None),
         method="POST",
         encoding="json",
         title="Creates a new Person",
-        schema=person_schema()
+        schema=PERSON_VALIDATOR.schema
     )
 
 
@@ -49,37 +57,66 @@ def add_control_mealrecords(resp, handle):
         handle))
 
 
+def add_control_nutrition(resp, handle):
+    resp.add_control(NS + ':nutrition', "{}{}{}/nutrition/".format(
+        ROUTE_ENTRYPOINT,
+        ROUTE_PERSON_COLLECTION,
+        handle))
+
+
+def person_collection_item(person):
+    p = person_to_api_person(person)
+    p.add_control_collection(resource_url(PersonItem, handle=None))
+    return p
+
+
 class PersonItem(Resource):
     """ PersonItem servers both: Individual PersonItem and Person Collection
     If given handle is missing, the Person Collection is returned. If handle is
-    given, the corresponding PersonItem is returned (if found from the DB) """
+    given, the corresponding PersonItem is returned (if found from the DB)
+    Collections are paginated with ?limit= and ?after=, ?stream=true streams all of it """
     @classmethod
+    @query_budget(2)
+    @conditional_get('person')
     def get(cls, handle=None):
         if handle is None:
-            # Person collection
-            resp = CalorieBuilder(items=[])
-            for person in Person.query.all():
-                p = person_to_api_person(person)
-                p.add_control_collection(api.url_for(PersonItem, handle=None))
-                resp['items'].append(p)
-            add_control_add_person(resp)
+            # Person collection, one page at a time or streamed as a whole
+            after = request.args.get('after')
+            after = None if after is None else [after]
+            if stream_requested():
+                persons = keyset_stream(Person.query, [Person.id], after)
+                resp = CalorieBuilder(items=StreamedItems(map(person_collection_item, persons)))
+                add_control_add_person(resp)
+            else:
+                limit = get_page_limit()
+                if limit is None:
+                    return error_400_query()
+                persons, has_more = keyset_page(Person.query, [Person.id], after, limit)
+                resp = CalorieBuilder(items=[person_collection_item(person) for person in persons])
+                add_control_add_person(resp)
+                if has_more:
+                    add_control_next_page(resp, persons[-1].id, limit)
         else:
             # Person item
             person = Person.query.filter(Person.id == handle).first()
             if person is None:
                 return error_404()
             resp = person_to_api_person(person)
-            resp.add_control_collection(api.url_for(PersonItem, handle=None))
-            resp.add_control_delete(api.url_for(PersonItem, handle=handle))
+            resp.add_control_collection(resource_url(PersonItem, handle=None))
+            resp.add_control_delete(resource_url(PersonItem, handle=handle))
             add_control_mealrecords(resp, handle)
+            add_control_nutrition(resp, handle)
 
         # Common fields for person item and person collection
-        resp.add_control_self(api.url_for(PersonItem, handle=handle))
-        resp.add_control(NS+':persons-all', api.url_for(PersonItem, handle=None))
+        resp.add_control_self(resource_url(PersonItem, handle=handle))
+        resp.add_control(NS+':persons-all', resource_url(PersonItem, handle=None))
         add_calorie_namespace(resp)
-        return Response(json.dumps(resp), 200, headers=add_mason_response_header())
+        if isinstance(resp.get('items'), StreamedItems):
+            return stream_mason_response(resp)
+        return Response(dumps(resp), 200, headers=add_mason_response_header())
 
     @classmethod
+    @query_budget(2)
     def post(cls):
         try:
             if request.content_type != "application/json" or request.json is None:
@@ -88,8 +125,8 @@ class PersonItem(Resource):
             return error_415()
 
         try:
-            validate(request.json, schema=person_schema())
-        except (SchemaError, ValidationError):
+            PERSON_VALIDATOR.validate(request.json)
+        except ValidationError:
             return error_400()
 
         person_id = request.json['id']
@@ -110,10 +147,15 @@ class PersonItem(Resource):
         )
 
     @classmethod
+    @query_budget(8)
     def delete(cls, handle=None):
         person = Person.query.filter(Person.id == handle).first()
         if person is None:
             return error_404()
+        # the records and daily totals in bulk, the cascades then have nothing to load
+        connection = db.session.connection()
+        for model in (MealRecord, ActivityRecord, DailyIntake):
+            connection.execute(delete(model).where(model.person_pk == person.pk))
         db.session.delete(person)
         db.session.commit()
         return Response("DELETED", 204, mimetype=MASON)
@@ -1,18 +1,25 @@
-import json
+import re
 
 from flask import Response, request
 from flask_restful import Resource
-from jsonschema import validate, SchemaError, ValidationError
+from jsonschema import ValidationError
+from sqlalchemy import literal_column, select
 from sqlalchemy.exc import IntegrityError
 from werkzeug.exceptions import BadRequest
 
-from tapi.models import Portion
-from tapi.utils import add_mason_response_header, add_calorie_namespace, portion_to_api_portion
-from tapi.utils import CalorieBuilder
-from tapi.utils import error_400, error_404, error_409, error_415
-from tapi.constants import MASON, NS
+from tapi.models import Portion, PORTION_FTS
+from tapi.utils import add_mason_response_header, add_calorie_namespace, portion_to_api_portion, dumps
+from tapi.utils import CalorieBuilder, get_page_limit, keyset_page, add_control_next_page
+from tapi.utils import stream_requested, keyset_stream, StreamedItems, stream_mason_response
+from tapi.utils import error_400, error_400_query, error_404, error_409, error_415
+from tapi.constants import MASON, NS, SEARCH_CANDIDATES, SEARCH_RANK_ALL_LENGTH
+from tapi.validation import compile_schema
 from tapi import db
 from tapi.api import api
+from tapi.urls import resource_url
+from tapi.conditional import conditional_get
+from tapi.querybudget import query_budget
+from tapi.cache import cached_get
 
 
 # PortionItem type specific helper functions
@@ -65,27 +72,31 @@ def portion_schema():
     return schema
 
 
+# Checked once at startup, reused for every request
+PORTION_VALIDATOR = compile_schema(portion_schema())
+
+
 def add_control_add_portion(resp):
     resp.add_control(
         NS + ":add-portion",
-        href=api.url_for(PortionItem, handle=None),
+        href=resource_url(PortionItem, handle=None),
         method="POST",
         # TODO: json or should it be application/json?
         encoding="json",
         title="Creates a new Portion",
-        schema=portion_schema()
+        schema=PORTION_VALIDATOR.schema
     )
 
 
 def add_control_edit_portion(resp, handle):
     resp.add_control(
         NS + ":edit-portion",
-        href=api.url_for(PortionItem) + handle + '/',
+        href=resource_url(PortionItem, handle=handle),
         method="PUT",
         # TODO: json or should it be application/json?
         encoding="json",
         title="Edits a Portion",
-        schema=portion_schema()
+        schema=PORTION_VALIDATOR.schema
     )
 
 
@@ -98,21 +109,88 @@ def extract_optional_fields(json_data):
     return fields
 
 
+def portion_search_words(q):
+    # the lowercased words of q, FTS5 syntax in q is not interpreted
+    return re.findall(r"\w+", q.lower())
+
+
+def portion_search_expression(words):
+    # FTS5 query where every word must match the start of a word of the name,
+    # e.g. ["olive", "o"] -> "olive"* "o"*
+    return " ".join('"{}"*'.format(word) for word in words)
+
+
+def search_portions(expression, limit, rank_all=True):
+    # best matches first (FTS5 bm25 rank, then the oldest), only the final page is joined
+    # to the portion table. Ranking all the matches costs as much as there are matches,
+    # without rank_all only the first SEARCH_CANDIDATES are ranked
+    matches = select(PORTION_FTS.c.rowid, literal_column("rank").label("rank")) \
+        .where(PORTION_FTS.c.name.match(expression))
+    if rank_all:
+        # ordered in the FTS query itself, FTS5 keeps only the best ?limit= while ranking
+        best = matches.order_by(literal_column("rank"), PORTION_FTS.c.rowid).limit(limit).subquery()
+    else:
+        candidates = matches.limit(SEARCH_CANDIDATES).subquery()
+        best = select(candidates).order_by(candidates.c.rank, candidates.c.rowid).limit(limit).subquery()
+    return Portion.query \
+        .join(best, best.c.rowid == Portion.pk) \
+        .order_by(best.c.rank, best.c.rowid).all()
+
+
+def add_control_search_portions(resp):
+    resp.add_control(
+        NS + ":search-portions",
+        href=resource_url(PortionItem, handle=None) + "?q={q}",
+        isHrefTemplate=True,
+        title="Searches Portions by name"
+    )
+
+
+def portion_collection_item(portion):
+    p = portion_to_api_portion(portion)
+    p.add_control_collection(resource_url(PortionItem, handle=None))
+    p.add_control_delete(resource_url(PortionItem, handle=portion.id))
+    return p
+
+
 class PortionItem(Resource):
     """ PortionItem servers both: Individual PortionItem and Portion Collection
     If given handle is missing, the Portion Collection is returned. If handle is
-    given, the corresponding PortionItem is returned (if found from the DB) """
+    given, the corresponding PortionItem is returned (if found from the DB)
+    Collections are paginated with ?limit= and ?after=, ?stream=true streams all of it.
+    ?q= searches the names by words and word prefixes, best matches first """
     @classmethod
+    @query_budget(2)
+    @cached_get('portion')
+    @conditional_get('portion')
     def get(cls, handle=None):
-        if handle is None:
-            # Portion collection
-            resp = CalorieBuilder(items=[])
-            for portion in Portion.query.all():
-                m = portion_to_api_portion(portion)
-                m.add_control_collection(api.url_for(PortionItem, handle=None))
-                m.add_control_delete(api.url_for(PortionItem, handle=portion.id))
-                resp['items'].append(m)
+        if handle is None and 'q' in request.args:
+            # Portion search, the first ?limit= matches
+            words = portion_search_words(request.args['q'])
+            limit = get_page_limit()
+            if not words or limit is None:
+                return error_400_query()
+            portions = search_portions(portion_search_expression(words), limit,
+                                       rank_all=max(map(len, words)) >= SEARCH_RANK_ALL_LENGTH)
+            resp = CalorieBuilder(items=[portion_collection_item(portion) for portion in portions])
             add_control_add_portion(resp)
+        elif handle is None:
+            # Portion collection, one page at a time or streamed as a whole
+            after = request.args.get('after')
+            after = None if after is None else [after]
+            if stream_requested():
+                portions = keyset_stream(Portion.query, [Portion.id], after)
+                resp = CalorieBuilder(items=StreamedItems(map(portion_collection_item, portions)))
+                add_control_add_portion(resp)
+            else:
+                limit = get_page_limit()
+                if limit is None:
+                    return error_400_query()
+                portions, has_more = keyset_page(Portion.query, [Portion.id], after, limit)
+                resp = CalorieBuilder(items=[portion_collection_item(portion) for portion in portions])
+                add_control_add_portion(resp)
+                if has_more:
+                    add_control_next_page(resp, portions[-1].id, limit)
         else:
             # Portion item
             portion = Portion.query.filter(Portion.id == handle).first()
@@ -120,18 +198,25 @@ class PortionItem(Resource):
                 return error_404()
 
             resp = portion_to_api_portion(portion)
-            resp.add_control_collection(api.url_for(PortionItem, handle=None))
-            resp.add_control_delete(api.url_for(PortionItem, handle=handle))
+            resp.add_control_collection(resource_url(PortionItem, handle=None))
+            resp.add_control_delete(resource_url(PortionItem, handle=handle))
             resp.add_control_profile()
+            resp.add_control(NS + ':meals-using', resource_url(PortionItem, handle=handle) + "meals/")
             add_control_edit_portion(resp, handle)
 
+        if handle is None:
+            add_control_search_portions(resp)
+
         # Common fields for portion item and portion collection
-        resp.add_control_self(api.url_for(PortionItem, handle=handle))
-        resp.add_control(NS+':portions-all', api.url_for(PortionItem, handle=None))
+        resp.add_control_self(resource_url(PortionItem, handle=handle))
+        resp.add_control(NS+':portions-all', resource_url(PortionItem, handle=None))
         add_calorie_namespace(resp)
-        return Response(json.dumps(resp), 200, headers=add_mason_response_header())
+        if isinstance(resp.get('items'), StreamedItems):
+            return stream_mason_response(resp)
+        return Response(dumps(resp), 200, headers=add_mason_response_header())
 
     @classmethod
+    @query_budget(2)
     def post(cls):
         try:
             if request.content_type != "application/json" or request.json is None:
@@ -140,8 +225,8 @@ class PortionItem(Resource):
             return error_415()
 
         try:
-            validate(request.json, schema=portion_schema())
-        except (SchemaError, ValidationError):
+            PORTION_VALIDATOR.validate(request.json)
+        except ValidationError:
             return error_400()
 
         portion_id = request.json['id']
@@ -175,6 +260,7 @@ class PortionItem(Resource):
         )
 
     @classmethod
+    @query_budget(7)
     def put(cls, handle):
         try:
             if request.content_type != "application/json" or request.json is None:
@@ -183,8 +269,8 @@ class PortionItem(Resource):
             return error_415()
 
         try:
-            validate(request.json, schema=portion_schema())
-        except (SchemaError, ValidationError):
+            PORTION_VALIDATOR.validate(request.json)
+        except ValidationError:
             return error_400()
 
         portion = Portion.query.filter(Portion.id == handle).first()
@@ -213,10 +299,16 @@ class PortionItem(Resource):
         )
 
     @classmethod
+    @query_budget(3)
     def delete(cls, handle):
         portion = Portion.query.filter(Portion.id == handle).first()
         if portion is None:
             return error_404()
         db.session.delete(portion)
-        db.session.commit()
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # still used by a meal
+            db.session.rollback()
+            return error_409()
         return Response("DELETED", 204, mimetype=MASON)
@@ -0,0 +1,152 @@
+""" Schema check at startup
+
+Creating the tables and the triggers and filling the rollups is needed only once
+per schema change, not at every boot of every worker. The schema_version table
+tells which SCHEMA_VERSION the database is at. A current database costs one
+query at startup. Otherwise the upgrade runs in an IMMEDIATE transaction, so of
+several workers starting together one upgrades and the others wait and then see
+the new version.
+"""
+from sqlalchemy import bindparam, inspect, select, text
+from sqlalchemy.exc import OperationalError
+
+from tapi import db
+from tapi.models import SchemaVersion
+
+# Increment when the models change, the next startup then upgrades the database
+# 2: integer surrogate keys, see migrate_surrogate_keys()
+# 3: portion_fts rows keyed by the portion pk, see drop_portion_fts()
+# 4: meal_record index by meal, see create_missing_indexes()
+SCHEMA_VERSION = 4
+
+# Tables with string primary keys before version 2, parents first, and the statements
+# that copy their rows into the new tables. The nutrient rollups are rebuilt instead
+STRING_KEY_TABLES = ['person', 'activity', 'meal', 'portion', 'activity_record', 'meal_record',
+                     'meal_portion', 'meal_nutrients', 'daily_intake']
+STRING_KEY_COPIES = {
+    # the pks are given in handle order, the collections keep their order
+    'person': "INSERT INTO person (id) SELECT id FROM person_v1 ORDER BY id",
+    'activity': "INSERT INTO activity (id, name, intensity, description) "
+                "SELECT id, name, intensity, description FROM activity_v1 ORDER BY id",
+    'meal': "INSERT INTO meal (id, name, servings, description) "
+            "SELECT id, name, servings, description FROM meal_v1 ORDER BY id",
+    'portion': "INSERT INTO portion (id, name, calories, density, alcohol, carbohydrate, protein, fat) "
+               "SELECT id, name, calories, density, alcohol, carbohydrate, protein, fat FROM portion_v1 ORDER BY id",
+    'activity_record': "INSERT INTO activity_record (person_pk, activity_pk, duration, timestamp) "
+                       "SELECT p.pk, a.pk, r.duration, r.timestamp FROM activity_record_v1 AS r "
+                       "JOIN person AS p ON p.id = r.person_id JOIN activity AS a ON a.id = r.activity_id",
+    'meal_record': "INSERT INTO meal_record (person_pk, meal_pk, amount, timestamp) "
+                   "SELECT p.pk, m.pk, r.amount, r.timestamp FROM meal_record_v1 AS r "
+                   "JOIN person AS p ON p.id = r.person_id JOIN meal AS m ON m.id = r.meal_id",
+    'meal_portion': "INSERT INTO meal_portion (meal_pk, portion_pk, weight_per_serving) "
+                    "SELECT m.pk, p.pk, mp.weight_per_serving FROM meal_portion_v1 AS mp "
+                    "JOIN meal AS m ON m.id = mp.meal_id JOIN portion AS p ON p.id = mp.portion_id",
+}
+
+
+def current_version(connection):
+    # None for a database without the schema_version table. A Core select, an ORM one
+    # would configure all the mappers here instead of at the first request
+    try:
+        return connection.execute(select(SchemaVersion.__table__.c.version)).scalar()
+    except OperationalError:
+        return None
+
+
+def string_key_tables(connection):
+    # the tables of a database from before version 2, empty if there are none
+    inspector = inspect(connection)
+    if not inspector.has_table('person') or 'pk' in {c['name'] for c in inspector.get_columns('person')}:
+        return []
+    return [table for table in STRING_KEY_TABLES if inspector.has_table(table)]
+
+
+def migrate_surrogate_keys(connection, tables):
+    """ Moves the rows of the string key tables to tables with integer surrogate keys.
+    The old tables are renamed to <table>_v1 with their indexes and triggers dropped, so
+    create_all() makes the new ones, and are dropped once their rows are copied. The
+    handles stay the same """
+    inspector = inspect(connection)
+    for table in tables:
+        for index in inspector.get_indexes(table):
+            connection.execute(text('DROP INDEX "{}"'.format(index['name'])))
+    if connection.dialect.name == "sqlite":
+        triggers = connection.execute(text(
+            "SELECT name FROM sqlite_master WHERE type = 'trigger' AND tbl_name IN :tables")
+            .bindparams(bindparam('tables', expanding=True)), {'tables': tables}).scalars().all()
+        for trigger in triggers:
+            connection.execute(text('DROP TRIGGER "{}"'.format(trigger)))
+    for table in tables:
+        connection.execute(text('ALTER TABLE {0} RENAME TO {0}_v1'.format(table)))
+    db.metadata.create_all(bind=connection)
+    for table in tables:
+        if table in STRING_KEY_COPIES:
+            connection.execute(text(STRING_KEY_COPIES[table]))
+    # children first, the foreign keys of the old tables point to the old tables
+    for table in reversed(tables):
+        connection.execute(text('DROP TABLE {}_v1'.format(table)))
+
+
+def drop_portion_fts(connection):
+    """ Drops the Portion search index and its triggers, create_all() makes them again
+    and fills the index from the portion table """
+    if connection.dialect.name != "sqlite":
+        return
+    from tapi.models import PORTION_FTS_TRIGGERS
+    for trigger in PORTION_FTS_TRIGGERS:
+        connection.execute(text('DROP TRIGGER IF EXISTS "{}"'.format(trigger)))
+    connection.execute(text("DROP TABLE IF EXISTS portion_fts"))
+
+
+def create_missing_indexes(connection):
+    """ Creates the indexes of the models missing from their tables, create_all() adds
+    indexes only with the tables """
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=connection, checkfirst=True)
+
+
+def upgrade_schema(connection):
+    # adds the missing tables (with their triggers) and fills the rollups of the new ones
+    from tapi.nutrition import fill_meal_nutrients, fill_daily_intake
+    tables = string_key_tables(connection)
+    if tables:
+        migrate_surrogate_keys(connection, tables)
+    version = current_version(connection)
+    if version is not None and version < 3:
+        drop_portion_fts(connection)
+    db.metadata.create_all(bind=connection)
+    if version is not None and version < 4:
+        create_missing_indexes(connection)
+    fill_meal_nutrients(connection)
+    fill_daily_intake(connection)
+    connection.execute(SchemaVersion.__table__.delete())
+    connection.execute(SchemaVersion.__table__.insert().values(version=SCHEMA_VERSION))
+
+
+def ensure_schema(engine):
+    """ Upgrades the database to SCHEMA_VERSION if it is not there yet.
+    Returns True if it upgraded """
+    with engine.connect() as connection:
+        if current_version(connection) == SCHEMA_VERSION:
+            return False
+
+    if engine.dialect.name != "sqlite":
+        with engine.begin() as connection:
+            upgrade_schema(connection)
+        return True
+
+    # the SQLite driver would start the transaction at the first write, take the
+    # write lock before checking the version again instead
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        connection.exec_driver_sql("BEGIN IMMEDIATE")
+        try:
+            if current_version(connection) == SCHEMA_VERSION:
+                connection.exec_driver_sql("ROLLBACK")
+                return False
+            upgrade_schema(connection)
+        except BaseException:
+            connection.exec_driver_sql("ROLLBACK")
+            raise
+        connection.exec_driver_sql("COMMIT")
+    return True
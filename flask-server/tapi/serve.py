@@ -0,0 +1,295 @@
+""" Prefork HTTP server for production
+
+`flask run` is one process. `python -m tapi.serve` builds the app once in a parent
+process and forks --workers processes that serve it from the shared listening
+socket, each with --threads request threads:
+
+    python -m tapi.serve --host 0.0.0.0 --port 5000 --workers 4 --threads 4
+
+The children share the memory pages of the parent until they write to them. The
+parent disables the cyclic GC while it builds the app and freezes the GC heap
+before the fork (gc.freeze), so the collections of a worker do not touch, and
+copy, the objects made before the fork: the imported modules, the mappers, the
+compiled validators. The database connections of the parent are closed before the
+fork, every worker opens its own.
+
+A worker accepts a connection only when it has a free thread, the others stay in
+the listen queue for the other workers. A connection is closed after its
+response, as idle keep-alive connections would hold the threads. A worker that
+has served --max-requests requests (plus up to --max-requests-jitter, so they
+do not all restart together) finishes its requests, exits and is replaced.
+
+Signals of the parent:
+    TERM, INT   graceful stop: the workers finish their requests, for at most
+                --graceful-timeout seconds
+    HUP         graceful reload: the app is built again (instance/config.py and
+                the TAPI_ environment are read again), new workers are forked
+                and the old ones stop gracefully. Changed code needs a restart.
+"""
+import argparse
+import gc
+import os
+import random
+import select
+import selectors
+import signal
+import socket
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler
+
+
+class RequestHandler(WSGIRequestHandler):
+    # one request per connection
+    protocol_version = "HTTP/1.0"
+
+
+class WorkerServer(BaseWSGIServer):
+    """ The HTTP server of one worker process: accepts from the inherited listening
+    socket when one of its threads is free and runs the request in that thread """
+    multithread = True
+    multiprocess = True
+
+    def __init__(self, app, sock, threads, max_requests=0):
+        super().__init__(sock.getsockname()[0], sock.getsockname()[1], app, RequestHandler, fd=sock.fileno())
+        self.socket.setblocking(False)
+        self.pool = ThreadPoolExecutor(threads, thread_name_prefix='tapi-worker')
+        self.slots = threading.BoundedSemaphore(threads)
+        self.max_requests = max_requests
+        self.requests = 0
+        self.stopping = False
+
+    def serve(self, parent):
+        """ Serves until stop() is called, max_requests is reached or the parent is gone,
+        then waits for the requests being processed """
+        with selectors.DefaultSelector() as selector:
+            selector.register(self.socket, selectors.EVENT_READ)
+            while True:
+                self.slots.acquire()
+                if self.stopping:
+                    self.slots.release()
+                    break
+                try:
+                    # another worker may accept the connection first
+                    if not selector.select(timeout=1.0):
+                        raise BlockingIOError
+                    request, client_address = self.socket.accept()
+                except (BlockingIOError, InterruptedError):
+                    self.slots.release()
+                    if os.getppid() != parent:
+                        self.stopping = True
+                    continue
+                request.setblocking(True)
+                self.requests += 1
+                if self.max_requests and self.requests >= self.max_requests:
+                    self.stopping = True
+                self.pool.submit(self.process_request_thread, request, client_address)
+        self.pool.shutdown(wait=True)
+        self.socket.close()
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self.slots.release()
+
+    def stop(self, *args):
+        self.stopping = True
+
+
+def build_app():
+    """ create_app() with the config of instance/config.py and the environment, ready
+    to be forked: mappers configured, no open database connections """
+    from sqlalchemy.orm import configure_mappers
+    from tapi import create_app, db
+    app = create_app()
+    configure_mappers()
+    with app.app_context():
+        db.engine.dispose()
+    return app
+
+
+def listen(host, port, backlog=2048):
+    sock = socket.create_server((host, port), family=socket.AF_INET6 if ':' in host else socket.AF_INET,
+                                backlog=backlog)
+    sock.set_inheritable(True)
+    return sock
+
+
+class Arbiter:
+    """ Forks the workers, replaces the ones that exit and handles the signals """
+
+    def __init__(self, app, sock, args):
+        self.app = app
+        self.sock = sock
+        self.args = args
+        # pid: generation, the workers of older generations are being stopped
+        self.workers = {}
+        self.stopped = {}
+        self.generation = 0
+        self.signals = []
+        self.stopping = False
+
+    def run(self):
+        self.wakeup_r, self.wakeup_w = os.pipe()
+        os.set_blocking(self.wakeup_w, False)
+        signal.set_wakeup_fd(self.wakeup_w)
+        for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP, signal.SIGCHLD):
+            signal.signal(signum, self.signal)
+        self.log("listening on http://{}:{} with {} workers of {} threads".format(
+            *self.sock.getsockname()[:2], self.args.workers, self.args.threads))
+        self.spawn_workers()
+        while self.workers:
+            select.select([self.wakeup_r], [], [], 1.0)
+            try:
+                os.read(self.wakeup_r, 1024)
+            except BlockingIOError:
+                pass
+            while self.signals:
+                self.handle(self.signals.pop(0))
+            self.reap()
+            self.kill_overdue()
+            if not self.stopping:
+                self.spawn_workers()
+        self.sock.close()
+        self.log("stopped")
+
+    def signal(self, signum, frame):
+        self.signals.append(signum)
+
+    def handle(self, signum):
+        if signum in (signal.SIGTERM, signal.SIGINT) and not self.stopping:
+            self.log("stopping")
+            self.stopping = True
+            self.stop_workers(list(self.workers))
+        elif signum == signal.SIGHUP and not self.stopping:
+            self.log("reloading")
+            try:
+                # the objects of the previous app can be collected now
+                gc.unfreeze()
+                self.app = self.freeze(build_app())
+            except Exception as e:
+                self.log("reload failed, keeping the running workers: {!r}".format(e))
+                self.freeze(self.app)
+                return
+            old = [pid for pid, generation in self.workers.items() if generation == self.generation]
+            self.generation += 1
+            self.spawn_workers()
+            self.stop_workers(old)
+
+    def spawn_workers(self):
+        current = sum(1 for generation in self.workers.values() if generation == self.generation)
+        for _ in range(self.args.workers - current):
+            pid = os.fork()
+            if pid == 0:
+                self.run_worker()
+            self.workers[pid] = self.generation
+
+    def run_worker(self):
+        # in the child, never returns
+        status = 0
+        try:
+            gc.enable()
+            signal.set_wakeup_fd(-1)
+            os.close(self.wakeup_r)
+            os.close(self.wakeup_w)
+            jitter = random.randint(0, self.args.max_requests_jitter) if self.args.max_requests else 0
+            server = WorkerServer(self.app, self.sock, self.args.threads, self.args.max_requests + jitter)
+            signal.signal(signal.SIGTERM, server.stop)
+            # Ctrl-C reaches the whole process group, the parent stops the workers
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            signal.signal(signal.SIGHUP, signal.SIG_IGN)
+            signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+            server.serve(os.getppid())
+        except BaseException:
+            import traceback
+            traceback.print_exc()
+            status = 1
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(status)
+
+    def stop_workers(self, pids):
+        deadline = time.monotonic() + self.args.graceful_timeout
+        for pid in pids:
+            self.stopped[pid] = deadline
+            self.workers[pid] = -1
+            self.kill(pid, signal.SIGTERM)
+
+    def kill_overdue(self):
+        now = time.monotonic()
+        for pid, deadline in list(self.stopped.items()):
+            if deadline < now:
+                self.log("worker {} did not stop in time, killing it".format(pid))
+                self.kill(pid, signal.SIGKILL)
+                del self.stopped[pid]
+
+    def reap(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            self.stopped.pop(pid, None)
+            if self.workers.pop(pid, None) not in (None, -1) and not self.stopping:
+                code = os.waitstatus_to_exitcode(status)
+                if code != 0:
+                    self.log("worker {} exited with {}".format(pid, code))
+                    # do not fork in a tight loop if the workers keep failing
+                    time.sleep(1)
+
+    @staticmethod
+    def kill(pid, signum):
+        try:
+            os.kill(pid, signum)
+        except ProcessLookupError:
+            pass
+
+    @staticmethod
+    def freeze(app):
+        # the objects of the app to the permanent generation, out of the reach of the
+        # collections in the workers
+        gc.collect()
+        gc.freeze()
+        return app
+
+    @staticmethod
+    def log(message):
+        print("[tapi.serve {}] {}".format(os.getpid(), message), file=sys.stderr, flush=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5000)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--threads", type=int, default=4, help="request threads per worker")
+    parser.add_argument("--max-requests", type=int, default=0,
+                        help="replace a worker after this many requests, 0 for never")
+    parser.add_argument("--max-requests-jitter", type=int, default=0)
+    parser.add_argument("--graceful-timeout", type=float, default=30,
+                        help="seconds a stopping worker has to finish its requests")
+    args = parser.parse_args(argv)
+    if args.workers < 1 or args.threads < 1:
+        parser.error("--workers and --threads must be at least 1")
+
+    # create_app() reads it, the response cache of a worker is off if it has siblings
+    os.environ['TAPI_SERVER_PROCESSES'] = str(args.workers)
+    # no collections while the app is built, no holes in the pages the workers share
+    gc.disable()
+    sock = listen(args.host, args.port)
+    app = Arbiter.freeze(build_app())
+    Arbiter(app, sock, args).run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,176 @@
+""" Per-request timing in a Server-Timing header
+
+With SERVER_TIMING in the config, every response gets a Server-Timing header
+with the time spent in the SQL statements (and their count), in building the
+URLs of the controls, in validating the request body and in serializing the
+JSON, the rest of the time in the view as 'app' and the total. With TIMING_LOG
+the same numbers are logged to the 'tapi.timing' logger as one JSON line per
+request. The log line is written when the request ends, so it includes the
+time of a streamed body. The header is sent before the body.
+
+The timings of the request being served are in a ContextVar. The SQL is timed
+with engine events, added to the engines of the apps that enable the timing.
+The other phases are timed by wrappers of the functions. The first app that
+enables the timing puts the wrappers in place of the functions in all the tapi
+modules, so a process that never enables it runs the plain functions. In a
+request without timing a wrapper costs one ContextVar lookup.
+"""
+import contextvars
+import functools
+import importlib
+import json
+import logging
+import sys
+import time
+
+from flask import request
+from sqlalchemy import event
+
+logger = logging.getLogger('tapi.timing')
+
+_timings = contextvars.ContextVar('tapi_timings', default=None)
+
+# (module, function, phase) of the timed functions
+TIMED_FUNCTIONS = [
+    ('tapi.urls', 'resource_url', 'url'),
+    ('tapi.utils', 'dumps', 'dumps'),
+]
+_instrumented = False
+
+# descriptions of the phases in the Server-Timing header
+DESCRIPTIONS = {
+    'url': 'URL building',
+    'validate': 'request validation',
+    'dumps': 'JSON serialization',
+    'app': 'rest of the view',
+}
+
+
+class RequestTimings:
+    """ Time spent per phase and in SQL by one request, in seconds """
+    __slots__ = ('started', 'phases', 'active', 'queries', 'sql', 'status')
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases = {}
+        # the phase being timed, the phases called from it are part of it
+        self.active = None
+        self.queries = 0
+        self.sql = 0.0
+        self.status = None
+
+    def metrics(self):
+        """ [(name, seconds, description)] of the phases that ran, 'app' and 'total' """
+        total = time.perf_counter() - self.started
+        metrics = []
+        if self.queries:
+            metrics.append(('sql', self.sql, "{} queries".format(self.queries)))
+        metrics += [(name, seconds, DESCRIPTIONS[name]) for name, seconds in self.phases.items()]
+        rest = total - sum(seconds for _, seconds, _ in metrics)
+        metrics.append(('app', max(rest, 0.0), DESCRIPTIONS['app']))
+        metrics.append(('total', total, None))
+        return metrics
+
+
+def timed(phase, fn):
+    """ fn with the time of its calls added to a phase of the request timing """
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        timings = _timings.get()
+        if timings is None or timings.active is not None:
+            return fn(*args, **kwargs)
+        timings.active = phase
+        started = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            timings.phases[phase] = timings.phases.get(phase, 0.0) + time.perf_counter() - started
+            timings.active = None
+    return wrapper
+
+
+def time_validator_class(cls):
+    # the validate() of a validator class of tapi.validation, once the timing is on
+    if _instrumented and not hasattr(cls.validate, '__wrapped__'):
+        cls.validate = timed('validate', cls.validate)
+
+
+def instrument():
+    """ Replaces the TIMED_FUNCTIONS by timed wrappers in every loaded tapi module
+    that has them, and times the validators. Once per process """
+    global _instrumented
+    if _instrumented:
+        return
+    _instrumented = True
+    wrappers = {}
+    for module_name, name, phase in TIMED_FUNCTIONS:
+        fn = getattr(importlib.import_module(module_name), name)
+        wrappers[id(fn)] = timed(phase, fn)
+    # the modules that did `from tapi.urls import resource_url` hold the function too
+    for module_name, module in list(sys.modules.items()):
+        if module is None or not (module_name == 'tapi' or module_name.startswith('tapi.')):
+            continue
+        for name, value in list(vars(module).items()):
+            wrapper = wrappers.get(id(value))
+            if wrapper is not None:
+                setattr(module, name, wrapper)
+    from tapi.validation import _validator_classes
+    for cls in _validator_classes.values():
+        time_validator_class(cls)
+
+
+def server_timing(metrics):
+    # e.g. sql;dur=1.20;desc="3 queries", dumps;dur=0.31;desc="JSON serialization", total;dur=2.50
+    return ", ".join(
+        "{};dur={:.2f}".format(name, seconds * 1000) + (';desc="{}"'.format(desc) if desc else "")
+        for name, seconds, desc in metrics)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _timings.get() is not None:
+        conn.info.setdefault('tapi_query_started', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    timings = _timings.get()
+    started = conn.info.get('tapi_query_started')
+    if timings is not None and started:
+        timings.sql += time.perf_counter() - started.pop()
+        timings.queries += 1
+
+
+def init_timing(app):
+    """ Adds the request timing to the app if SERVER_TIMING or TIMING_LOG is set """
+    header = app.config.get('SERVER_TIMING', False)
+    log = app.config.get('TIMING_LOG', False)
+    if not (header or log):
+        return
+
+    instrument()
+    from tapi import db
+    with app.app_context():
+        event.listen(db.engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(db.engine, "after_cursor_execute", _after_cursor_execute)
+
+    @app.before_request
+    def start_timing():
+        _timings.set(RequestTimings())
+
+    @app.after_request
+    def add_server_timing(response):
+        timings = _timings.get()
+        if timings is not None:
+            timings.status = response.status_code
+            if header:
+                response.headers['Server-Timing'] = server_timing(timings.metrics())
+        return response
+
+    @app.teardown_request
+    def stop_timing(exc):
+        timings = _timings.get()
+        _timings.set(None)
+        if log and timings is not None:
+            line = {'method': request.method, 'path': request.full_path.rstrip('?'), 'status': timings.status,
+                    'queries': timings.queries}
+            line.update(("{}_ms".format(name), round(seconds * 1000, 3)) for name, seconds, _ in timings.metrics())
+            logger.info(json.dumps(line))
@@ -0,0 +1,54 @@
+""" Precomputed URL templates for the hypermedia controls
+
+api.url_for() goes through the Werkzeug URL building for every call and the
+collections call it several times per item. resource_url() resolves the route
+of a resource once per app (and script root) with api.url_for() and fills in the
+handles of the following calls with plain string formatting.
+"""
+import re
+from urllib.parse import quote
+
+from flask.globals import request_ctx
+
+# Werkzeug leaves these characters unquoted in the URL path segments
+URL_SAFE = "!$&'()*+,/:;=@"
+# Most handles need no quoting at all, quote() is only called for the others
+NEEDS_QUOTING = re.compile(r"[^A-Za-z0-9_.~\-" + re.escape(URL_SAFE) + "]")
+# Placeholder of a route value while resolving the template, only URL safe characters
+PLACEHOLDER = "TAPI{}VALUE"
+
+
+def _quote(value):
+    value = str(value)
+    if NEEDS_QUOTING.search(value) is None:
+        return value
+    return quote(value, safe=URL_SAFE)
+
+
+def _resolve_template(resource, names, values):
+    # build the URL once with placeholders and turn it into a format string
+    # (imported here, tapi.api imports the resources which import this module)
+    from tapi.api import api
+    placeholders = {k: (PLACEHOLDER.format(k) if k in names else None) for k in values}
+    template = api.url_for(resource, **placeholders).replace('{', '{{').replace('}', '}}')
+    for k in names:
+        template = template.replace(PLACEHOLDER.format(k), '{' + k + '}')
+    return template
+
+
+def resource_url(resource, **values):
+    """ Returns the same URL as api.url_for(resource, **values). Values that are None
+    select the route without them (e.g. the collection route), as with url_for """
+    names = tuple([k for k in values if values[k] is not None])
+    # one context lookup for both the app and the script root
+    ctx = request_ctx._get_current_object()
+    templates = ctx.app.extensions.get('tapi_url_templates')
+    if templates is None:
+        templates = ctx.app.extensions['tapi_url_templates'] = {}
+    key = (resource, names, ctx.request.script_root)
+    template = templates.get(key)
+    if template is None:
+        template = templates[key] = _resolve_template(resource, names, values)
+    if not names:
+        return template.format()
+    return template.format(**{k: _quote(values[k]) for k in names})
@@ -1,9 +1,17 @@
 import json
 import datetime
+import itertools
+from urllib.parse import urlencode
 
+from sqlalchemy import tuple_
 from werkzeug.datastructures import Headers
 from tapi.constants import *
-from flask import request, Response
+from flask import request, Response, stream_with_context
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 
 # MasonBuilder was given during the exercises. Here with no modifications.
@@ -98,7 +106,8 @@ def mealrecord_to_api_mealrecord(mealrecord):
         'person_id': mealrecord.person_id,
         'meal_id': mealrecord.meal_id,
         'amount': mealrecord.amount,
-        'timestamp': mealrecord.timestamp
+        # as a string here, so the serializer needs no callback per timestamp
+        'timestamp': str(mealrecord.timestamp)
     })
     return m
 
@@ -135,6 +144,41 @@ def myconverter(o):
         return o.__str__()
 
 
+def json_default(o):
+    # datetime in the format the API has always used: str(), not the ISO 'T' format
+    if isinstance(o, datetime.datetime):
+        return str(o)
+    raise TypeError("Type is not JSON serializable: " + type(o).__name__)
+
+
+def stdlib_dumps(obj):
+    # compact and UTF-8, the same bytes as orjson gives
+    return json.dumps(obj, default=json_default, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+
+def orjson_dumps(obj):
+    return orjson.dumps(obj, default=json_default, option=orjson.OPT_PASSTHROUGH_DATETIME)
+
+
+SERIALIZERS = {'stdlib': stdlib_dumps}
+if orjson is not None:
+    SERIALIZERS['orjson'] = orjson_dumps
+# The fastest available one is used unless use_serializer() is called
+_serializer = SERIALIZERS.get('orjson', stdlib_dumps)
+
+
+def use_serializer(name):
+    """ Selects the JSON serializer ('stdlib' or 'orjson') of all the responses. Both give
+    the same bytes, except for floats that need an exponent (1e+16 / 1e16) """
+    global _serializer
+    _serializer = SERIALIZERS[name]
+
+
+def dumps(obj):
+    # JSON of a response body as UTF-8 bytes with the selected serializer
+    return _serializer(obj)
+
+
 def make_mealportion_handle(meal, portion):
     return "{}-{}".format(meal, portion)
 
@@ -170,6 +214,13 @@ class CalorieBuilder(MasonBuilder):
             href=href
         )
 
+    def add_control_next(self, href):
+        # next is IANA defined control, outside of calorie namespace
+        self.add_control(
+            "next",
+            href=href
+        )
+
     def add_control_delete(self, href):
         # delete is calmeta specific control, within calorie namespace
         self.add_control(
@@ -179,6 +230,126 @@ class CalorieBuilder(MasonBuilder):
         )
 
 
+def get_page_limit():
+    # page size from the ?limit= query parameter, None if the given value is not valid
+    value = request.args.get('limit')
+    if value is None:
+        return DEFAULT_PAGE_SIZE
+    try:
+        limit = int(value)
+    except ValueError:
+        return None
+    if limit < 1:
+        return None
+    return min(limit, MAX_PAGE_SIZE)
+
+
+def keyset_query(query, columns, after, descending=False):
+    """ Orders the query by the given (unique) columns and starts it after the key values
+    in 'after', so the database can seek the index instead of counting an OFFSET """
+    if after is not None:
+        if len(columns) == 1:
+            key, after_key = columns[0], after[0]
+        else:
+            key, after_key = tuple_(*columns), tuple_(*after)
+        query = query.filter(key < after_key if descending else key > after_key)
+    if descending:
+        return query.order_by(*[c.desc() for c in columns])
+    return query.order_by(*columns)
+
+
+def keyset_page(query, columns, after, limit, descending=False):
+    # fetches one page of the keyset_query, returns (rows, has_more)
+    # One extra row tells if there is a next page
+    rows = keyset_query(query, columns, after, descending).limit(limit + 1).all()
+    return rows[:limit], len(rows) > limit
+
+
+def keyset_stream(query, columns, after, descending=False):
+    # all the rows of the keyset_query, fetched from the database a chunk at a time
+    return keyset_query(query, columns, after, descending).yield_per(STREAM_CHUNK_SIZE)
+
+
+def chunked(iterable, size):
+    # lists of at most size items from the iterable
+    iterator = iter(iterable)
+    chunk = list(itertools.islice(iterator, size))
+    while chunk:
+        yield chunk
+        chunk = list(itertools.islice(iterator, size))
+
+
+def add_control_next_page(resp, cursor, limit):
+    # next page link keeps the other query parameters of the current request
+    args = request.args.to_dict()
+    args['limit'] = limit
+    args['after'] = cursor
+    resp.add_control_next(request.path + '?' + urlencode(args))
+
+
+def stream_requested():
+    # ?stream=true asks for the whole collection in one streamed response instead of pages
+    return request.args.get('stream', '').lower() in ('1', 'true')
+
+
+class StreamedItems(list):
+    """ Stands in for the items of a streamed collection. It is an empty list for
+    dumps() and the items come from the iterable while the response is sent """
+    def __init__(self, iterable):
+        super().__init__()
+        self.iterable = iterable
+
+
+def stream_mason_response(resp):
+    """ Streams the Mason collection document whose items are StreamedItems. The body is
+    the same as dumps(resp) would give with all the items in place, but only one buffer
+    of items is in memory at a time """
+    envelope = dumps(resp)
+    split = envelope.index(b'"items":[]') + len(b'"items":[')
+    head, tail = envelope[:split], envelope[split:]
+
+    def generate():
+        # the envelope head goes out before the query has even started
+        yield head
+        buffer = []
+        size = 0
+        separator = b''
+        for item in resp['items'].iterable:
+            data = dumps(item)
+            buffer.append(separator)
+            buffer.append(data)
+            separator = b','
+            size += len(data)
+            if size >= STREAM_BUFFER_SIZE:
+                yield b''.join(buffer)
+                buffer = []
+                size = 0
+        buffer.append(tail)
+        yield b''.join(buffer)
+
+    return Response(stream_with_context(generate()), 200, headers=add_mason_response_header())
+
+
+def stream_export_response(chunks, content_type, filename):
+    """ Streams the bytes of the chunks as a file download, joined into writes of about
+    STREAM_BUFFER_SIZE. Nothing but the current buffer is kept in memory """
+    def generate():
+        buffer = []
+        size = 0
+        for chunk in chunks:
+            buffer.append(chunk)
+            size += len(chunk)
+            if size >= STREAM_BUFFER_SIZE:
+                yield b''.join(buffer)
+                buffer = []
+                size = 0
+        yield b''.join(buffer)
+
+    headers = Headers()
+    headers['Content-Disposition'] = 'attachment; filename="{}"'.format(filename)
+    return Response(stream_with_context(generate()), 200, headers=headers, content_type=content_type)
+
+
 def add_calorie_namespace(resp):
     resp.add_namespace(NS, URL_LINK_RELATIONS)
 
@@ -197,7 +368,7 @@ def create_error_response(status_code, title, message=None):
     body = MasonBuilder(resource_url=resource_url)
     body.add_error(title, message)
     body.add_control("profile", href=ERROR_PROFILE)
-    return Response(json.dumps(body), status_code, mimetype=MASON)
+    return Response(dumps(body), status_code, mimetype=MASON)
 
 
 def error_404():
@@ -218,3 +389,8 @@ def error_409():
 def error_400():
     return create_error_response(
         400, "Invalid JSON", "Request JSON does not follow the jsonschema.")
+
+
+def error_400_query():
+    return create_error_response(
+        400, "Invalid query", "Request query parameters are not valid.")
@@ -0,0 +1,57 @@
+""" Precompiled jsonschema validators for the request bodies
+
+jsonschema.validate() checks the schema itself and builds a new validator on every
+call. Here each resource schema is checked once when the resource module is imported
+and the validator is reused for every request. The id 'pattern' regexes are compiled
+once as well instead of being looked up from the re module cache on every check.
+"""
+import re
+
+from jsonschema import validators
+from jsonschema.exceptions import ValidationError
+
+from tapi.timing import time_validator_class
+
+_compiled_patterns = {}
+_validator_classes = {}
+
+
+def compile_pattern(pattern):
+    # compiled regex for a schema pattern, shared by all the validators
+    compiled = _compiled_patterns.get(pattern)
+    if compiled is None:
+        compiled = _compiled_patterns[pattern] = re.compile(pattern)
+    return compiled
+
+
+def _pattern(validator, patrn, instance, schema):
+    # same as the jsonschema 'pattern' keyword, but with the precompiled regex
+    if validator.is_type(instance, "string") and not compile_pattern(patrn).search(instance):
+        yield ValidationError(f"{instance!r} does not match {patrn!r}")
+
+
+def _precompile_patterns(schema):
+    # walk the schema and compile every 'pattern' in it up front
+    if isinstance(schema, dict):
+        for key, value in schema.items():
+            if key == "pattern" and isinstance(value, str):
+                compile_pattern(value)
+            else:
+                _precompile_patterns(value)
+    elif isinstance(schema, list):
+        for value in schema:
+            _precompile_patterns(value)
+
+
+def compile_schema(schema):
+    """ Checks the schema and returns a reusable validator for it. Raises SchemaError
+    for an invalid schema, so a broken schema fails at startup and not per request.
+    validator.validate(instance) raises ValidationError for an invalid instance """
+    base = validators.validator_for(schema)
+    base.check_schema(schema)
+    cls = _validator_classes.get(base)
+    if cls is None:
+        cls = _validator_classes[base] = validators.extend(base, {"pattern": _pattern})
+        time_validator_class(cls)
+    _precompile_patterns(schema)
+    return cls(schema)
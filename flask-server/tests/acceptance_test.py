@@ -260,8 +260,19 @@ def create_mealrecord(app, meal, time, servings, date='2021-04-21'):
 
 def get_meals_for_day(app, day='2021-04-21'):
     client = app.test_client()
+    next_day = datetime.date.fromisoformat(day) + datetime.timedelta(days=1)
     r = client.get(
-        ROUTE_ENTRYPOINT + ROUTE_PERSON_COLLECTION + VALID_PERSON['id'] + '/mealrecords/'
+        ROUTE_ENTRYPOINT + ROUTE_PERSON_COLLECTION + VALID_PERSON['id'] + '/mealrecords/',
+        query_string={'from': day, 'to': next_day.isoformat()}
+    )
+    assert r.status_code == 200
+    return json.loads(r.data)
+
+def get_nutrition_for_day(app, day='2021-04-21'):
+    client = app.test_client()
+    r = client.get(
+        ROUTE_ENTRYPOINT + ROUTE_PERSON_COLLECTION + VALID_PERSON['id'] + '/nutrition/',
+        query_string={'day': day}
     )
     assert r.status_code == 200
     return json.loads(r.data)
@@ -291,19 +302,23 @@ def test_track_meals_of_the_day_and_count_calories(app):
         create_mealrecord(app, breakfast, "10:00", servings=2)
         create_mealrecord(app, lunch, "14:00", servings=1)
         create_mealrecord(app, dinner, "20:00", servings=2)
+        # the day before is not counted
+        create_mealrecord(app, dinner, "20:00", servings=1, date='2021-04-20')
 
         meals_data = get_meals_for_day(app)
 
         meals = []
         for m in meals_data['items']:
-            meals.append([m['timestamp'], m['meal_id'], m['amount'], 0])
+            meals.append([m['timestamp'], m['meal_id'], m['amount'], m['nutrients']['calories']])
         assert len(meals) == 3
-        for m in meals:
-            for p in get_mealjson(app, m[1]):
-                print (p)
-                # TODO: HOW do we get the MealPortions for calculating totals?
-                #['items']:
-                pass
+        assert [m[3] for m in meals] == pytest.approx([368, 590, 2340])
+
+        totals = get_nutrition_for_day(app)
+        assert totals['calories'] == pytest.approx(3298)
+        assert totals['carbohydrate'] == pytest.approx(237.6)
+        assert totals['protein'] == pytest.approx(142)
+        assert totals['fat'] == pytest.approx(64)
+        assert totals['alcohol'] == pytest.approx(62.04)
 
 
 def test_track_breakfast_and_count_carbohydrates(app):
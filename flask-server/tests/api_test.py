@@ -1,14 +1,25 @@
+import asyncio
 import json
 import datetime
 import pytest
+import sqlalchemy
 from tapi import db, create_app
 from tapi.constants import *
-from tapi.models import Person, Meal, MealRecord, MealPortion, Portion
+from tapi.models import Person, Meal, MealRecord, MealPortion, Portion, DailyIntake
 # BEGIN Original fixture setup taken from the Exercise example and then modified further
 from tapi.utils import make_mealrecord_handle, myconverter, make_mealportion_handle
+from tapi.urls import resource_url
+from tapi.utils import SERIALIZERS, use_serializer, stdlib_dumps
+from tapi.asgi import AsgiApp
 
 import os
+import signal
+import socket
+import subprocess
+import sys
 import tempfile
+import time
+import urllib.request
 from sqlalchemy.engine import Engine
 from sqlalchemy import event
 
@@ -21,7 +32,9 @@ def app():
     db_fd, db_fname = tempfile.mkstemp()
     config = {
         "SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname,
-        "TESTING": True
+        "TESTING": True,
+        # the response cache on, whatever WEB_CONCURRENCY says
+        "SERVER_PROCESSES": 1
     }
 
     app = create_app(config)
@@ -172,6 +185,213 @@ def test_person_collection_200(app):
         assert_post_control_properties(r, NS + ":add-person")
 
 
+def test_person_collection_pages(app):
+    with app.app_context():
+        for person_id in ["1", "2", "3", "4", "5"]:
+            add_person_to_db(person_id)
+        client = app.test_client()
+        # walk the collection through the 'next' controls
+        seen = []
+        url = ROUTE_ENTRYPOINT + ROUTE_PERSON_COLLECTION + "?limit=2"
+        while url is not None:
+            r = client.get(url)
+            assert r.status_code == 200
+            body = json.loads(r.data)
+            assert len(body['items']) <= 2
+            seen.extend(p['id'] for p in body['items'])
+            url = body['@controls'].get('next', {}).get('href')
+        assert seen == ["1", "2", "3", "4", "5"]
+
+        r = client.get(ROUTE_ENTRYPOINT + ROUTE_PERSON_COLLECTION + "?limit=2&after=4")
+        body = json.loads(r.data)
+        assert [p['id'] for p in body['items']] == ["5"]
+        assert 'next' not in body['@controls']
+
+
+def test_collections_streamed_same_as_paged(app, monkeypatch):
+    # small buffer to stream in several writes
+    monkeypatch.setattr("tapi.utils.STREAM_BUFFER_SIZE", 100)
+    with app.app_context():
+        add_person_to_db("123")
+        add_person_to_db("456")
+        add_meal_to_db("oatmeal")
+        add_meal_to_db("porridge")
+        add_portion_to_db("oat")
+        add_portion_to_db("milk")
+        add_mealportion_to_db("oatmeal", "oat", 50)
+        for h in range(8, 12):
+            add_mealrecord_to_db("123", "oatmeal", datetime.datetime(2021, 4, 21, h, 0, 0, 1))
+            add_mealrecord_to_db("456", "porridge", datetime.datetime(2021, 4, 21, h, 0, 0, 1))
+
+        client = app.test_client()
+        for url in [ROUTE_ENTRYPOINT + ROUTE_PERSON_COLLECTION,
+                    ROUTE_ENTRYPOINT + ROUTE_MEAL_COLLECTION,
+                    ROUTE_ENTRYPOINT + ROUTE_PORTION_COLLECTION,
+                    ROUTE_ENTRYPOINT + ROUTE_MEALRECORD_COLLECTION,
+                    ROUTE_ENTRYPOINT + ROUTE_PERSON_COLLECTION + "123/mealrecords/?order=desc&"]:
+            sep = "" if url.endswith("&") else "?"
+            paged = client.get(url + sep + "limit=1000")
+            streamed = client.get(url + sep + "stream=true")
+            assert streamed.status_code == 200
+            assert streamed.is_streamed
+            assert_content_type(streamed)
+            assert streamed.data == paged.data
+            assert len(json.loads(streamed.data)['items']) > 0
+
+        # streaming continues after the cursor
+        r = client.get(ROUTE_ENTRYPOINT + ROUTE_PERSON_COLLECTION + "?stream=true&after=123")
+        assert [p['id'] for p in json.loads(r.data)['items']] == ["456"]
+
+
+def test_collection_streamed_empty(app):
+    with app.app_context():
+        client = app.test_client()
+        r = client.get(ROUTE_ENTRYPOINT + ROUTE_MEAL_COLLECTION + "?stream=1")
+        assert r.status_code == 200
+        body = json.loads(r.data)
+        assert body['items'] == []
+        assert_control(r, NS + ":add-meal", ROUTE_ENTRYPOINT + ROUTE_MEAL_COLLECTION)
+
+
+def test_export_mealrecords(app, monkeypatch):
+    # small buffer to stream in several writes
+    monkeypatch.setattr("tapi.utils.STREAM_BUFFER_SIZE", 100)
+    monkeypatch.setattr("tapi.resources.mealrecord.STREAM_BUFFER_SIZE", 100)
+    with app.app_context():
+        add_person_to_db("123")
+        add_person_to_db("456")
+        add_meal_to_db("oatmeal")
+        add_portion_to_db("oat")
+        add_mealportion_to_db("oatmeal", "oat", 50)
+        for h in range(8, 12):
+            add_mealrecord_to_db("123", "oatmeal", datetime.datetime(2021, 4, 21, h, 0, 0, 1))
+        add_mealrecord_to_db("456", "oatmeal", datetime.datetime(2021, 4, 21, 8, 0, 0, 1))
+        client = app.test_client()
+        url = ROUTE_ENTRYPOINT + ROUTE_PERSON_MEALRECORD_EXPORT.replace("<handle>", "123")
+
+        # the same records and nutrients as the collection items
+        items = json.loads(client.get(ROUTE_ENTRYPOINT + "/persons/123/mealrecords/").data)['items']
+        r = client.get(url + "?nutrients=true")
+        assert r.status_code == 200 and r.is_streamed
+        assert r.headers['Content-Type'] == "application/x-ndjson"
+        assert 'filename="123-mealrecords.ndjson"' in r.headers['Content-Disposition']
+        lines = [json.loads(line) for line in r.data.decode().splitlines()]
+        assert lines == [{k: v for k, v in item.items() if k != '@controls'} for item in items]
+
+        r = client.get(url + "?format=csv&nutrients=1&from=2021-04-21T09:00:00")
+        assert r.headers['Content-Type'] == "text/csv; charset=utf-8"
+        rows = r.data.decode().splitlines()
+        assert rows[0] == "person_id,meal_id,amount,timestamp,calories,fat,protein,carbohydrate,alcohol"
+        assert len(rows) == 4
+        assert rows[1].startswith("123,oatmeal,4.0,2021-04-21 09:00:00.000001,")
+
+        r = client.get(url + "?format=csv")
+        assert r.data.decode().splitlines()[0] == "person_id,meal_id,amount,timestamp"
+
+        # the export is linked from the records of the person
+        r = client.get(ROUTE_ENTRYPOINT + "/persons/123/mealrecords/")
+        assert json.loads(r.data)['@controls'][NS + ':export-mealrecords']['href'].startswith(url)
+
+        assert client.get(url + "?format=xml").status_code == 400
+        assert client.get(url + "?from=yesterday").status_code == 400
+        r = client.get(ROUTE_ENTRYPOINT + ROUTE_PERSON_MEALRECORD_EXPORT.replace("<handle>", "nobody"))
+        assert r.status_code == 404
+
+
+def asgi_request(asgi, method, path, query=b"", body_chunks=(b"",), headers=()):
+    # one request through the ASGI app, returns (status, headers, body, number of body messages)
+    received = [{'type': 'http.request', 'body': chunk, 'more_body': i < len(body_chunks) - 1}
+                for i, chunk in enumerate(body_chunks)]
+    sent = []
+
+    async def receive():
+        return received.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {'type': 'http', 'method': method, 'path': path, 'query_string': query, 'root_path': '',
+             'headers': list(headers), 'server': ('localhost', 80), 'http_version': '1.1', 'scheme': 'http'}
+    asyncio.run(asgi(scope, receive, send))
+    return sent[0]['status'], dict(sent[0]['headers']), b"".join(m['body'] for m in sent[1:]), len(sent) - 1
+
+
+def test_asgi_app(app, monkeypatch):
+    monkeypatch.setattr("tapi.utils.STREAM_BUFFER_SIZE", 100)
+    with app.app_context():
+        add_person_to_db("123")
+        add_meal_to_db("oatmeal")
+        add_portion_to_db("oat")
+        for h in range(8, 12):
+            add_mealrecord_to_db("123", "oatmeal", datetime.datetime(2021, 4, 21, h, 0, 0, 1))
+        client = app.test_client()
+        asgi = AsgiApp(app, 2)
+
+        # the same responses as through WSGI
+        for path, query in [(ROUTE_PERSON_COLLECTION, b""), ("/meals/oatmeal/", b""),
+                            (ROUTE_PORTION_COLLECTION, b"q=oa"), ("/persons/123/mealrecords/", b"limit=2")]:
+            status, headers, body, _ = asgi_request(asgi, "GET", ROUTE_ENTRYPOINT + path, query)
+            r = client.get(ROUTE_ENTRYPOINT + path + "?" + query.decode())
+            assert status == 200
+            assert headers[b'content-type'] == MASON.encode()
+            assert body == r.data
+
+        # a cached response is answered on the event loop, without SQL
+        (status, headers, body, _), queries = count_queries(
+            lambda: asgi_request(asgi, "GET", ROUTE_ENTRYPOINT + ROUTE_PORTION_COLLECTION, b"q=oa"))
+        assert (status, headers[b'x-cache'], queries) == (200, b'HIT', 0)
+        # also when the entry is dropped after the lookup, the view does not query on the loop
+        cache = app.extensions['tapi_response_cache']
+        call = asgi.call
+
+        def call_after_invalidate(environ):
+            cache.clear()
+            return call(environ)
+        asgi.call = call_after_invalidate
+        (status, headers, body, _), queries = count_queries(
+            lambda: asgi_request(asgi, "GET", ROUTE_ENTRYPOINT + ROUTE_PORTION_COLLECTION, b"q=oa"))
+        assert (status, headers[b'x-cache'], queries) == (200, b'HIT', 0)
+        del asgi.call
+
+        # a streamed response is sent in several messages
+        status, headers, body, messages = asgi_request(asgi, "GET", ROUTE_ENTRYPOINT + "/persons/123/mealrecords/",
+                                                       b"stream=true")
+        assert body == client.get(ROUTE_ENTRYPOINT + "/persons/123/mealrecords/?limit=1000").data
+        assert b'content-length' not in headers and messages > 2
+
+        # a request body in several messages, without a Content-Length
+        status, headers, body, _ = asgi_request(asgi, "POST", ROUTE_ENTRYPOINT + ROUTE_PERSON_COLLECTION,
+                                                body_chunks=(b'{"id": ', b'"456"}'),
+                                                headers=[(b'content-type', b'application/json')])
+        assert status == 201
+        assert headers[b'location'].endswith(b"/api/persons/456/")
+        assert asgi_request(asgi, "GET", ROUTE_ENTRYPOINT + "/persons/nobody/")[0] == 404
+        asgi.executor.shutdown()
+
+
+def test_person_collection_invalid_limit_400(app):
+    with app.app_context():
+        client = app.test_client()
+        for limit in ["0", "-1", "abc"]:
+            r = client.get(ROUTE_ENTRYPOINT + ROUTE_PERSON_COLLECTION + "?limit=" + limit)
+            assert r.status_code == 400
+            assert_content_type(r)
+            assert_control_profile_error(r)
+
+
+def test_person_collection_default_page_size(app):
+    with app.app_context():
+        for i in range(DEFAULT_PAGE_SIZE + 1):
+            db.session.add(Person(id="p{:04d}".format(i)))
+        db.session.commit()
+        client = app.test_client()
+        r = client.get(ROUTE_ENTRYPOINT + ROUTE_PERSON_COLLECTION)
+        body = json.loads(r.data)
+        assert len(body['items']) == DEFAULT_PAGE_SIZE
+        assert_control(r, 'next', ROUTE_ENTRYPOINT + ROUTE_PERSON_COLLECTION +
+                       "?limit={}&after=p{:04d}".format(DEFAULT_PAGE_SIZE, DEFAULT_PAGE_SIZE - 1))
+
+
 def test_get_person_200(app):
     with app.app_context():
         # create person for testing and put it into the db
@@ -201,6 +421,7 @@ def test_control_mealrecords_by_exists_on_person(app):
         # assert correct response code and data
         assert r.status_code == 200
         assert_control(r, NS+':mealrecords-by', ROUTE_ENTRYPOINT + ROUTE_PERSON_COLLECTION + person_id + '/mealrecords/')
+        assert_control(r, NS+':nutrition', ROUTE_ENTRYPOINT + ROUTE_PERSON_COLLECTION + person_id + '/nutrition/')
 
 def test_get_person_404(app):
     with app.app_context():
@@ -727,6 +948,178 @@ def test_mealrecord_collection_200(app):
         assert_post_control_properties(r, NS + ":add-mealrecord")
 
 
+def test_mealrecord_collection_pages(app):
+    with app.app_context():
+        person_id = "123"
+        add_person_to_db(person_id)
+        add_meal_to_db("oatmeal")
+        add_meal_to_db("porridge")
+        timestamps = [datetime.datetime(2021, 4, 21, h, 0, 0) for h in range(8, 11)]
+        for t in timestamps:
+            add_mealrecord_to_db(person_id, "oatmeal", t)
+            add_mealrecord_to_db(person_id, "porridge", t)
+
+        client = app.test_client()
+        seen = []
+        url = ROUTE_ENTRYPOINT + ROUTE_MEALRECORD_COLLECTION + "?limit=4"
+        while url is not None:
+            r = client.get(url)
+            assert r.status_code == 200
+            body = json.loads(r.data)
+            seen.extend((m['meal_id'], m['timestamp']) for m in body['items'])
+            url = body['@controls'].get('next', {}).get('href')
+        assert seen == [(m, str(t)) for m in ["oatmeal", "porridge"] for t in timestamps]
+
+
+def test_mealrecord_collection_invalid_cursor_400(app):
+    with app.app_context():
+        client = app.test_client()
+        r = client.get(ROUTE_ENTRYPOINT + ROUTE_MEALRECORD_COLLECTION + "?after=oatmeal")
+        assert r.status_code == 400
+        assert_content_type(r)
+        assert_control_profile_error(r)
+
+
+def test_mealrecords_by_person_time_range(app):
+    with app.app_context():
+        add_person_to_db("123")
+        add_person_to_db("456")
+        add_meal_to_db("oatmeal")
+        add_meal_to_db("porridge")
+        add_mealrecord_to_db("123", "oatmeal", datetime.datetime(2021, 4, 20, 8, 0, 0))
+        add_mealrecord_to_db("123", "oatmeal", datetime.datetime(2021, 4, 21, 8, 0, 0))
+        add_mealrecord_to_db("123", "porridge", datetime.datetime(2021, 4, 21, 8, 0, 0))
+        add_mealrecord_to_db("123", "oatmeal", datetime.datetime(2021, 4, 21, 20, 0, 0))
+        add_mealrecord_to_db("123", "oatmeal", datetime.datetime(2021, 4, 22, 0, 0, 0))
+        add_mealrecord_to_db("456", "oatmeal", datetime.datetime(2021, 4, 21, 9, 0, 0))
+
+        client = app.test_client()
+        url = ROUTE_ENTRYPOINT + ROUTE_PERSON_COLLECTION + "123/mealrecords/"
+        r = client.get(url + "?from=2021-04-21&to=2021-04-22")
+        assert r.status_code == 200
+        body = json.loads(r.data)
+        assert [(m['meal_id'], m['timestamp']) for m in body['items']] == [
+            ("oatmeal", "2021-04-21 08:00:00"),
+            ("porridge", "2021-04-21 08:00:00"),
+            ("oatmeal", "2021-04-21 20:00:00")]
+
+        # the API timestamp format is accepted as well
+        r = client.get(url + "?from=2021-04-21 20:00:00.000000")
+        body = json.loads(r.data)
+        assert [m['timestamp'] for m in body['items']] == ["2021-04-21 20:00:00", "2021-04-22 00:00:00"]
+
+        # newest first, one page at a time
+        seen = []
+        next_url = url + "?order=desc&limit=2&to=2021-04-22"
+        while next_url is not None:
+            r = client.get(next_url)
+            assert r.status_code == 200
+            body = json.loads(r.data)
+            seen.extend((m['meal_id'], m['timestamp']) for m in body['items'])
+            next_url = body['@controls'].get('next', {}).get('href')
+        assert seen == [
+            ("oatmeal", "2021-04-21 20:00:00"),
+            ("porridge", "2021-04-21 08:00:00"),
+            ("oatmeal", "2021-04-21 08:00:00"),
+            ("oatmeal", "2021-04-20 08:00:00")]
+
+
+def test_mealrecords_by_person_invalid_query_400(app):
+    with app.app_context():
+        add_person_to_db("123")
+        client = app.test_client()
+        url = ROUTE_ENTRYPOINT + ROUTE_PERSON_COLLECTION + "123/mealrecords/"
+        for query in ["?from=yesterday", "?to=2021-13-01", "?order=random",
+                      "?from=2021-04-21T02:30:00%2B02:00", "?to=2021-04-22T00:00:00Z"]:
+            r = client.get(url + query)
+            assert r.status_code == 400
+            assert_content_type(r)
+            assert_control_profile_error(r)
+
+
+def add_mealportion_to_db(meal_id, portion_id, weight_per_serving):
+    db.session.add(MealPortion(meal_id=meal_id, portion_id=portion_id,
+                               weight_per_serving=weight_per_serving))
+    db.session.commit()
+
+
+def test_mealrecord_nutrients(app):
+    with app.app_context():
+        person_id = "123"
+        add_person_to_db(person_id)
+        add_meal_to_db("oatmeal")
+        add_portion_to_db("oat")
+        add_mealportion_to_db("oatmeal", "oat", 50)
+        timestamp = datetime.datetime(2021, 4, 21, 8, 0, 0, 1)
+        add_mealrecord_to_db(person_id, "oatmeal", timestamp)
+
+        client = app.test_client()
+        r = client.get(ROUTE_ENTRYPOINT + ROUTE_MEAL_COLLECTION + "oatmeal" + ROUTE_MEALRECORD_COLLECTION +
+                       make_mealrecord_handle(person_id, "oatmeal", timestamp) + '/')
+        assert r.status_code == 200
+        # 4 servings of 50g oat
+        nutrients = json.loads(r.data)['nutrients']
+        assert nutrients == pytest.approx({'calories': 240, 'fat': 3, 'protein': 20,
+                                           'carbohydrate': 48, 'alcohol': 1})
+
+        r = client.get(ROUTE_ENTRYPOINT + ROUTE_MEALRECORD_COLLECTION)
+        assert json.loads(r.data)['items'][0]['nutrients'] == nutrients
+
+
+def test_get_nutrition_200(app):
+    with app.app_context():
+        person_id = "123"
+        add_person_to_db(person_id)
+        add_meal_to_db("oatmeal")
+        add_portion_to_db("oat")
+        add_mealportion_to_db("oatmeal", "oat", 50)
+        add_mealrecord_to_db(person_id, "oatmeal", datetime.datetime(2021, 4, 21, 8, 0, 0))
+        add_mealrecord_to_db(person_id, "oatmeal", datetime.datetime(2021, 4, 21, 23, 59, 59))
+        add_mealrecord_to_db(person_id, "oatmeal", datetime.datetime(2021, 4, 22, 8, 0, 0))
+
+        client = app.test_client()
+        url = ROUTE_ENTRYPOINT + ROUTE_PERSON_COLLECTION + person_id + "/nutrition/"
+        r = client.get(url + "?day=2021-04-21")
+        assert r.status_code == 200
+        assert_content_type(r)
+        assert_namespace(r)
+        assert_self_url(r, url)
+        assert_control(r, NS + ":mealrecords-by", ROUTE_ENTRYPOINT + ROUTE_PERSON_COLLECTION + person_id +
+                       "/mealrecords/?from=2021-04-21+00%3A00%3A00&to=2021-04-22+00%3A00%3A00")
+        body = json.loads(r.data)
+        assert body['person_id'] == person_id
+        assert body['calories'] == pytest.approx(480)
+        assert body['carbohydrate'] == pytest.approx(96)
+
+        r = client.get(url + "?from=2021-04-21&to=2021-04-23")
+        assert json.loads(r.data)['calories'] == pytest.approx(720)
+
+        r = client.get(url + "?day=2020-01-01")
+        body = json.loads(r.data)
+        assert body['calories'] == 0
+        assert body['alcohol'] == 0
+
+
+def test_get_nutrition_404(app):
+    with app.app_context():
+        client = app.test_client()
+        r = client.get(ROUTE_ENTRYPOINT + ROUTE_PERSON_COLLECTION + "123/nutrition/")
+        assert r.status_code == 404
+        assert_content_type(r)
+
+
+def test_get_nutrition_400(app):
+    with app.app_context():
+        add_person_to_db("123")
+        client = app.test_client()
+        url = ROUTE_ENTRYPOINT + ROUTE_PERSON_COLLECTION + "123/nutrition/"
+        for query in ["?day=today", "?from=2021-04-21", "?day=2021-04-21&to=2021-04-22"]:
+            r = client.get(url + query)
+            assert r.status_code == 400
+            assert_content_type(r)
+            assert_control_profile_error(r)
+
+
 def test_post_mealrecord_415(app):
     with app.app_context():
         client = app.test_client()
@@ -843,6 +1236,81 @@ def test_post_mealrecord_201(app):
                                                                        MEALRECORD['timestamp']) + '/')
 
 
+def test_post_mealrecord_batch_200(app):
+    with app.app_context():
+        client = app.test_client()
+        add_person_to_db("123")
+        add_meal_to_db("oatmeal")
+        existing = datetime.datetime(2021, 4, 20, 8, 0, 0, 1)
+        add_mealrecord_to_db("123", "oatmeal", existing)
+
+        def record(person_id, timestamp):
+            return {'person_id': person_id, 'meal_id': 'oatmeal', 'amount': 1,
+                    'timestamp': str(timestamp)}
+
+        new = datetime.datetime(2021, 4, 21, 8, 0, 0, 1)
+        batch = [
+            record("123", new),
+            record("123", existing),
+            record("123", new),
+            record("unknown", new),
+            {'person_id': "123"},
+        ]
+        r = client.post(ROUTE_ENTRYPOINT + ROUTE_MEALRECORD_BATCH, data=json.dumps(batch),
+                        content_type=APPLICATION_JSON)
+        assert r.status_code == 200
+        assert_content_type(r)
+        items = json.loads(r.data)['items']
+        assert [item['status'] for item in items] == [201, 409, 409, 404, 400]
+        assert items[0]['@controls']['self']['href'] == ROUTE_ENTRYPOINT + ROUTE_MEAL_COLLECTION + \
+            'oatmeal' + ROUTE_MEALRECORD_COLLECTION + make_mealrecord_handle("123", "oatmeal", new) + '/'
+        assert '@error' in items[1]
+        assert MealRecord.query.count() == 2
+        # the bulk insert counts in the daily totals
+        assert DailyIntake.query.filter_by(person_id="123", day=new.date()).first() is not None
+
+        # the created record can be fetched
+        r = client.get(items[0]['@controls']['self']['href'])
+        assert r.status_code == 200
+
+
+def test_post_mealrecord_batch_409_race(app, monkeypatch):
+    with app.app_context():
+        add_person_to_db("123")
+        add_meal_to_db("oatmeal")
+        timestamp = datetime.datetime(2021, 4, 21, 8, 0, 0, 1)
+        person_pk = Person.query.filter_by(id="123").one().pk
+        meal_pk = Meal.query.filter_by(id="oatmeal").one().pk
+        def insert_after_other_request(table):
+            # another request commits the same record after the existence check
+            with db.engine.begin() as connection:
+                connection.execute(sqlalchemy.insert(MealRecord).values(
+                    person_pk=person_pk, meal_pk=meal_pk, amount=2, timestamp=timestamp))
+            return sqlalchemy.insert(table)
+        monkeypatch.setattr("tapi.resources.mealrecord.insert", insert_after_other_request)
+
+        batch = [{'person_id': "123", 'meal_id': 'oatmeal', 'amount': 1, 'timestamp': str(timestamp)}]
+        r = app.test_client().post(ROUTE_ENTRYPOINT + ROUTE_MEALRECORD_BATCH, data=json.dumps(batch),
+                                   content_type=APPLICATION_JSON)
+        assert r.status_code == 409
+        assert_control_profile_error(r)
+        # only the record of the other request
+        assert [record.amount for record in MealRecord.query.all()] == [2]
+
+
+def test_post_mealrecord_batch_400(app):
+    with app.app_context():
+        client = app.test_client()
+        endpoint = ROUTE_ENTRYPOINT + ROUTE_MEALRECORD_BATCH
+        r = client.post(endpoint, data=json.dumps({'person_id': '123'}), content_type=APPLICATION_JSON)
+        assert r.status_code == 400
+        assert_control_profile_error(r)
+        r = client.post(endpoint, data=json.dumps([{}] * (MAX_BATCH_SIZE + 1)), content_type=APPLICATION_JSON)
+        assert r.status_code == 400
+        r = client.post(endpoint, data=json.dumps([]), content_type="text/plain")
+        assert r.status_code == 415
+
+
 def test_delete_mealrecord_204(app):
     with app.app_context():
         # create mealrecord for testing and put it into the db
@@ -1014,6 +1482,42 @@ def test_put_mealrecord_204(app):
         assert r.status_code == 204
 
 
+def test_put_mealrecord_moves_daily_intake(app):
+    with app.app_context():
+        add_person_to_db("123")
+        add_person_to_db("456")
+        add_portion_to_db("oat")
+        for meal_id, weight in [("oatmeal", 50), ("porridge", 100)]:
+            add_meal_to_db(meal_id)
+            add_mealportion_to_db(meal_id, "oat", weight)
+        timestamp = datetime.datetime(2021, 4, 21, 8, 0, 0, 1)
+        add_mealrecord_to_db("123", "oatmeal", timestamp)
+        client = app.test_client()
+
+        def calories(person_id):
+            row = DailyIntake.query.filter_by(person_id=person_id, day=timestamp.date()).first()
+            if row is None:
+                return 0
+            db.session.refresh(row)
+            return row.calories
+
+        def put(old, new):
+            endpoint = ROUTE_ENTRYPOINT + ROUTE_MEAL_COLLECTION + old['meal_id'] + ROUTE_MEALRECORD_COLLECTION + \
+                make_mealrecord_handle(old['person_id'], old['meal_id'], timestamp) + '/'
+            r = client.put(endpoint, data=json.dumps(dict(new, timestamp=timestamp), default=myconverter),
+                           content_type=APPLICATION_JSON)
+            assert r.status_code == 204
+
+        oatmeal = calories("123") / 4
+        assert oatmeal > 0
+        # to another person and meal with a new amount: the old person loses all of it
+        put({'person_id': "123", 'meal_id': "oatmeal"}, {'person_id': "456", 'meal_id': "porridge", 'amount': 2})
+        assert (calories("123"), calories("456")) == (0, pytest.approx(2 * 2 * oatmeal))
+        # only the person changes
+        put({'person_id': "456", 'meal_id': "porridge"}, {'person_id': "123", 'meal_id': "porridge", 'amount': 2})
+        assert (calories("123"), calories("456")) == (pytest.approx(2 * 2 * oatmeal), 0)
+
+
 def test_put_mealrecord_404(app):
     with app.app_context():
         # create meal for testing and put it into the db
@@ -1253,6 +1757,103 @@ def test_get_mealportion_200(app):
         assert_edit_control_properties(r, NS + ":edit-mealportion")
 
 
+def count_queries(fn):
+    # number of SQL statements run by fn()
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+    event.listen(db.engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        result = fn()
+    finally:
+        event.remove(db.engine, "before_cursor_execute", before_cursor_execute)
+    return result, len(statements)
+
+
+def test_get_mealportion_collection_200(app):
+    with app.app_context():
+        client = app.test_client()
+        add_meal_to_db("oatmeal")
+        url = ROUTE_ENTRYPOINT + ROUTE_MEAL_COLLECTION + "oatmeal/mealportions/"
+        query_counts = []
+        for i in range(5):
+            add_portion_to_db("oat{}".format(i))
+            add_mealportion_to_db("oatmeal", "oat{}".format(i), 10 + i)
+            r, queries = count_queries(lambda: client.get(url))
+            query_counts.append(queries)
+            assert r.status_code == 200
+        # the same number of queries whatever the number of portions
+        assert len(set(query_counts)) == 1
+
+        items = json.loads(r.data)['items']
+        assert [item['portion_id'] for item in items] == ["oat0", "oat1", "oat2", "oat3", "oat4"]
+        assert items[1]['weight_per_serving'] == 11
+        assert items[1]['portion']['calories'] == 120
+        assert items[1]['portion']['@controls']['self']['href'] == ROUTE_ENTRYPOINT + ROUTE_PORTION_COLLECTION + "oat1/"
+        assert items[1]['@controls']['self']['href'] == url + make_mealportion_handle("oatmeal", "oat1") + "/"
+
+        r = client.get(ROUTE_ENTRYPOINT + ROUTE_MEAL_COLLECTION + "missing/mealportions/")
+        assert r.status_code == 404
+
+
+def test_get_meal_expand_portions(app):
+    with app.app_context():
+        client = app.test_client()
+        add_meal_to_db("oatmeal")
+        add_portion_to_db("oat")
+        add_mealportion_to_db("oatmeal", "oat", 80)
+        url = ROUTE_ENTRYPOINT + ROUTE_MEAL_COLLECTION + "oatmeal/"
+
+        r = client.get(url)
+        body = json.loads(r.data)
+        assert 'portions' not in body
+        assert body['@controls'][NS + ':mealportions']['href'] == url + "mealportions/"
+
+        r = client.get(url + "?expand=portions")
+        assert r.status_code == 200
+        portions = json.loads(r.data)['portions']
+        assert len(portions) == 1
+        assert portions[0]['portion']['id'] == "oat"
+        assert portions[0]['weight_per_serving'] == 80
+
+        r = client.get(url + "?expand=everything")
+        assert r.status_code == 400
+
+
+def test_get_meals_for_portion(app):
+    with app.app_context():
+        client = app.test_client()
+        add_portion_to_db("salmon")
+        add_portion_to_db("oat")
+        for meal_id in ["soup-3", "soup-1", "soup-2"]:
+            add_meal_to_db(meal_id)
+            add_mealportion_to_db(meal_id, "salmon", 100)
+        add_meal_to_db("porridge")
+        add_mealportion_to_db("porridge", "oat", 50)
+
+        url = ROUTE_ENTRYPOINT + ROUTE_PORTION_COLLECTION + "salmon/meals/"
+        # in the order the meals were created
+        r = client.get(url + "?limit=2")
+        assert r.status_code == 200
+        body = json.loads(r.data)
+        assert [item['id'] for item in body['items']] == ["soup-3", "soup-1"]
+        assert body['items'][0]['weight_per_serving'] == 100
+        r = client.get(body['@controls']['next']['href'])
+        body = json.loads(r.data)
+        assert [item['id'] for item in body['items']] == ["soup-2"]
+        assert 'next' not in body['@controls']
+        r = client.get(url + "?after=no-such-meal")
+        assert r.status_code == 400
+
+        r = client.get(ROUTE_ENTRYPOINT + ROUTE_PORTION_COLLECTION + "salmon/")
+        assert json.loads(r.data)['@controls'][NS + ':meals-using']['href'] == url
+        r = client.get(ROUTE_ENTRYPOINT + ROUTE_PORTION_COLLECTION + "missing/meals/")
+        assert r.status_code == 404
+        r = client.get(url + "?limit=0")
+        assert r.status_code == 400
+
+
 def test_get_mealportion_404(app):
     with app.app_context():
         # create meal for testing and put it into the db
@@ -1589,6 +2190,54 @@ def test_get_portion_200(app):
         assert_edit_control_properties(r, NS + ":edit-portion")
 
 
+def test_search_portions(app):
+    with app.app_context():
+        client = app.test_client()
+        url = ROUTE_ENTRYPOINT + ROUTE_PORTION_COLLECTION
+        for portion_id, name in [("olive-oil", "Olive oil"), ("olives", "Green olives"), ("oat", "Oat flakes")]:
+            r = client.post(url, data=json.dumps({'id': portion_id, 'name': name, 'calories': 100}),
+                            content_type=APPLICATION_JSON)
+            assert r.status_code == 201
+
+        def search(q):
+            r = client.get(url, query_string={'q': q})
+            assert r.status_code == 200
+            return [item['id'] for item in json.loads(r.data)['items']]
+
+        assert sorted(search("oli")) == ["olive-oil", "olives"]
+        assert search("olive oi") == ["olive-oil"]
+        assert search("OAT") == ["oat"]
+        assert search("flakes oa") == ["oat"]
+        assert search("rye") == []
+
+        # the index follows the changes of the portions
+        client.put(url + "oat/", data=json.dumps({'id': 'oat', 'name': 'Rolled oats', 'calories': 100}),
+                   content_type=APPLICATION_JSON)
+        assert search("flakes") == []
+        assert search("roll") == ["oat"]
+        client.delete(url + "olives/")
+        assert search("oli") == ["olive-oil"]
+
+        r = client.get(url, query_string={'q': " - "})
+        assert r.status_code == 400
+
+
+def test_search_portions_ranks_all_matches(app):
+    with app.app_context():
+        # the best match comes after hundreds of weaker ones
+        db.session.add_all([Portion(id="bread-{}".format(i), name="Bread roll with seeds {}".format(i), calories=250)
+                            for i in range(600)])
+        db.session.add(Portion(id="bread", name="Bread", calories=250))
+        db.session.commit()
+        client = app.test_client()
+        r = client.get(ROUTE_ENTRYPOINT + ROUTE_PORTION_COLLECTION, query_string={'q': "bread", 'limit': 1})
+        assert [item['id'] for item in json.loads(r.data)['items']] == ["bread"]
+        # a 1-2 letter prefix ranks only the first SEARCH_CANDIDATES matches
+        r = client.get(ROUTE_ENTRYPOINT + ROUTE_PORTION_COLLECTION, query_string={'q': "br", 'limit': 3})
+        items = [item['id'] for item in json.loads(r.data)['items']]
+        assert len(items) == 3 and "bread" not in items
+
+
 def test_get_portion_404(app):
     with app.app_context():
         # create portion for testing and put it into the db
@@ -1714,6 +2363,120 @@ def test_put_portion_204(app):
         assert_content_type(r)
 
 
+def test_get_portion_304(app):
+    with app.app_context():
+        client = app.test_client()
+        add_portion_to_db('oat')
+        for url in [ROUTE_ENTRYPOINT + ROUTE_PORTION_COLLECTION, ROUTE_ENTRYPOINT + ROUTE_PORTION_COLLECTION + 'oat/']:
+            r = client.get(url)
+            assert r.status_code == 200
+            etag = r.headers['ETag']
+            last_modified = r.headers['Last-Modified']
+
+            r = client.get(url, headers={'If-None-Match': etag})
+            assert r.status_code == 304
+            assert r.data == b''
+            assert r.headers['ETag'] == etag
+            r = client.get(url, headers={'If-Modified-Since': last_modified})
+            assert r.status_code == 304
+
+        # a change of the table gives a new ETag
+        url = ROUTE_ENTRYPOINT + ROUTE_PORTION_COLLECTION + 'oat/'
+        r = client.put(url, data=json.dumps({'id': 'oat', 'name': 'Oat', 'calories': 321}),
+                       content_type=APPLICATION_JSON)
+        assert r.status_code == 204
+        r = client.get(url, headers={'If-None-Match': etag})
+        assert r.status_code == 200
+        assert r.headers['ETag'] != etag
+        assert json.loads(r.data)['calories'] == 321
+
+
+def test_response_cache(app):
+    with app.app_context():
+        client = app.test_client()
+        add_portion_to_db('oat')
+        add_meal_to_db('oatmeal')
+        portions = ROUTE_ENTRYPOINT + ROUTE_PORTION_COLLECTION
+        meals = ROUTE_ENTRYPOINT + ROUTE_MEAL_COLLECTION
+
+        r = client.get(portions)
+        assert r.headers['X-Cache'] == 'MISS'
+        body = r.data
+
+        # a warm GET runs no SQL
+        r, queries = count_queries(lambda: client.get(portions))
+        assert r.headers['X-Cache'] == 'HIT'
+        assert r.data == body
+        assert queries == 0
+        assert client.get(portions + '?limit=1').headers['X-Cache'] == 'MISS'
+        r = client.get(portions, headers={'If-None-Match': r.headers['ETag']})
+        assert r.status_code == 304
+        client.get(meals + 'oatmeal/')
+
+        # a write drops the entries reading the table only
+        r = client.put(portions + 'oat/', data=json.dumps({'id': 'oat', 'name': 'Oat', 'calories': 321}),
+                       content_type=APPLICATION_JSON)
+        assert r.status_code == 204
+        r = client.get(portions)
+        assert r.headers['X-Cache'] == 'MISS'
+        assert json.loads(r.data)['items'][0]['calories'] == 321
+        add_person_to_db('123')
+        assert client.get(portions).headers['X-Cache'] == 'HIT'
+
+        stats = json.loads(client.get(ROUTE_ENTRYPOINT + ROUTE_CACHE_STATS).data)
+        assert stats['hits'] == 3
+        assert stats['misses'] == 4
+        # the meal reads portions too
+        assert stats['invalidations'] == 3
+
+
+def test_response_cache_bounds():
+    db_fd, db_fname = tempfile.mkstemp()
+    app = create_app({"SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname, "TESTING": True,
+                      "RESPONSE_CACHE_SIZE": 2, "RESPONSE_CACHE_TTL": 0})
+    with app.app_context():
+        client = app.test_client()
+        for url in ['/api/', '/api/portions/', '/api/meals/']:
+            client.get(url)
+        stats = json.loads(client.get(ROUTE_ENTRYPOINT + ROUTE_CACHE_STATS).data)
+        assert (stats['entries'], stats['evictions']) == (2, 1)
+        # expired already
+        assert client.get('/api/meals/').headers['X-Cache'] == 'MISS'
+        db.session.remove()
+    os.close(db_fd)
+    os.unlink(db_fname)
+
+
+def test_response_cache_off_with_processes(monkeypatch):
+    db_fd, db_fname = tempfile.mkstemp()
+    config = {"SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname, "TESTING": True}
+    monkeypatch.delenv("WEB_CONCURRENCY", raising=False)
+    assert create_app(config).extensions['tapi_response_cache'].max_entries > 0
+    # the other processes would serve stale entries
+    assert create_app(dict(config, SERVER_PROCESSES=2)).extensions['tapi_response_cache'].max_entries == 0
+    monkeypatch.setenv("WEB_CONCURRENCY", "4")
+    assert create_app(config).extensions['tapi_response_cache'].max_entries == 0
+    # unless turned on
+    assert create_app(dict(config, RESPONSE_CACHE_SIZE=16)).extensions['tapi_response_cache'].max_entries == 16
+    os.close(db_fd)
+    os.unlink(db_fname)
+
+
+def test_get_meal_etag_differs_per_url(app):
+    with app.app_context():
+        client = app.test_client()
+        add_meal_to_db('oatmeal')
+        r1 = client.get(ROUTE_ENTRYPOINT + ROUTE_MEAL_COLLECTION)
+        r2 = client.get(ROUTE_ENTRYPOINT + ROUTE_MEAL_COLLECTION + 'oatmeal/')
+        assert r1.headers['ETag'] != r2.headers['ETag']
+        r = client.get(ROUTE_ENTRYPOINT + ROUTE_MEAL_COLLECTION + 'oatmeal/', headers={'If-None-Match': r1.headers['ETag']})
+        assert r.status_code == 200
+        # no ETag for errors
+        r = client.get(ROUTE_ENTRYPOINT + ROUTE_MEAL_COLLECTION + 'missing/')
+        assert r.status_code == 404
+        assert 'ETag' not in r.headers
+
+
 def test_put_portion_404(app):
     with app.app_context():
         client = app.test_client()
@@ -1810,6 +2573,16 @@ def test_delete_portion_204(app):
         assert r.status_code == 204
 
 
+def test_delete_portion_409_used_by_meal(app):
+    with app.app_context():
+        add_portion_to_db("oat")
+        add_meal_to_db("oatmeal")
+        add_mealportion_to_db("oatmeal", "oat", 80)
+        r = app.test_client().delete(ROUTE_ENTRYPOINT + ROUTE_PORTION_COLLECTION + "oat/")
+        assert r.status_code == 409
+        assert Portion.query.filter_by(id="oat").first() is not None
+
+
 def test_delete_portion_404(app):
     with app.app_context():
         client = app.test_client()
@@ -1861,3 +2634,145 @@ def test_put_portion_415_bad_request(app):
         assert r.status_code == 415
         assert_content_type(r)
         assert_control_profile_error(r)
+
+
+def test_resource_url_same_as_url_for(app):
+    from tapi.api import api
+    from tapi.resources.meal import MealItem
+    from tapi.resources.mealrecord import MealRecordItem
+    handles = [None, "oatmeal", "a,b", "123-oatmeal-2021-04-21_08:00:00.000000", "ä ö?#{x}%"]
+    with app.test_request_context():
+        for handle in handles:
+            assert resource_url(MealItem, handle=handle) == api.url_for(MealItem, handle=handle)
+            # twice to use the cached template
+            assert resource_url(MealItem, handle=handle) == api.url_for(MealItem, handle=handle)
+        assert resource_url(MealRecordItem, meal=None, handle=None) == \
+            api.url_for(MealRecordItem, meal=None, handle=None)
+        for handle in handles[1:]:
+            assert resource_url(MealRecordItem, meal="oatmeal", handle=handle) == \
+                api.url_for(MealRecordItem, meal="oatmeal", handle=handle)
+    with app.test_request_context(base_url="http://localhost/calorie/"):
+        assert resource_url(MealItem, handle="oatmeal") == "/calorie/api/meals/oatmeal/"
+        assert resource_url(MealItem, handle="oatmeal") == api.url_for(MealItem, handle="oatmeal")
+
+
+def test_serializers_give_same_bytes(app):
+    if 'orjson' not in SERIALIZERS:
+        pytest.skip("orjson is not installed")
+    doc = {'items': [{'id': 'oat', 'name': 'Kaurapuuro äö   "quoted"', 'calories': 352,
+                      'density': 0.4, 'fat': 1.5, 'protein': None, 'servings': 2.0,
+                      'timestamp': datetime.datetime(2021, 4, 21, 8, 0, 0, 123)}],
+           '@controls': {'self': {'href': '/api/portions/'}}}
+    assert SERIALIZERS['orjson'](doc) == stdlib_dumps(doc)
+
+    with app.app_context():
+        add_person_to_db("123")
+        add_meal_to_db("oatmeal")
+        add_mealrecord_to_db("123", "oatmeal", datetime.datetime(2021, 4, 21, 8, 0, 0, 1))
+        client = app.test_client()
+        bodies = []
+        try:
+            for name in ['stdlib', 'orjson']:
+                use_serializer(name)
+                bodies.append(client.get(ROUTE_ENTRYPOINT + ROUTE_MEALRECORD_COLLECTION).data)
+        finally:
+            use_serializer('orjson')
+        assert bodies[0] == bodies[1]
+
+
+def serve_workers(pid):
+    with open("/proc/{}/task/{}/children".format(pid, pid)) as f:
+        return set(f.read().split())
+
+
+def wait_until(condition, timeout=20):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.1)
+
+
+@pytest.mark.skipif(not os.path.exists("/proc/self/task"), reason="reads the worker pids from /proc")
+def test_serve_workers(tmp_path):
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    env = dict(os.environ, TAPI_SQLALCHEMY_DATABASE_URI="sqlite:///" + str(tmp_path / "serve.db"),
+               PYTHONWARNINGS="ignore")
+    server = subprocess.Popen([sys.executable, "-m", "tapi.serve", "--port", str(port), "--workers", "2",
+                               "--threads", "2", "--max-requests", "5"], env=env, stderr=subprocess.DEVNULL)
+    try:
+        def get(url):
+            try:
+                with urllib.request.urlopen("http://127.0.0.1:{}{}".format(port, url), timeout=10) as r:
+                    return r.status, r.read()
+            except OSError:
+                return None, b""
+
+        wait_until(lambda: get(ROUTE_ENTRYPOINT + "/")[0] == 200)
+        first = serve_workers(server.pid)
+        assert len(first) == 2
+
+        # the workers are replaced after their max requests
+        for _ in range(20):
+            status, body = get(ROUTE_ENTRYPOINT + ROUTE_PERSON_COLLECTION)
+            assert status == 200 and json.loads(body)['items'] == []
+        wait_until(lambda: len(serve_workers(server.pid)) == 2 and not serve_workers(server.pid) & first)
+
+        # a reload replaces them too
+        before = serve_workers(server.pid)
+        server.send_signal(signal.SIGHUP)
+        wait_until(lambda: len(serve_workers(server.pid)) == 2 and not serve_workers(server.pid) & before)
+        assert get(ROUTE_ENTRYPOINT + "/")[0] == 200
+
+        server.send_signal(signal.SIGTERM)
+        assert server.wait(20) == 0
+    finally:
+        if server.poll() is None:
+            server.kill()
+            server.wait()
+
+
+def parse_server_timing(header):
+    # {name: (milliseconds, description)}
+    metrics = {}
+    for metric in header.split(", "):
+        name, *params = metric.split(";")
+        params = dict(p.split("=", 1) for p in params)
+        metrics[name] = (float(params["dur"]), params.get("desc", "").strip('"'))
+    return metrics
+
+
+def test_server_timing(caplog):
+    db_fd, db_fname = tempfile.mkstemp()
+    app = create_app({"SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname, "TESTING": True,
+                      "SERVER_TIMING": True, "TIMING_LOG": True})
+    with app.app_context():
+        client = app.test_client()
+        add_person_to_db("123")
+        add_person_to_db("456")
+
+        with caplog.at_level("INFO", logger="tapi.timing"):
+            r, queries = count_queries(lambda: client.get(ROUTE_ENTRYPOINT + ROUTE_PERSON_COLLECTION))
+        metrics = parse_server_timing(r.headers['Server-Timing'])
+        assert metrics['sql'][1] == "{} queries".format(queries)
+        assert {'url', 'dumps', 'app', 'total'} <= set(metrics)
+        assert sum(ms for name, (ms, _) in metrics.items() if name != 'total') == pytest.approx(
+            metrics['total'][0], abs=0.05)
+        line = json.loads(caplog.records[-1].getMessage())
+        assert (line['method'], line['path'], line['status'], line['queries']) == (
+            "GET", ROUTE_ENTRYPOINT + ROUTE_PERSON_COLLECTION, 200, queries)
+
+        r = client.post(ROUTE_ENTRYPOINT + ROUTE_PERSON_COLLECTION, data=json.dumps({"id": "789"}),
+                        content_type=APPLICATION_JSON)
+        assert r.status_code == 201
+        assert 'validate' in parse_server_timing(r.headers['Server-Timing'])
+        db.session.remove()
+    os.close(db_fd)
+    os.unlink(db_fname)
+
+
+def test_server_timing_disabled(app):
+    with app.app_context():
+        r = app.test_client().get(ROUTE_ENTRYPOINT + ROUTE_PERSON_COLLECTION)
+        assert 'Server-Timing' not in r.headers
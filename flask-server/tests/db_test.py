@@ -1,10 +1,12 @@
 import datetime
+import sqlite3
 
 import pytest
 from sqlalchemy.exc import IntegrityError
 
 from tapi import db, create_app
-from tapi.models import Person, Activity, Meal, MealRecord, ActivityRecord, Portion, MealPortion
+from tapi.schema import SCHEMA_VERSION, drop_portion_fts, ensure_schema
+from tapi.models import Person, Activity, Meal, MealRecord, ActivityRecord, Portion, MealPortion, MealNutrients, DailyIntake
 
 # BEGIN Original fixture setup taken from the Exercise example and then modified further
 
@@ -882,3 +884,278 @@ def test_meal_portion_cascade_meal(app):
         assert MealPortion.query.filter(MealPortion.meal_id == mid).first() is None
 
 # TODO: test for do not permit delete for Portion if there is Meals mapped to the portion
+
+
+def test_meal_nutrients_follow_writes(app):
+    with app.app_context():
+        meal = Meal(id="porridge", name="Porridge", servings=2)
+        oat = Portion(id="oat", name="Oat", calories=400, carbohydrate=60)
+        milk = Portion(id="milk", name="Milk", calories=60, fat=3)
+        db.session.add_all([meal, oat, milk])
+        db.session.commit()
+        # a meal without portions has zero nutrients
+        assert MealNutrients.query.filter_by(meal_id="porridge").first().calories == 0
+
+        db.session.add(MealPortion(meal_id="porridge", portion_id="oat", weight_per_serving=50))
+        db.session.add(MealPortion(meal_id="porridge", portion_id="milk", weight_per_serving=200))
+        db.session.commit()
+        n = MealNutrients.query.filter_by(meal_id="porridge").first()
+        db.session.refresh(n)
+        assert (n.calories, n.carbohydrate, n.fat) == (320, 30, 6)
+
+        # portion change
+        milk.fat = 1
+        db.session.commit()
+        db.session.refresh(n)
+        assert (n.calories, n.fat) == (320, 2)
+
+        # mealportion change and removal
+        mp = MealPortion.query.filter_by(meal_id="porridge", portion_id="oat").first()
+        mp.weight_per_serving = 100
+        db.session.commit()
+        db.session.refresh(n)
+        assert n.calories == 520
+        db.session.delete(mp)
+        db.session.commit()
+        db.session.refresh(n)
+        assert (n.calories, n.carbohydrate) == (120, 0)
+
+        # removed with the meal
+        db.session.delete(meal)
+        db.session.commit()
+        assert MealNutrients.query.count() == 0
+
+
+def test_daily_intake_follows_writes(app):
+    with app.app_context():
+        db.session.add_all([Person(id="7"), Meal(id="toast", name="Toast", servings=1),
+                            Portion(id="bread", name="Bread", calories=250)])
+        db.session.add(MealPortion(meal_id="toast", portion_id="bread", weight_per_serving=40))
+        db.session.commit()
+
+        def calories(day):
+            row = DailyIntake.query.filter_by(person_id="7", day=day).first()
+            if row is None:
+                return None
+            db.session.refresh(row)
+            return row.calories
+
+        monday, tuesday = datetime.date(2021, 4, 19), datetime.date(2021, 4, 20)
+        record = MealRecord(person_id="7", meal_id="toast", amount=2,
+                            timestamp=datetime.datetime(2021, 4, 19, 8, 0))
+        db.session.add(record)
+        db.session.add(MealRecord(person_id="7", meal_id="toast", amount=1,
+                                  timestamp=datetime.datetime(2021, 4, 19, 20, 0)))
+        db.session.commit()
+        assert calories(monday) == 300
+
+        # moved to the next day with a new amount
+        record.amount = 3
+        record.timestamp = datetime.datetime(2021, 4, 20, 8, 0)
+        db.session.commit()
+        assert (calories(monday), calories(tuesday)) == (100, 300)
+
+        # meal nutrients change, the days are recomputed
+        Portion.query.filter_by(id="bread").first().calories = 500
+        db.session.commit()
+        assert (calories(monday), calories(tuesday)) == (200, 600)
+
+        db.session.delete(record)
+        db.session.commit()
+        assert calories(tuesday) == 0
+
+        # rebuild from scratch gives the same totals
+        result = app.test_cli_runner().invoke(args=["rebuild-daily-intake"])
+        assert result.exit_code == 0
+        db.session.expire_all()
+        assert (calories(monday), calories(tuesday)) == (200, None)
+
+        # removed with the person
+        db.session.delete(Person.query.filter_by(id="7").first())
+        db.session.commit()
+        assert DailyIntake.query.count() == 0
+
+
+def test_engine_configuration():
+    db_fd, db_fname = tempfile.mkstemp()
+    app = create_app({
+        "SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname,
+        "TESTING": True,
+        "SQLITE_PRAGMAS": {"synchronous": "FULL", "mmap_size": None},
+        "DB_POOL_SIZE": 3
+    })
+    with app.app_context():
+        def pragma(name):
+            return db.session.execute(db.text("PRAGMA " + name)).scalar()
+        assert pragma("journal_mode") == "wal"
+        assert pragma("foreign_keys") == 1
+        assert pragma("busy_timeout") == 5000
+        # FULL from the config, mmap left at the default
+        assert pragma("synchronous") == 2
+        assert pragma("mmap_size") == 0
+        assert db.engine.pool.size() == 3
+        db.session.remove()
+    os.close(db_fd)
+    os.unlink(db_fname)
+
+
+def test_schema_version(app):
+    with app.app_context():
+        # the fixture made the tables, but did not stamp the version
+        assert ensure_schema(db.engine)
+        assert db.session.execute(db.text("SELECT version FROM schema_version")).scalar() == SCHEMA_VERSION
+        # current, nothing to do
+        assert not ensure_schema(db.engine)
+
+
+def test_upgrade_missing_indexes(app):
+    with app.app_context():
+        # a version 3 database, from before the meal_record index by meal
+        db.session.execute(db.text("DROP INDEX ix_meal_record_meal_person_timestamp"))
+        db.session.execute(db.text("DELETE FROM schema_version"))
+        db.session.execute(db.text("INSERT INTO schema_version (version) VALUES (3)"))
+        db.session.commit()
+        assert ensure_schema(db.engine)
+        plan = db.session.execute(db.text(
+            "EXPLAIN QUERY PLAN SELECT person_pk, timestamp FROM meal_record WHERE meal_pk = 1")).all()
+        assert "ix_meal_record_meal_person_timestamp" in plan[0][-1]
+
+
+def test_upgrade_portion_fts(app):
+    with app.app_context():
+        db.session.add_all([Portion(id="bread", name="Bread", calories=250),
+                            Portion(id="butter", name="Butter", calories=700)])
+        db.session.commit()
+        # the version 2 index: rows found by the unindexed id column
+        connection = db.session.connection()
+        drop_portion_fts(connection)
+        connection.execute(db.text("CREATE VIRTUAL TABLE portion_fts USING fts5(id UNINDEXED, name)"))
+        connection.execute(db.text("INSERT INTO portion_fts (id, name) SELECT id, name FROM portion"))
+        connection.execute(db.text("CREATE TRIGGER portion_fts_delete AFTER DELETE ON portion BEGIN "
+                                   "DELETE FROM portion_fts WHERE id = old.id; END"))
+        connection.execute(db.text("DELETE FROM schema_version"))
+        connection.execute(db.text("INSERT INTO schema_version (version) VALUES (2)"))
+        db.session.commit()
+
+        assert ensure_schema(db.engine)
+        assert db.session.execute(db.text("SELECT rowid, name FROM portion_fts ORDER BY rowid")).all() == \
+            [(p.pk, p.name) for p in Portion.query.order_by(Portion.pk)]
+        client = app.test_client()
+        bread = Portion.query.filter_by(id="bread").one()
+        bread.name = "Rye bread"
+        db.session.delete(Portion.query.filter_by(id="butter").one())
+        db.session.commit()
+        assert [p["id"] for p in client.get("/api/portions/?q=rye").get_json()["items"]] == ["bread"]
+        assert client.get("/api/portions/?q=butter").get_json()["items"] == []
+        assert db.session.execute(db.text("SELECT count(*) FROM portion_fts")).scalar() == 1
+
+
+def test_seed_example_data(app):
+    with app.app_context():
+        # no example data at startup, only with the command
+        assert Person.query.count() == 0
+        runner = app.test_cli_runner()
+        assert runner.invoke(args=["seed-example-data"]).exit_code == 0
+        assert Person.query.filter_by(id="123").first() is not None
+        count = MealRecord.query.count()
+        assert runner.invoke(args=["seed-example-data"]).exit_code == 0
+        assert MealRecord.query.count() == count
+
+
+def test_portion_catalog(app, tmp_path):
+    csv_file = tmp_path / "portions.csv"
+    catalog = str(tmp_path / "portions.db")
+    with app.app_context():
+        db.session.add_all([Person(id="7"), Meal(id="toast", name="Toast", servings=1),
+                            Portion(id="bread", name="Bread", calories=250),
+                            Portion(id="old-cheese", name="Old cheese", calories=400),
+                            Portion(id="butter", name="Butter", calories=700)])
+        db.session.add(MealPortion(meal_id="toast", portion_id="bread", weight_per_serving=40))
+        db.session.add(MealRecord(person_id="7", meal_id="toast", amount=2,
+                                  timestamp=datetime.datetime(2021, 4, 19, 8, 0)))
+        db.session.commit()
+        runner = app.test_cli_runner()
+
+        # an invalid row fails the build and leaves no catalog behind
+        csv_file.write_text("id,name,calories,fat\nbread,Bread,500,\nBad Id,Bad,1,\n")
+        result = runner.invoke(args=["build-portion-catalog", str(csv_file), catalog])
+        assert result.exit_code != 0 and "line 3" in result.output
+        assert not os.path.exists(catalog)
+
+        csv_file.write_text("id,name,calories,fat\nbread,Bread,500,\nbutter,Butter,700,\nmilk,Milk,64,3.5\n")
+        result = runner.invoke(args=["build-portion-catalog", str(csv_file), catalog])
+        assert result.exit_code == 0 and "3 Portions" in result.output
+        # the app database is not touched by the build
+        assert Portion.query.filter_by(id="milk").first() is None
+
+        result = runner.invoke(args=["swap-portion-catalog", catalog, "--prune"])
+        assert result.exit_code == 0
+        # unchanged butter not written, unused old-cheese pruned, bread kept for its meal
+        assert "2 Portions added or changed, 1 deleted" in result.output
+        db.session.expire_all()
+        assert Portion.query.filter_by(id="milk").first().fat == 3.5
+        assert Portion.query.filter_by(id="old-cheese").first() is None
+        assert MealNutrients.query.filter_by(meal_id="toast").first().calories == 200
+        assert DailyIntake.query.filter_by(person_id="7", day=datetime.date(2021, 4, 19)).first().calories == 400
+        # a swap of the same catalog changes nothing
+        result = runner.invoke(args=["swap-portion-catalog", catalog])
+        assert "0 Portions added or changed, 0 deleted" in result.output
+
+        # a renamed Portion is found by its new name only
+        csv_file.write_text("id,name,calories,fat\nbread,Bread,500,\nbutter,Butter,700,\nmilk,Oat milk,64,3.5\n")
+        runner.invoke(args=["build-portion-catalog", str(csv_file), catalog])
+        result = runner.invoke(args=["swap-portion-catalog", catalog])
+        assert "1 Portions added or changed, 0 deleted" in result.output
+        client = app.test_client()
+        assert [p["id"] for p in client.get("/api/portions/?q=oat").get_json()["items"]] == ["milk"]
+        assert [p["id"] for p in client.get("/api/portions/?q=milk").get_json()["items"]] == ["milk"]
+        assert db.session.execute(db.text("SELECT count(*) FROM portion_fts")).scalar() == 3
+
+
+# Tables and rows of a database from before the integer surrogate keys (schema version 2)
+STRING_KEY_SCHEMA = [
+    "CREATE TABLE person (id VARCHAR(128) NOT NULL, PRIMARY KEY (id))",
+    "CREATE TABLE meal (id VARCHAR(128) NOT NULL, name VARCHAR(128) NOT NULL, servings FLOAT NOT NULL, "
+    "description VARCHAR(8192), PRIMARY KEY (id))",
+    "CREATE TABLE portion (id VARCHAR(128) NOT NULL, name VARCHAR(128) NOT NULL, calories FLOAT NOT NULL, "
+    "density FLOAT, alcohol FLOAT, carbohydrate FLOAT, protein FLOAT, fat FLOAT, PRIMARY KEY (id))",
+    "CREATE TABLE meal_portion (meal_id VARCHAR(128) NOT NULL, portion_id VARCHAR(128) NOT NULL, "
+    "weight_per_serving FLOAT NOT NULL, PRIMARY KEY (meal_id, portion_id), "
+    "FOREIGN KEY(meal_id) REFERENCES meal (id), FOREIGN KEY(portion_id) REFERENCES portion (id))",
+    "CREATE TABLE meal_record (person_id VARCHAR(128) NOT NULL, meal_id VARCHAR(128) NOT NULL, "
+    "amount FLOAT NOT NULL, timestamp DATETIME NOT NULL, PRIMARY KEY (person_id, meal_id, timestamp), "
+    "FOREIGN KEY(person_id) REFERENCES person (id), FOREIGN KEY(meal_id) REFERENCES meal (id))",
+    "INSERT INTO person VALUES ('7'), ('123')",
+    "INSERT INTO meal VALUES ('toast', 'Toast', 1, NULL), ('porridge', 'Porridge', 2, NULL)",
+    "INSERT INTO portion VALUES ('bread', 'Bread', 250, NULL, 0, 0, 0, 0)",
+    "INSERT INTO meal_portion VALUES ('toast', 'bread', 40)",
+    "INSERT INTO meal_record VALUES ('7', 'toast', 2, '2021-04-19 08:00:00.000000'), "
+    "('7', 'porridge', 1, '2021-04-19 09:00:00.000000')",
+]
+
+
+def test_migrate_string_keys(tmp_path):
+    db_fname = str(tmp_path / "v1.db")
+    with sqlite3.connect(db_fname) as connection:
+        for statement in STRING_KEY_SCHEMA:
+            connection.execute(statement)
+    connection.close()
+
+    app = create_app({"SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname, "TESTING": True})
+    with app.app_context():
+        assert db.session.execute(db.text("SELECT version FROM schema_version")).scalar() == SCHEMA_VERSION
+        tables = set(db.inspect(db.engine).get_table_names())
+        assert "person" in tables and not any(t.endswith("_v1") for t in tables)
+        # pks in handle order, the records point to them
+        assert [(p.pk, p.id) for p in Person.query.order_by(Person.pk)] == [(1, "123"), (2, "7")]
+        records = MealRecord.query.order_by(MealRecord.timestamp).all()
+        assert [(r.person_id, r.meal_id, r.amount) for r in records] == [("7", "toast", 2), ("7", "porridge", 1)]
+        assert MealPortion.query.filter_by(meal_id="toast", portion_id="bread").one().weight_per_serving == 40
+        # rollups built, triggers back on the new tables
+        assert DailyIntake.query.filter_by(person_id="7", day=datetime.date(2021, 4, 19)).one().calories == 200
+        r = app.test_client().get("/api/portions/?q=bre")
+        assert [p["id"] for p in r.get_json()["items"]] == ["bread"]
+        r = app.test_client().get("/api/persons/7/mealrecords/")
+        assert [m["meal_id"] for m in r.get_json()["items"]] == ["toast", "porridge"]
+        db.session.remove()
+        db.engine.dispose()
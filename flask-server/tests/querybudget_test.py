@@ -0,0 +1,250 @@
+import datetime
+import json
+import logging
+import os
+import tempfile
+from urllib.parse import quote
+
+import pytest
+from tapi import db, create_app
+from tapi.constants import *
+from tapi.models import Person, Meal, MealRecord, MealPortion, Portion, DailyIntake
+from tapi.nutrition import daily_intake_select
+from tapi.querybudget import QueryBudgetExceeded, endpoint_budget, repeated_statements
+from tapi.utils import make_mealrecord_handle, make_mealportion_handle, myconverter
+
+APPLICATION_JSON = "application/json"
+START = datetime.datetime(2021, 4, 1, 8, 0, 0, 1)
+
+
+def make_app(rows, **config):
+    """ An app with QUERY_BUDGET_ACTION 'raise' and `rows` of everything: persons,
+    meals and portions, and person p0 and meal m0 with `rows` MealRecords and
+    MealPortions """
+    db_fd, db_fname = tempfile.mkstemp()
+    config = dict({
+        "SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname,
+        "TESTING": True,
+        "QUERY_BUDGET_ACTION": "raise",
+    }, **config)
+    app = create_app(config)
+    with app.app_context():
+        db.reflect()
+        db.drop_all()
+        db.create_all()
+        persons = [Person(id="p{}".format(i)) for i in range(rows)]
+        meals = [Meal(id="m{}".format(i), name="Meal {}".format(i), servings=2) for i in range(rows)]
+        portions = [Portion(id="q{}".format(i), name="Portion {}".format(i), calories=100, protein=10)
+                    for i in range(rows)]
+        db.session.add_all(persons + meals + portions)
+        for i in range(rows):
+            db.session.add(MealRecord(person=persons[0], meal=meals[i], amount=1,
+                                      timestamp=START + datetime.timedelta(hours=i)))
+            db.session.add(MealPortion(meal=meals[0], portion=portions[i], weight_per_serving=10))
+            if i:
+                db.session.add(MealRecord(person=persons[i], meal=meals[0], amount=1,
+                                          timestamp=START + datetime.timedelta(hours=i)))
+                db.session.add(MealPortion(meal=meals[i], portion=portions[0], weight_per_serving=10))
+        db.session.commit()
+    return app, db_fd, db_fname
+
+
+@pytest.fixture(params=[3, 30], ids=["small", "large"])
+def app(request):
+    app, db_fd, db_fname = make_app(request.param)
+    with app.app_context():
+        yield app
+        db.session.remove()
+    os.close(db_fd)
+    os.unlink(db_fname)
+
+
+def record_url(person, meal, timestamp):
+    return ROUTE_ENTRYPOINT + ROUTE_MEAL_COLLECTION + meal + ROUTE_MEALRECORD_COLLECTION + \
+        make_mealrecord_handle(person, meal, timestamp) + '/'
+
+
+def mealportion_url(meal, portion):
+    return ROUTE_ENTRYPOINT + ROUTE_MEAL_COLLECTION + meal + '/mealportions/' + \
+        make_mealportion_handle(meal, portion) + '/'
+
+
+# cursor of the second mealrecord of p0
+AFTER = quote('m1/' + make_mealrecord_handle('p0', 'm1', START + datetime.timedelta(hours=1)), safe='')
+
+
+def mealrecord(person, meal, timestamp):
+    return {'person_id': person, 'meal_id': meal, 'amount': 2, 'timestamp': timestamp}
+
+
+# (endpoint, method, url, body, status) of a request to every endpoint and method,
+# in an order that leaves the rows the later ones need
+REQUESTS = [
+    ("tapi.entrypoint", "GET", ROUTE_ENTRYPOINT + '/', None, 200),
+    ("tapi.cache_stats", "GET", ROUTE_ENTRYPOINT + ROUTE_CACHE_STATS, None, 200),
+    ("tapi.redirect_to_apiary_link_rels", "GET", ROUTE_ENTRYPOINT + '/link-relations/', None, 302),
+    ("tapi.personitem", "GET", ROUTE_ENTRYPOINT + ROUTE_PERSON_COLLECTION, None, 200),
+    ("tapi.personitem", "GET", ROUTE_ENTRYPOINT + ROUTE_PERSON_COLLECTION + 'p0/', None, 200),
+    ("tapi.personitem", "POST", ROUTE_ENTRYPOINT + ROUTE_PERSON_COLLECTION, {'id': 'new'}, 201),
+    ("tapi.mealitem", "GET", ROUTE_ENTRYPOINT + ROUTE_MEAL_COLLECTION, None, 200),
+    ("tapi.mealitem", "GET", ROUTE_ENTRYPOINT + ROUTE_MEAL_COLLECTION + 'm0/', None, 200),
+    ("tapi.mealitem", "GET", ROUTE_ENTRYPOINT + ROUTE_MEAL_COLLECTION + 'm0/?expand=portions', None, 200),
+    ("tapi.mealitem", "POST", ROUTE_ENTRYPOINT + ROUTE_MEAL_COLLECTION,
+     {'id': 'new', 'name': 'New', 'servings': 3}, 201),
+    ("tapi.mealitem", "PUT", ROUTE_ENTRYPOINT + ROUTE_MEAL_COLLECTION + 'm0/',
+     {'id': 'm0', 'name': 'Meal 0', 'servings': 4}, 204),
+    ("tapi.portionitem", "GET", ROUTE_ENTRYPOINT + ROUTE_PORTION_COLLECTION, None, 200),
+    ("tapi.portionitem", "GET", ROUTE_ENTRYPOINT + ROUTE_PORTION_COLLECTION + 'q0/', None, 200),
+    ("tapi.portionitem", "POST", ROUTE_ENTRYPOINT + ROUTE_PORTION_COLLECTION,
+     {'id': 'new', 'name': 'New', 'calories': 50}, 201),
+    ("tapi.portionitem", "PUT", ROUTE_ENTRYPOINT + ROUTE_PORTION_COLLECTION + 'q0/',
+     {'id': 'q0', 'name': 'Portion 0', 'calories': 120}, 204),
+    ("tapi.meals_using_portion", "GET", ROUTE_ENTRYPOINT + ROUTE_PORTION_COLLECTION + 'q0/meals/', None, 200),
+    ("tapi.mealportions_of_meal", "GET", ROUTE_ENTRYPOINT + ROUTE_MEAL_COLLECTION + 'm0/mealportions/', None, 200),
+    ("tapi.mealportions_for_meal", "POST", ROUTE_ENTRYPOINT + ROUTE_MEAL_COLLECTION + 'm0/mealportions/',
+     {'meal_id': 'm0', 'portion_id': 'new', 'weight_per_serving': 5}, 201),
+    ("tapi.mealportionitem", "GET", mealportion_url('m0', 'q0'), None, 200),
+    ("tapi.mealportionitem", "PUT", mealportion_url('m0', 'q0'),
+     {'meal_id': 'm0', 'portion_id': 'q0', 'weight_per_serving': 20}, 204),
+    ("tapi.mealportionitem", "DELETE", mealportion_url('m0', 'new'), None, 204),
+    ("tapi.mealrecorditem", "GET", ROUTE_ENTRYPOINT + ROUTE_MEALRECORD_COLLECTION, None, 200),
+    ("tapi.mealrecorditem", "GET", ROUTE_ENTRYPOINT + ROUTE_MEALRECORD_COLLECTION + '?limit=2&after=' + AFTER,
+     None, 200),
+    ("tapi.mealrecorditem", "GET", record_url('p0', 'm0', START), None, 200),
+    ("tapi.mealrecorditem", "POST", ROUTE_ENTRYPOINT + ROUTE_MEALRECORD_COLLECTION,
+     mealrecord('new', 'new', START), 201),
+    ("tapi.mealrecorditem", "PUT", record_url('p0', 'm0', START), mealrecord('p0', 'm0', START), 204),
+    ("tapi.mealrecorditem", "DELETE", record_url('new', 'new', START), None, 204),
+    ("tapi.mealrecords_batch", "POST", ROUTE_ENTRYPOINT + ROUTE_MEALRECORD_BATCH,
+     [mealrecord('new', 'm0', START + datetime.timedelta(days=i)) for i in range(5)], 200),
+    ("tapi.meals_for_person", "GET", ROUTE_ENTRYPOINT + ROUTE_PERSON_COLLECTION + 'p0/mealrecords/', None, 200),
+    ("tapi.meals_for_person", "GET", ROUTE_ENTRYPOINT + ROUTE_PERSON_COLLECTION +
+     'p0/mealrecords/?limit=2&from=2021-04-01&to=2021-04-05&after=' + AFTER, None, 200),
+    ("tapi.mealrecords_export_for_person", "GET",
+     ROUTE_ENTRYPOINT + ROUTE_PERSON_COLLECTION + 'p0/mealrecords/export/', None, 200),
+    ("tapi.nutritionitem", "GET", ROUTE_ENTRYPOINT + ROUTE_PERSON_COLLECTION + 'p0/nutrition/', None, 200),
+    ("tapi.mealitem", "DELETE", ROUTE_ENTRYPOINT + ROUTE_MEAL_COLLECTION + 'm0/', None, 204),
+    ("tapi.portionitem", "DELETE", ROUTE_ENTRYPOINT + ROUTE_PORTION_COLLECTION + 'new/', None, 204),
+    ("tapi.personitem", "DELETE", ROUTE_ENTRYPOINT + ROUTE_PERSON_COLLECTION + 'p0/', None, 204),
+]
+
+
+def statement_counts(app):
+    """ {(endpoint, method): statements} of REQUESTS """
+    from sqlalchemy import event
+    statements = []
+
+    def count(*args):
+        statements.append(args[2])
+
+    event.listen(db.engine, "before_cursor_execute", count)
+    counts = {}
+    client = app.test_client()
+    try:
+        for endpoint, method, url, body, status in REQUESTS:
+            del statements[:]
+            kwargs = {}
+            if body is not None:
+                kwargs = {'data': json.dumps(body, default=myconverter), 'content_type': APPLICATION_JSON}
+            r = client.open(url, method=method, **kwargs)
+            assert r.status_code == status, (method, url, r.data)
+            r.close()
+            counts[endpoint, method] = max(counts.get((endpoint, method), 0), len(statements))
+    finally:
+        event.remove(db.engine, "before_cursor_execute", count)
+    return counts
+
+
+def test_every_endpoint_has_a_budget(app):
+    methods = {}
+    for rule in app.url_map.iter_rules():
+        if rule.endpoint.startswith('tapi.'):
+            methods.setdefault(rule.endpoint, set()).update(rule.methods - {'HEAD', 'OPTIONS'})
+    for endpoint, endpoint_methods in methods.items():
+        for method in endpoint_methods:
+            assert endpoint_budget(app, endpoint, method) is not None, (endpoint, method)
+    # and REQUESTS covers them all, but the POST of a MealPortion item URL, MealPortionItem.post
+    # serves the POST of the collection
+    assert {(endpoint, method) for endpoint, method, *_ in REQUESTS} >= \
+        {(endpoint, method) for endpoint, endpoint_methods in methods.items() for method in endpoint_methods} - \
+        {("tapi.mealportionitem", "POST")}
+
+
+def test_requests_within_budget(app):
+    # raises QueryBudgetExceeded if not
+    counts = statement_counts(app)
+    for (endpoint, method), statements in counts.items():
+        assert statements <= endpoint_budget(app, endpoint, method), (endpoint, method)
+    # the bulk deletes of the mealrecords keep DailyIntake right
+    expected = {(person_pk, day): calories for person_pk, day, calories, *_ in db.session.execute(daily_intake_select())}
+    intake = {(row.person_pk, row.day.isoformat()): row.calories for row in DailyIntake.query if abs(row.calories) > 1e-9}
+    assert intake == pytest.approx(expected)
+
+
+def test_statements_do_not_grow_with_rows():
+    counts = []
+    for rows in (3, 30):
+        app, db_fd, db_fname = make_app(rows)
+        with app.app_context():
+            counts.append(statement_counts(app))
+            db.session.remove()
+        os.close(db_fd)
+        os.unlink(db_fname)
+    assert counts[0] == counts[1]
+
+
+def test_over_budget_raises():
+    app, db_fd, db_fname = make_app(3, QUERY_BUDGETS={"GET tapi.personitem": 1})
+    with app.app_context():
+        client = app.test_client()
+        with pytest.raises(QueryBudgetExceeded) as e:
+            client.get(ROUTE_ENTRYPOINT + ROUTE_PERSON_COLLECTION)
+        assert "GET tapi.personitem: 2 SQL statements, budget 1" in str(e.value)
+        # the other methods keep their budgets
+        assert endpoint_budget(app, "tapi.personitem", "DELETE") == 8
+        db.session.remove()
+    os.close(db_fd)
+    os.unlink(db_fname)
+
+
+def test_over_budget_logged_and_repeats_reported(caplog):
+    app, db_fd, db_fname = make_app(3, QUERY_BUDGET_ACTION="log", QUERY_BUDGETS={"tapi.personitem": 1})
+
+    # one query per person
+    def n_plus_one():
+        for person in Person.query.all():
+            MealRecord.query.filter(MealRecord.person_pk == person.pk).count()
+        return "", 204
+
+    app.add_url_rule('/n-plus-one/', 'n_plus_one', n_plus_one)
+    with app.app_context():
+        client = app.test_client()
+        with caplog.at_level(logging.WARNING, logger='tapi.querybudget'):
+            assert client.get(ROUTE_ENTRYPOINT + ROUTE_PERSON_COLLECTION).status_code == 200
+            assert client.get('/n-plus-one/').status_code == 204
+            assert client.get(ROUTE_ENTRYPOINT + ROUTE_MEAL_COLLECTION + 'm0/').status_code == 200
+        messages = [r.getMessage() for r in caplog.records]
+        assert len(messages) == 2
+        assert messages[0] == "GET tapi.personitem: 2 SQL statements, budget 1"
+        # no budget, 1 + 3 queries
+        assert messages[1].startswith("GET n_plus_one: 4 SQL statements\n  3 times (N+1?): SELECT count(*)")
+        db.session.remove()
+    os.close(db_fd)
+    os.unlink(db_fname)
+
+
+def test_repeated_statements():
+    statements = ["SELECT 1", "SELECT 2", "SELECT 1", "SELECT 3", "SELECT 1", "SELECT 2"]
+    assert repeated_statements(statements) == [("SELECT 1", 3)]
+    assert repeated_statements(statements, 2) == [("SELECT 1", 3), ("SELECT 2", 2)]
+
+
+def test_query_budget_off_by_default():
+    app, db_fd, db_fname = make_app(3, QUERY_BUDGET_ACTION=None, QUERY_BUDGETS={"tapi.personitem": 0})
+    with app.app_context():
+        assert app.test_client().get(ROUTE_ENTRYPOINT + ROUTE_PERSON_COLLECTION).status_code == 200
+        db.session.remove()
+    os.close(db_fd)
+    os.unlink(db_fname)
+    with pytest.raises(ValueError):
+        create_app({"SQLALCHEMY_DATABASE_URI": "sqlite://", "QUERY_BUDGET_ACTION": "ignore"})